@@ -1,58 +1,145 @@
 import asyncio
 import configparser
 from websockets.asyncio.server import serve
+from websockets.protocol import State
 import file_dl
 import json
+import time
+import socket
 import importlib.util
-import redis
+import redis.asyncio as redis
 import traceback
 from pathlib import Path
-from dataclasses import dataclass
-from subprocess import Popen
-from streaming import start_video_streaming, start_audio_streaming
-from remote_input import handle_packet
-from process import wait_for_window, bring_window_to_foreground
+from dataclasses import dataclass, field, replace
+from subprocess import Popen, TimeoutExpired
+from urllib.parse import urlsplit
+from streaming import start_video_streaming, start_audio_streaming, stream_host_available
+from pipeline import VideoSpec
+from bitrate import BitrateController, control_video_stream
+from remote_input import InputEngine, WindowMessageBackend
+from input_protocol import PROTOCOL_V2, InputDecoderV2, negotiate_protocol
+from process import wait_for_window_async, bring_window_to_foreground
 from game_manager import GameMetadata, GameManager
-import psutil
-
-class AgentState:
-    def __init__(self):
-        self.lock = asyncio.Lock()
-        self.game_proccess = None
-        self.video_streaming_process = None
-        self.audio_streaming_process = None
-        self.connection_event = asyncio.Event()
+from metrics import InputMetrics, MetricsServer, publish_metrics, publish_session_summary
+from supervisor import ProcessSupervisor
+from save_queue import SaveUploadQueue
+from scheduling import DEFAULT_PRIORITY, session_queues, inventory, publish_inventory, record_demand
+from prefetch import Prefetcher
+from checkpoint import SaveCheckpointer
+from hot_files import AccessSampler, access_sampling_available
+from input_recording import InputRecorder
+from warm_pool import WarmPool
+from tracing import NULL_SPAN, Tracer, JsonLinesExporter
+from transfer import TransferStats
 
 class SessionData:
-    def __init__(self, id: str, user: str, game: str):
+    # enqueued_at and deadline are unix milliseconds set by the backend, which
+    # stops waiting for an ack at the deadline. Fields from newer backends are ignored.
+    def __init__(self, id: str, user: str, game: str, enqueued_at: int | None = None, deadline: int | None = None,
+                 priority: str = DEFAULT_PRIORITY, **extra):
         self.id = id
         self.user = user
         self.game = game
+        self.enqueued_at = enqueued_at
+        self.deadline = deadline
+        self.priority = priority
 
+    def queued_for(self) -> float | None:
+        return time.time() - self.enqueued_at / 1000 if self.enqueued_at else None
 
-async def monitor_game_process(agent_state: AgentState):
-    def is_process_alive(proc):
-        if proc is None:
-            return False
-        try:
-            process = psutil.Process(proc.pid)
-            return process.is_running() and process.status() != psutil.STATUS_ZOMBIE
-        except (psutil.NoSuchProcess, psutil.AccessDenied):
-            return False
+    def expired(self, margin: float = 1.0) -> bool:
+        # The margin leaves time for the ack to reach the backend
+        return self.deadline is not None and time.time() + margin >= self.deadline / 1000
 
-    while True:
-        async with agent_state.lock:
-            if not is_process_alive(agent_state.game_proccess):
-                print(f"Game process not running. Closing session.")
-                break
-            if not is_process_alive(agent_state.video_streaming_process):
-                print(f"Video streaming process not running. Closing session.")
-                break
-            if not is_process_alive(agent_state.audio_streaming_process):
-                print(f"Audio streaming process not running. Closing session.")
-                break
+class Session:
+    def __init__(self, data: SessionData, slot: int):
+        self.data = data
+        self.slot = slot
+        self.game_proccess = None
+        self.video_streaming_process = None
+        self.audio_streaming_process = None
+        self.input_engine = None
+        self.input_decoder = None
+        self.input_recorder = None
+        self.protocol = 1
+        self.stream_prefs = None
+        self.bitrate_task = None
+        self.game_metadata = None
+        self.game_pinned = False
+        self.warm_instance = None
+        self.input_metrics = None
+        self.supervisor = None
+        self.checkpointer = None
+        self.access_sampler = None
+        self.install_watch = None
+        self.trace = NULL_SPAN
+        self.acked_at = None
+        # The client's connection while a reconnect may replace it, and the
+        # reconnect waiting for the session's handler to take it over
+        self.ws = None
+        self.reconnect = None
+
+class AgentState:
+    # Session table. Each claimed request reserves a slot, which fixes the
+    # signalling ports handed out in the ack, until its session is torn down
+    # or the client never connects.
+    def __init__(self, max_sessions: int = 1):
+        self.lock = asyncio.Lock()
+        self.slots: list[Session | None] = [None] * max_sessions
+        self.pending_sessions: dict[str, Session] = {}
+        self.sessions: dict[str, Session] = {}
+        self.slot_freed = asyncio.Event()
+
+    def has_capacity(self) -> bool:
+        return None in self.slots
+
+    def is_idle(self) -> bool:
+        return all(slot is None for slot in self.slots)
+
+    def session_count(self) -> int:
+        return sum(slot is not None for slot in self.slots)
+
+    def running_games(self) -> set[str]:
+        return {session.data.game for session in self.slots if session is not None}
+
+    def reserve(self, session_data: SessionData) -> Session:
+        session = Session(session_data, self.slots.index(None))
+        self.slots[session.slot] = session
+        self.pending_sessions[session_data.id] = session
+        return session
 
-        await asyncio.sleep(1.0)
+    def release(self, session: Session):
+        self.pending_sessions.pop(session.data.id, None)
+        self.sessions.pop(session.data.id, None)
+        if self.slots[session.slot] is session:
+            self.slots[session.slot] = None
+            self.slot_freed.set()
+
+    async def wait_for_capacity(self):
+        while not self.has_capacity():
+            self.slot_freed.clear()
+            await self.slot_freed.wait()
+
+
+async def send_progress(ws, phase: str, **data):
+    await ws.send(json.dumps({
+        "type": "progress",
+        "phase": phase,
+        **data
+    }))
+
+def threadsafe_progress(loop: asyncio.AbstractEventLoop, ws, phase: str, interval: float = 0.25):
+    last_sent = 0.0
+
+    def progress(done: int, total: int):
+        nonlocal last_sent
+        now = time.monotonic()
+        if now - last_sent < interval and done < total:
+            return
+        last_sent = now
+        asyncio.run_coroutine_threadsafe(send_progress(ws, phase, done=done, total=total), loop)
+
+    return progress
 
 
 @dataclass
@@ -69,6 +156,35 @@ class Config:
     minio_endpoint: str
     minio_access_key: str
     minio_secret_key: str
+    cache_max_bytes: int = 0
+    save_cache_max_bytes: int = 0
+    install_workers: int = 4
+    hot_file_window: float = 120
+    agent_id: str = ''
+    metrics_http_port: int = 0
+    metrics_redis: bool = False
+    metrics_interval: float = 5.0
+    stream_restarts: int = 3
+    save_transfer_workers: int = 8
+    save_upload_retries: int = 5
+    save_compression: str = 'fast'
+    save_checkpoint_interval: float = 0
+    reconnect_grace: float = 0
+    transfer_part_size: int = 16 * 1024 * 1024
+    inventory_interval: float = 5.0
+    max_sessions: int = 1
+    signalling_port: int = 8443
+    video_spec: VideoSpec = field(default_factory=VideoSpec)
+    prefetch: bool = False
+    prefetch_max_games: int = 5
+    prefetch_bytes_per_second: float = 0
+    demand_window_hours: int = 24
+    warm_pool_size: int = 0
+    warm_pool_games: list[str] = field(default_factory=list)
+    warm_pool_idle_timeout: float = 1800
+    warm_pool_max_memory: int = 0
+    trace_path: str = ''
+    input_record_path: str = ''
 
     @classmethod
     def from_ini(cls, ini_path: str):
@@ -77,6 +193,10 @@ class Config:
         
         games_repo_path = parser['fs']['games_repo']
         working_folder_path = parser['fs']['working_folder']
+        cache_max_bytes = int(parser['fs'].getfloat('cache_max_gb', fallback=0) * 1024 ** 3)
+        save_cache_max_bytes = int(parser['fs'].getfloat('save_cache_max_gb', fallback=0) * 1024 ** 3)
+        install_workers = parser['fs'].getint('install_workers', fallback=4)
+        hot_file_window = parser['fs'].getfloat('hot_file_window', fallback=120)
 
         ws_ip = parser['session']['ws_ip']
         ws_port = int(parser['session']['ws_port'])
@@ -87,9 +207,40 @@ class Config:
         redis_ip = parser['redis']['host']
         redis_port = int(parser['redis']['port'])
 
+        agent_id = parser.get('session', 'agent_id', fallback=socket.gethostname())
+        stream_restarts = parser.getint('session', 'stream_restarts', fallback=3)
+        inventory_interval = parser.getfloat('session', 'inventory_interval', fallback=5.0)
+        max_sessions = parser.getint('session', 'max_sessions', fallback=1)
+        signalling_port = parser.getint('session', 'signalling_port', fallback=8443)
+        save_checkpoint_interval = parser.getfloat('session', 'save_checkpoint_interval', fallback=0)
+        reconnect_grace = parser.getfloat('session', 'reconnect_grace', fallback=0)
+
+        metrics_http_port = parser.getint('metrics', 'http_port', fallback=0)
+        metrics_redis = parser.getboolean('metrics', 'redis', fallback=False)
+        metrics_interval = parser.getfloat('metrics', 'interval', fallback=5.0)
+
+        prefetch = parser.getboolean('prefetch', 'enabled', fallback=False)
+        prefetch_max_games = parser.getint('prefetch', 'max_games', fallback=5)
+        prefetch_bytes_per_second = parser.getfloat('prefetch', 'max_mbps', fallback=0) * 1024 ** 2 / 8
+        demand_window_hours = parser.getint('prefetch', 'demand_window_hours', fallback=24)
+
+        warm_pool_size = parser.getint('warm_pool', 'size', fallback=0)
+        warm_pool_games = [game.strip() for game in parser.get('warm_pool', 'games', fallback='').split(',') if game.strip()]
+        warm_pool_idle_timeout = parser.getfloat('warm_pool', 'idle_minutes', fallback=30) * 60
+        warm_pool_max_memory = int(parser.getfloat('warm_pool', 'max_memory_mb', fallback=0) * 1024 ** 2)
+
+        trace_path = parser.get('tracing', 'path', fallback='')
+        input_record_path = parser.get('input', 'record_path', fallback='')
+
+        video_spec = VideoSpec().merged(dict(parser['stream']) if parser.has_section('stream') else None)
+
         minio_endpoint = parser['minio']['endpoint']
         minio_access_key = parser['minio']['access_key']
         minio_secret_key = parser['minio']['secret_key']
+        save_transfer_workers = parser.getint('minio', 'save_transfer_workers', fallback=8)
+        save_upload_retries = parser.getint('minio', 'save_upload_retries', fallback=5)
+        save_compression = parser.get('minio', 'save_compression', fallback='fast')
+        transfer_part_size = int(parser.getfloat('minio', 'transfer_part_mb', fallback=16) * 1024 ** 2)
 
         return cls(
             games_repo_path=games_repo_path,
@@ -103,47 +254,325 @@ class Config:
             redis_port=redis_port,
             minio_endpoint=minio_endpoint,
             minio_access_key=minio_access_key,
-            minio_secret_key=minio_secret_key
+            minio_secret_key=minio_secret_key,
+            cache_max_bytes=cache_max_bytes,
+            save_cache_max_bytes=save_cache_max_bytes,
+            install_workers=install_workers,
+            hot_file_window=hot_file_window,
+            agent_id=agent_id,
+            metrics_http_port=metrics_http_port,
+            metrics_redis=metrics_redis,
+            metrics_interval=metrics_interval,
+            stream_restarts=stream_restarts,
+            save_transfer_workers=save_transfer_workers,
+            save_upload_retries=save_upload_retries,
+            save_compression=save_compression,
+            save_checkpoint_interval=save_checkpoint_interval,
+            reconnect_grace=reconnect_grace,
+            transfer_part_size=transfer_part_size,
+            inventory_interval=inventory_interval,
+            max_sessions=max_sessions,
+            signalling_port=signalling_port,
+            video_spec=video_spec,
+            prefetch=prefetch,
+            prefetch_max_games=prefetch_max_games,
+            prefetch_bytes_per_second=prefetch_bytes_per_second,
+            demand_window_hours=demand_window_hours,
+            warm_pool_size=warm_pool_size,
+            warm_pool_games=warm_pool_games,
+            warm_pool_idle_timeout=warm_pool_idle_timeout,
+            warm_pool_max_memory=warm_pool_max_memory,
+            trace_path=trace_path,
+            input_record_path=input_record_path
         )
 
-def create_ws_handle(config: Config, agent_state: AgentState, session_data: SessionData):
-
-    game_dl = file_dl.MinioGameFileManager(config.working_folder_path, config.minio_endpoint, config.minio_access_key, config.minio_secret_key, 'games')
-    save_dl = file_dl.MinioSaveFileManager(config.minio_endpoint, config.minio_access_key, config.minio_secret_key, 'saves')
-
-    game_metadata = None
-    game = None
-    user = None
-    monitor_task = None
-    message_task = None
+    # Slot n streams video on signalling_port + 2n and audio on the port after it
+    def video_signalling_port(self, slot: int) -> int:
+        return self.signalling_port + 2 * slot
+
+    def audio_signalling_port(self, slot: int) -> int:
+        return self.signalling_port + 2 * slot + 1
+
+
+def client_connected(ws) -> bool:
+    return ws.state is State.OPEN
+
+def offset_endpoint(endpoint: str, offset: int) -> str:
+    if not offset:
+        return endpoint
+    parts = urlsplit(endpoint)
+    host = parts.netloc.rsplit(':', 1)[0]
+    return parts._replace(netloc=f"{host}:{parts.port + offset}").geturl()
+
+def create_ws_handle(config: Config, agent_state: AgentState, game_dl: file_dl.GameFileManager, save_dl: file_dl.SaveFileManager,
+                     upload_queue: SaveUploadQueue, redis_client: redis.Redis, warm_pool: WarmPool | None = None):
+
+    async def cleanup(session: Session):
+        game, user = session.data.game, session.data.user
+        teardown = session.trace.child('teardown')
+        if session.supervisor:
+            await session.supervisor.stop()
+        if session.bitrate_task:
+            session.bitrate_task.cancel()
+        if session.install_watch:
+            session.install_watch.cancel()
+        if session.checkpointer:
+            await session.checkpointer.stop()
+        if session.access_sampler:
+            accessed = await session.access_sampler.stop()
+            if accessed:
+                await asyncio.to_thread(game_dl.hot_log.record, game, accessed)
+        if session.warm_instance:
+            # Taken from the pool but never adopted; its save root holds nothing of this user's
+            await asyncio.to_thread(session.warm_instance.stop)
+            session.warm_instance = None
+        if session.game_proccess:
+            game_proccess = session.game_proccess
+            session.game_proccess = None
+            try:
+                game_proccess.terminate()
+                await asyncio.to_thread(game_proccess.wait, 5)
+            except (TimeoutExpired, Exception) as e:
+                pass
 
-    async def cleanup():
+            if session.game_metadata:
+                try:
+                    with teardown.child('save_export') as span:
+                        save_files = await asyncio.to_thread(GameManager.export_save, session.game_metadata)
+                        staged = await asyncio.to_thread(save_dl.stage_save, game, user, save_files)
+                        span.set(files=len(save_files), staged=staged,
+                                 checkpoints=session.checkpointer.checkpoints if session.checkpointer else 0)
+                    if staged:
+                        upload_queue.submit(game, user, session.trace)
+                except Exception as e:
+                    print(f"Failed to stage save for {game}/{user}: {e}")
+            else:
+                print("Game metadata is None; skipping save upload.")
+        if session.game_pinned:
+            game_dl.cache.unpin(game)
+        if session.video_streaming_process:
+            session.video_streaming_process.terminate()
+            session.video_streaming_process = None
+        if session.audio_streaming_process:
+            session.audio_streaming_process.terminate()
+            session.audio_streaming_process = None
+        if session.input_engine:
+            session.input_engine.reset()
+            await asyncio.to_thread(session.input_engine.stop)
+            session.input_engine = None
+        if session.input_recorder:
+            session.input_recorder.close()
+            print(f"Recorded {session.input_recorder.count} input messages to {session.input_recorder.path}")
+            session.input_recorder = None
         async with agent_state.lock:
-            if agent_state.game_proccess:
+            agent_state.release(session)
+        teardown.end()
+        session.trace.end()
+        print(f"Session {session.data.id}: game, video streaming, and audio streaming processes released. Input cleaned up.")
+
+        if session.input_metrics:
+            summary = session.input_metrics.snapshot()
+            print(f"Input metrics for session {summary['session_id']}: {json.dumps(summary)}")
+            if config.metrics_redis:
                 try:
-                    agent_state.game_proccess.terminate()
+                    await publish_session_summary(redis_client, config.agent_id, summary)
                 except Exception as e:
-                    pass
-                
-                agent_state.game_proccess = None
-                if game_metadata and game and user:
-                    zipped_save = GameManager.export_save(game_metadata)
-                    save_dl.upload_save(game, user, zipped_save)
+                    print(f"Failed to publish session metrics: {e}")
+
+    async def start_session(ws, session: Session):
+        game, user = session.data.game, session.data.user
+        trace = session.trace
+        loop = asyncio.get_running_loop()
+        supervisor = session.supervisor = ProcessSupervisor(config.stream_restarts)
+        video_port = config.video_signalling_port(session.slot)
+        audio_port = config.audio_signalling_port(session.slot)
+        # A shared desktop needs per-window input and per-process audio capture
+        shared_desktop = config.max_sessions > 1
+
+        def set_video_process(proc: Popen):
+            session.video_streaming_process = proc
+
+        def set_audio_process(proc: Popen):
+            session.audio_streaming_process = proc
+
+        if not client_connected(ws):
+            raise Exception("Client disconnected before the install")
+        game_dl.cache.pin(game)
+        session.game_pinned = True
+        warm = session.warm_instance = await warm_pool.take(game, exclusive=not shared_desktop) if warm_pool else None
+
+        install_span = trace.child('install', cached=game_dl.game_is_downloaded(game))
+        install_progress = threadsafe_progress(loop, ws, "install")
+
+        def progress(done: int, total: int):
+            install_span.set(bytes=total)
+            install_progress(done, total)
+
+        async def install():
+            with install_span:
+                return await asyncio.to_thread(game_dl.install_from_repo, game, progress)
+
+        async def download_save():
+            with trace.child('save_download') as span:
+                # A save still being uploaded from this user's last session has to land first
+                await upload_queue.wait_idle(game, user)
+                save_path = await asyncio.to_thread(save_dl.download_save, game, user)
+                span.set(found=save_path is not None)
+                return save_path
+
+        await send_progress(ws, "install")
+        await send_progress(ws, "save_download")
+        game_path, save_path = await asyncio.gather(install(), download_save())
+        print (f"Game {game} installed to {game_path}")
+        if game_dl.installing_in_background(game):
+            # The game runs on its hot files; without the rest it cannot go on
+            async def watch_install():
+                error = await asyncio.to_thread(game_dl.background_result, game)
+                if error:
+                    supervisor.fail("Install", f"the rest of {game} could not be installed: {error}")
+            session.install_watch = asyncio.create_task(watch_install())
+        session.game_metadata = await asyncio.to_thread(GameMetadata.load, game_path / "cloud_gaming_metadata.json")
+        print(f"Game metadata: {session.game_metadata}")
+        if warm and warm.game_path != game_path:
+            print(f"{game} was updated after its warm instance started; launching it fresh")
+            await asyncio.to_thread(warm.stop)
+            warm = session.warm_instance = None
+
+        if save_path:
+            print(f"Existing save downloaded to {save_path}. Importing...")
+        else:
+            print("No existing save found.")
+
+        # The install may have taken a while; don't launch a game nobody is waiting for
+        if not client_connected(ws):
+            raise Exception("Client disconnected before the launch")
+
+        # A warm instance is still in its menus, so the save is in place before the game reads it
+        await send_progress(ws, "save_import")
+        with trace.child('save_import') as span:
+            span.set(copied=await asyncio.to_thread(GameManager.import_save, save_path, session.game_metadata))
+
+        await send_progress(ws, "launch")
+        with trace.child('launch', warm=warm is not None):
+            if warm:
+                session.game_proccess = warm.process
+                session.warm_instance = None
+            else:
+                session.game_proccess = await asyncio.to_thread(GameManager.start_game, game_path, session.game_metadata)
+        game_pid = session.game_proccess.pid
+        start_audio = lambda: start_audio_streaming(audio_port, game_pid if shared_desktop else None)
+        with trace.child('audio_start'):
+            session.audio_streaming_process = await asyncio.to_thread(start_audio)
+        supervisor.watch("Game", session.game_proccess)
+        if session.game_metadata.hot_files is not None and config.hot_file_window > 0 and access_sampling_available():
+            # Teaches later partial installs which files this game needs early
+            session.access_sampler = AccessSampler(game_pid, game_path, config.hot_file_window)
+            session.access_sampler.start()
+        if config.save_checkpoint_interval > 0:
+            session.checkpointer = SaveCheckpointer(save_dl, upload_queue, game, user, session.game_metadata,
+                                                    config.save_checkpoint_interval, trace=trace)
+            session.checkpointer.start()
+        supervisor.watch("Audio streaming", session.audio_streaming_process, start_audio, set_audio_process)
+
+        await send_progress(ws, "window")
+        with trace.child('wait_for_window') as span:
+            if warm:
+                hwnd = warm.hwnd
+            else:
+                window_task = asyncio.create_task(wait_for_window_async(game_pid))
+                exit_task = asyncio.create_task(supervisor.wait())
+                await asyncio.wait([window_task, exit_task], return_when=asyncio.FIRST_COMPLETED)
+                exit_task.cancel()
+                if window_task.done():
+                    hwnd = window_task.result()
                 else:
-                    print("Game metadata, game, or user is None; skipping save upload.")
-            if agent_state.video_streaming_process:
-                agent_state.video_streaming_process.terminate()
-                agent_state.video_streaming_process = None
-            if agent_state.audio_streaming_process:
-                agent_state.audio_streaming_process.terminate()
-                agent_state.audio_streaming_process = None
-            cleanup_packet = bytes(56)
-            handle_packet(cleanup_packet)
-            print("Game, video streaming, and audio streaming processes released. Input cleaned up.")
+                    window_task.cancel()
+                    hwnd = None
+            span.set(found=bool(hwnd))
+
+        if not hwnd:
+            await ws.send(json.dumps({
+                "result": "err",
+                "msg": "Unable to start the game."
+            }))
+            raise Exception("Window not found")
+
+        session.input_engine = InputEngine(WindowMessageBackend(hwnd) if shared_desktop else None)
+        session.input_engine.metrics = session.input_metrics
+        session.input_engine.start()
+
+        await send_progress(ws, "stream")
+        stream_span = trace.child('stream_start')
+        await asyncio.to_thread(bring_window_to_foreground, hwnd)
+        print(f"Streaming window {hwnd}")
+        # Agent defaults, then the game's own settings, then whatever the client asked for
+        spec = config.video_spec.merged(session.game_metadata.stream).with_client(session.stream_prefs)
+        if spec.adaptive and not stream_host_available():
+            print("PyGObject is not installed; streaming with a fixed bitrate.")
+            spec = replace(spec, adaptive=False)
+        print(f"Video stream: {spec}")
+        start_video = lambda: start_video_streaming(hwnd, video_port, spec)
+        with stream_span:
+            stream_span.set(encoder=spec.encoder, adaptive=spec.adaptive)
+            session.video_streaming_process = await asyncio.to_thread(start_video)
+        supervisor.watch("Video streaming", session.video_streaming_process, start_video, set_video_process)
+        if spec.adaptive:
+            session.bitrate_task = asyncio.create_task(
+                control_video_stream(lambda: session.video_streaming_process, BitrateController(spec)))
+
+    async def wait_for_reconnect(session: Session, monitor_task: asyncio.Task):
+        # The game and its streams keep running with input back at neutral, so
+        # nothing stays held down, until the client reconnects with the same
+        # session id and user or the grace period runs out
+        session.input_engine.reset()
+        if session.reconnect is None:
+            session.reconnect = asyncio.get_running_loop().create_future()
+        print(f"Client of session {session.data.id} disconnected. Keeping the session for {config.reconnect_grace:.0f}s.")
+        span = session.trace.child('detached')
+        await asyncio.wait([session.reconnect, monitor_task], timeout=config.reconnect_grace, return_when=asyncio.FIRST_COMPLETED)
+        reconnect = session.reconnect
+        session.reconnect = None
+        if not reconnect.done():
+            reconnect.cancel()
+            span.set(reattached=False)
+            span.end()
+            return None
+
+        ws, json_msg, released = reconnect.result()
+        session.protocol = negotiate_protocol(json_msg.get('protocols'))
+        session.input_decoder = InputDecoderV2() if session.protocol == PROTOCOL_V2 else None
+        span.set(reattached=True, protocol=session.protocol)
+        span.end()
+        print(f"Client of session {session.data.id} reconnected.")
+        await ws.send(json.dumps({
+            "result": "ok",
+            "protocol": session.protocol,
+            "reattached": True
+        }))
+        return ws, released
+
+    def hand_over(session: Session, ws, json_msg: dict):
+        reattached = asyncio.get_running_loop().create_future()
+        reconnect = session.reconnect
+        if reconnect and reconnect.done():
+            # An earlier reconnect the handler has not taken over yet is superseded
+            reconnect.result()[2].set_result(None)
+            reconnect = None
+        if reconnect is None:
+            reconnect = session.reconnect = asyncio.get_running_loop().create_future()
+        reconnect.set_result((ws, json_msg, reattached))
+        if session.ws:
+            # The client is already back, so the old connection is dead even if
+            # it looks open until the ping timeout; drop it without a close handshake
+            session.ws.transport.abort()
+            session.ws = None
+        return reattached
 
     async def ws_handle(ws):
-        nonlocal game_metadata, game, user, monitor_task, message_task
-        new_session = False
+        session = None
+        monitor_task = None
+        message_task = None
+        released = None
         try:
             try:
                 print("Waiting for start message...")
@@ -165,137 +594,293 @@ def create_ws_handle(config: Config, agent_state: AgentState, session_data: Sess
                 }))
                 return
 
-            user = json_msg.get('user')
-            game = json_msg.get('game')
-
-            if user != session_data.user or game != session_data.game or session_data.id != json_msg.get('id'):
-                print("Session data mismatch. Received:", json_msg)
-                await ws.send(json.dumps({
-                    "result": "err",
-                    "msg": "Session data mismatch."
-                }))
-                return
-
             async with agent_state.lock:
-                if agent_state.game_proccess is not None:
-                    print(f"A new connection was made but a game is already running. Closing the new connection.")
-                    await ws.send(json.dumps({
-                        "result": "err",
-                        "msg": "A session is already running."
-                    }))
-                    return
-
-                new_session = True
-                agent_state.connection_event.set()
-
-                game_path = game_dl.install_from_repo(game)
-                print (f"Game {game} installed to {game_path}")
-                game_metadata = GameMetadata.from_json(game_path / "cloud_gaming_metadata.json")
-                print(f"Game metadata: {game_metadata}")
-                save_path = save_dl.download_save(game, user)
-
-                if save_path:
-                    print(f"Existing save downloaded to {save_path}. Importing...")
+                live = agent_state.sessions.get(json_msg.get('id'))
+                if live and (live.ws or live.reconnect) and json_msg.get('user') == live.data.user and json_msg.get('game') == live.data.game:
+                    # Hand this connection to the handler that owns the session
+                    reattached = hand_over(live, ws, json_msg)
                 else:
-                    print("No existing save found.")
-                    
-                GameManager.import_save(save_path, game_metadata)
-
-                agent_state.game_proccess = GameManager.start_game(game_path, game_metadata)
-
-                hwnd = wait_for_window(agent_state.game_proccess.pid)
+                    reattached = None
+                    pending = agent_state.pending_sessions.get(json_msg.get('id'))
+                    if pending is None or json_msg.get('user') != pending.data.user or json_msg.get('game') != pending.data.game:
+                        print("Session data mismatch. Received:", json_msg)
+                        await ws.send(json.dumps({
+                            "result": "err",
+                            "msg": "Session data mismatch."
+                        }))
+                        return
+
+                    session = agent_state.pending_sessions.pop(pending.data.id)
+                    agent_state.sessions[session.data.id] = session
+                    session.trace.child('ws_connect', start=session.acked_at).end()
+                    session.input_metrics = InputMetrics(session.data.id)
+                    session.protocol = negotiate_protocol(json_msg.get('protocols'))
+                    session.stream_prefs = json_msg.get('stream')
+                    if session.protocol == PROTOCOL_V2:
+                        session.input_decoder = InputDecoderV2()
+                    session.trace.set(protocol=session.protocol)
+                    if config.input_record_path:
+                        session.input_recorder = InputRecorder(Path(config.input_record_path) / f'{session.data.id}.cgir', session.protocol)
+
+            if reattached:
+                # The connection closes once this handler returns
+                await reattached
+                return
 
-                if not hwnd:
-                    await ws.send(json.dumps({
-                        "result": "err",
-                        "msg": "Unable to start the game."
-                    }))
-                    raise Exception("Window not found")
+            await start_session(ws, session)
+            session.trace.set(startup_ms=(time.perf_counter() - session.acked_at) * 1000)
+            await ws.send(json.dumps({
+                "result": "ok",
+                "protocol": session.protocol
+            }))
 
-                bring_window_to_foreground(hwnd)
-                print(f"Streaming window {hwnd}")
-                agent_state.video_streaming_process = start_video_streaming(hwnd)
-                agent_state.audio_streaming_process = start_audio_streaming()
-                await ws.send(json.dumps({
-                    "result": "ok",
-                }))
+            async def handle_frame(ws, frame: bytes):
+                decoder = session.input_decoder
+                resync_needed = decoder.resync_needed
+                try:
+                    packets = decoder.decode(frame)
+                except ValueError as e:
+                    print(f"Invalid input frame: {e}")
+                    session.input_metrics.bad_size += 1
+                    return
+                session.input_metrics.lost = decoder.lost
+                for pkt in packets:
+                    session.input_engine.submit(pkt)
+                if decoder.resync_needed and not resync_needed:
+                    await ws.send(json.dumps({"type": "resync"}))
 
-            async def handle_messages():
+            async def handle_messages(ws):
                 try:
                     async for msg in ws:
                         if isinstance(msg, bytes):
-                            handle_packet(msg)
+                            if session.input_recorder:
+                                session.input_recorder.record(msg)
+                            if session.input_decoder:
+                                await handle_frame(ws, msg)
+                            else:
+                                session.input_engine.submit(msg)
                         else:
                             print(f"New msg: {msg}")
                 except Exception as e:
                     print(f"Error in message handling: {e}")
 
-            monitor_task = asyncio.create_task(monitor_game_process(agent_state))    
-            message_task = asyncio.create_task(handle_messages())
-            
-            await asyncio.wait(
-                [message_task, monitor_task], 
-                return_when=asyncio.FIRST_COMPLETED
-            )
+            monitor_task = asyncio.create_task(session.supervisor.wait())
+            while True:
+                if config.reconnect_grace > 0:
+                    session.ws = ws
+                message_task = asyncio.create_task(handle_messages(ws))
+                await asyncio.wait(
+                    [message_task, monitor_task],
+                    return_when=asyncio.FIRST_COMPLETED
+                )
+                session.ws = None
+                if released:
+                    released.set_result(None)
+                    released = None
+                # Only a lost client is waited for; a game that exited ends the session
+                if monitor_task.done() or config.reconnect_grace <= 0:
+                    break
+                reconnected = await wait_for_reconnect(session, monitor_task)
+                if reconnected is None:
+                    break
+                ws, released = reconnected
+
+            ended = monitor_task.result() if monitor_task.done() else None
+            if ended and ended.error:
+                try:
+                    await ws.send(json.dumps({"type": "error", "msg": f"Session ended: {ended.error}"}))
+                except Exception:
+                    pass
         except Exception as e:
             traceback.print_exc()
             print(f"Error: {e}. Closing session")
         finally:
-            if new_session:
-                await cleanup()
-                ws.server.close()
+            if session:
+                session.ws = None
+                reconnect, session.reconnect = session.reconnect, None
+                if reconnect and reconnect.done() and not reconnect.cancelled():
+                    reconnect.result()[2].set_result(None)
+                await cleanup(session)
                 for task in [message_task, monitor_task]:
                     if task is not None and not task.done():
                         task.cancel()
                         try:
                             await task
-                        except Exception:
+                        except (Exception, asyncio.CancelledError):
                             pass
+            if released and not released.done():
+                released.set_result(None)
 
     return ws_handle
 
 
-async def main(config: Config):
-    agent_state = AgentState()
-    redis_client = redis.Redis(host=config.redis_ip, port=config.redis_port)
+async def expire_pending_session(agent_state: AgentState, session: Session, timeout: float = 10):
+    await asyncio.sleep(timeout)
+    async with agent_state.lock:
+        if agent_state.pending_sessions.get(session.data.id) is session:
+            print(f"No connection received for session {session.data.id} within {timeout} seconds. Canceling session.")
+            agent_state.release(session)
+            session.trace.set(expired=True)
+            session.trace.end()
+
+
+async def publish_metrics_loop(config: Config, agent_state: AgentState, redis_client: redis.Redis):
     while True:
+        await asyncio.sleep(config.metrics_interval)
+        snapshots = [session.input_metrics.snapshot() for session in list(agent_state.sessions.values()) if session.input_metrics]
+        if not snapshots:
+            continue
         try:
-            print("Waiting for next session request...")
-            _, session_request = redis_client.brpop("sessions", timeout=0)
-            session_data = json.loads(session_request)
-            print(f"Received session request: {session_data}")
-            session_data = SessionData(**session_data)
-
-            redis_client.lpush(f"{session_data.id}", json.dumps({
-                "ws_endpoint": config.reported_ws_endpoint,
-                "video_signalling_endpoint": config.reported_video_signalling_endpoint,
-                "audio_signalling_endpoint": config.reported_audio_signalling_endpoint,
-                "id": session_data.id
-            }))
-            redis_client.expire(f"{session_data.id}", 60)
-
-            agent_state.connection_event.clear()
-            
-            ws_handler = create_ws_handle(config, agent_state, session_data)
-            async with serve(ws_handler, config.ws_ip, config.ws_port) as server:
-                print("WebSocket server started. Waiting for connection...")
-                
-                try:
-                    await asyncio.wait_for(agent_state.connection_event.wait(), timeout=10)
-                    print("Connection established. Waiting for session to complete...")
-                except asyncio.TimeoutError:
-                    print("No connection received within 10 seconds. Canceling session.")
-                    server.close()
-                
-                await server.wait_closed()
-                print("WebSocket server closed.")
+            await publish_metrics(redis_client, config.agent_id, snapshots, int(config.metrics_interval * 3))
+        except Exception as e:
+            print(f"Failed to publish metrics: {e}")
+
 
+async def publish_inventory_loop(config: Config, agent_state: AgentState, game_dl: file_dl.GameFileManager, redis_client: redis.Redis):
+    while True:
+        try:
+            snapshot = await asyncio.to_thread(inventory, config.agent_id, game_dl.cache.games(), config.working_folder_path,
+                                               agent_state.session_count(), config.max_sessions)
+            await publish_inventory(redis_client, snapshot, int(config.inventory_interval * 3))
         except Exception as e:
-            print(f"Error connecting to Redis server: {e}. Retrying in 10 seconds...")
-            await asyncio.sleep(10)
+            print(f"Failed to publish inventory: {e}")
+        await asyncio.sleep(config.inventory_interval)
+
+
+async def main(config: Config):
+    redis_client = redis.Redis(host=config.redis_ip, port=config.redis_port)
+    minio_client = file_dl.MinioClient(config.minio_endpoint, config.minio_access_key, config.minio_secret_key,
+                                       max_connections=2 * config.install_workers + config.save_transfer_workers,
+                                       state_path=Path(config.working_folder_path) / '.transfers',
+                                       part_size=config.transfer_part_size, transfer_workers=config.install_workers)
+    game_dl = file_dl.MinioGameFileManager(config.working_folder_path, minio_client, 'games', config.cache_max_bytes, config.install_workers)
+    save_dl = file_dl.MinioSaveFileManager(minio_client, 'saves', Path(config.working_folder_path) / '.saves', config.save_transfer_workers,
+                                           config.save_compression, config.save_cache_max_bytes)
+    await run_agent(config, redis_client, game_dl, save_dl, transfer_stats=minio_client.stats)
+
+
+async def run_agent(config: Config, redis_client: redis.Redis, game_dl: file_dl.GameFileManager, save_dl: file_dl.SaveFileManager,
+                    tracer: Tracer | None = None, transfer_stats: TransferStats | None = None):
+    agent_state = AgentState(config.max_sessions)
+    if tracer is None:
+        tracer = Tracer(JsonLinesExporter(config.trace_path) if config.trace_path else None)
+
+    upload_queue = SaveUploadQueue(save_dl, config.save_upload_retries)
+    for game, user in save_dl.pending_saves():
+        upload_queue.submit(game, user)
+
+    if config.metrics_http_port:
+        def current_snapshots():
+            return [session.input_metrics.snapshot() for session in list(agent_state.sessions.values()) if session.input_metrics]
+        await MetricsServer(config.agent_id, current_snapshots, config.ws_ip, config.metrics_http_port,
+                            transfer_stats.snapshot if transfer_stats else None).start()
+    if config.metrics_redis:
+        asyncio.create_task(publish_metrics_loop(config, agent_state, redis_client))
+
+    asyncio.create_task(publish_inventory_loop(config, agent_state, game_dl, redis_client))
+
+    prefetcher = None
+    if config.prefetch:
+        prefetcher = Prefetcher(game_dl, redis_client, config.prefetch_max_games, config.prefetch_bytes_per_second,
+                                config.demand_window_hours)
+
+    warm_pool = None
+    if config.warm_pool_size > 0:
+        # One desktop only has room for the warm instances while nothing is being streamed
+        shared_desktop = config.max_sessions > 1
+        warm_pool = WarmPool(game_dl, redis_client, GameManager.start_game, wait_for_window_async,
+                             lambda: agent_state.has_capacity() and (shared_desktop or agent_state.is_idle()),
+                             agent_state.running_games, config.warm_pool_size, config.warm_pool_games,
+                             config.warm_pool_idle_timeout, config.warm_pool_max_memory, config.demand_window_hours)
+        warm_pool.start()
+
+    ws_handler = create_ws_handle(config, agent_state, game_dl, save_dl, upload_queue, redis_client, warm_pool)
+    async with serve(ws_handler, config.ws_ip, config.ws_port):
+        print(f"WebSocket server started. Accepting up to {config.max_sessions} concurrent sessions.")
+        waiting = False
+        wait_started = time.perf_counter()
+        # Games whose request at the head of a global queue had to be handed back
+        passed_over = set()
+        while True:
+            try:
+                if not agent_state.has_capacity():
+                    print("All session slots in use. Waiting for a session to end...")
+                    await agent_state.wait_for_capacity()
+                    waiting = False
+                    continue
+                if not waiting:
+                    print("Waiting for next session request...")
+                    waiting = True
+                    wait_started = time.perf_counter()
+                if prefetcher and agent_state.is_idle():
+                    prefetcher.start()
+
+                # Games already running here are left to other agents: they share one save root
+                running_games = agent_state.running_games()
+                installed_games = [game for game in game_dl.cache.games() if game not in running_games]
+                # Until those games end here the global queues are left to other agents
+                passed_over &= running_games
+                queues = session_queues(installed_games, include_global=not passed_over)
+                if not queues:
+                    await asyncio.sleep(config.inventory_interval)
+                    continue
+                # Re-read the inventory every few seconds so newly installed games get their queues
+                popped = await redis_client.brpop(queues, timeout=config.inventory_interval)
+                if popped is None:
+                    continue
+                queue, session_request = popped
+                waiting = False
+                session_data = json.loads(session_request)
+                print(f"Received session request from {queue.decode()}: {session_data}")
+                session_data = SessionData(**session_data)
+
+                # The backend has given up on it; acking would only start a game nobody connects to
+                if session_data.expired():
+                    print(f"Session request {session_data.id} is past its deadline. Dropping it.")
+                    tracer.start(session_data.id, 'session', agent=config.agent_id, game=session_data.game, user=session_data.user,
+                                 priority=session_data.priority, dropped='expired').end()
+                    continue
+
+                if session_data.game in agent_state.running_games():
+                    print(f"{session_data.game} is already running on this agent. Returning the request to the head of {queue.decode()}.")
+                    # The backend lpushes and agents brpop, so rpush puts it back in its place
+                    await redis_client.rpush(queue, session_request)
+                    passed_over.add(session_data.game)
+                    continue
+
+                trace = tracer.start(session_data.id, 'session', agent=config.agent_id, game=session_data.game, user=session_data.user,
+                                     priority=session_data.priority)
+                trace.child('queue_wait', start=wait_started, queue=queue.decode(), queued_for=session_data.queued_for()).end()
+                with trace.child('ack'):
+                    if prefetcher:
+                        prefetcher.preempt(session_data.game)
+                    try:
+                        await record_demand(redis_client, session_data.game, config.demand_window_hours)
+                    except Exception as e:
+                        print(f"Failed to record demand for {session_data.game}: {e}")
+
+                    async with agent_state.lock:
+                        session = agent_state.reserve(session_data)
+                    session.trace = trace
+                    trace.set(slot=session.slot)
+
+                    session.acked_at = time.perf_counter()
+                    await redis_client.lpush(f"{session_data.id}", json.dumps({
+                        "ws_endpoint": config.reported_ws_endpoint,
+                        "video_signalling_endpoint": offset_endpoint(config.reported_video_signalling_endpoint, 2 * session.slot),
+                        "audio_signalling_endpoint": offset_endpoint(config.reported_audio_signalling_endpoint, 2 * session.slot),
+                        "id": session_data.id
+                    }))
+                    await redis_client.expire(f"{session_data.id}", 60)
+                print(f"Session {session_data.id} assigned to slot {session.slot}.")
+                asyncio.create_task(expire_pending_session(agent_state, session))
+
+            except Exception as e:
+                print(f"Error connecting to Redis server: {e}. Retrying in 10 seconds...")
+                await asyncio.sleep(10)
 
 
 if __name__ == "__main__":
     config = Config.from_ini('agent/config.ini')
     
-    asyncio.run(main(config))
\ No newline at end of file
+    asyncio.run(main(config))
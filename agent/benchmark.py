@@ -0,0 +1,447 @@
+import os
+import sys
+import json
+import time
+import shutil
+import socket
+import asyncio
+import zipfile
+import argparse
+import contextlib
+import tempfile
+from pathlib import Path
+from subprocess import Popen
+from types import SimpleNamespace
+from minio import S3Error
+from websockets.asyncio.client import connect
+import app
+import file_dl
+from game_manager import GameManager, SaveFile
+from pipeline import VideoSpec
+
+# End-to-end session startup benchmark. Runs the real agent loop (app.run_agent)
+# against in-process stand-ins: a fake Redis, a directory standing in for MinIO,
+# a dummy game and stubbed window/streaming hooks, then drives sessions the way
+# the backend and the web client do and reports where the time goes.
+#
+#   python agent/benchmark.py --sizes 10M,100M,1G --saves 0,1000 --warm-runs 2
+
+PHASES = ('queue_pickup', 'ack', 'ws_connect', 'install', 'save_download', 'save_import', 'launch', 'stream_start', 'total', 'teardown')
+
+
+class FakeRedis:
+    # Just the commands the agent and backend use, on plain dicts
+    def __init__(self):
+        self.data = {}
+        self.changed = asyncio.Condition()
+        self.brpop_waiters = 0
+        self.popped_at = {}
+
+    @staticmethod
+    def key(key) -> str:
+        return key.decode() if isinstance(key, bytes) else key
+
+    @staticmethod
+    def value(value) -> bytes:
+        return value if isinstance(value, bytes) else str(value).encode()
+
+    async def notify(self):
+        async with self.changed:
+            self.changed.notify_all()
+
+    async def lpush(self, key, *values):
+        items = self.data.setdefault(self.key(key), [])
+        for value in values:
+            items.insert(0, self.value(value))
+        await self.notify()
+        return len(items)
+
+    async def rpush(self, key, *values):
+        items = self.data.setdefault(self.key(key), [])
+        items.extend(self.value(value) for value in values)
+        await self.notify()
+        return len(items)
+
+    async def lrem(self, key, count, value):
+        items = self.data.get(self.key(key), [])
+        value = self.value(value)
+        if value in items:
+            items.remove(value)
+            return 1
+        return 0
+
+    async def ltrim(self, key, start, end):
+        items = self.data.get(self.key(key), [])
+        self.data[self.key(key)] = items[start:end + 1 if end >= 0 else len(items) + end + 1]
+
+    async def blocking_pop(self, keys, timeout, index: int):
+        keys = [self.key(keys)] if isinstance(keys, (str, bytes)) else [self.key(k) for k in keys]
+        deadline = time.monotonic() + timeout if timeout else None
+        async with self.changed:
+            while True:
+                for key in keys:
+                    if self.data.get(key):
+                        value = self.data[key].pop(index)
+                        self.popped_at[value] = time.perf_counter()
+                        return key.encode(), value
+                remaining = deadline - time.monotonic() if deadline else None
+                if remaining is not None and remaining <= 0:
+                    return None
+                try:
+                    await asyncio.wait_for(self.changed.wait(), remaining)
+                except asyncio.TimeoutError:
+                    return None
+
+    async def brpop(self, keys, timeout=0):
+        self.brpop_waiters += 1
+        try:
+            return await self.blocking_pop(keys, timeout, -1)
+        finally:
+            self.brpop_waiters -= 1
+
+    async def blpop(self, keys, timeout=0):
+        return await self.blocking_pop(keys, timeout, 0)
+
+    async def expire(self, key, seconds):
+        return True
+
+    async def set(self, key, value, ex=None):
+        self.data[self.key(key)] = self.value(value)
+
+    async def sadd(self, key, *members):
+        self.data.setdefault(self.key(key), set()).update(self.value(m) for m in members)
+
+    async def zincrby(self, key, amount, member):
+        scores = self.data.setdefault(self.key(key), {})
+        member = self.value(member)
+        scores[member] = scores.get(member, 0) + amount
+        return scores[member]
+
+    async def zrange(self, key, start, end, withscores=False):
+        scores = self.data.get(self.key(key), {})
+        items = sorted(scores.items(), key=lambda item: item[1])
+        items = items[start:end + 1 if end >= 0 else len(items) + end + 1]
+        return items if withscores else [member for member, _ in items]
+
+
+class LocalObjectStore:
+    # Same interface as file_dl.MinioClient over a directory of bucket folders
+    def __init__(self, root: Path):
+        self.root = Path(root)
+
+    def path(self, bucket: str, object_name: str) -> Path:
+        return self.root / bucket / object_name
+
+    def existing(self, bucket: str, object_name: str) -> Path:
+        path = self.path(bucket, object_name)
+        if not path.is_file():
+            raise S3Error(response=None, code="NoSuchKey", message="Object does not exist", resource=object_name,
+                          request_id=None, host_id=None, bucket_name=bucket, object_name=object_name)
+        return path
+
+    def download(self, bucket: str, object_name: str, local_path: str):
+        shutil.copyfile(self.existing(bucket, object_name), local_path)
+
+    def upload(self, bucket: str, object_name: str, local_path: str):
+        path = self.path(bucket, object_name)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        shutil.copyfile(local_path, path)
+
+    def get_bytes(self, bucket: str, object_name: str) -> bytes:
+        return self.existing(bucket, object_name).read_bytes()
+
+    def put_stream(self, bucket: str, object_name: str, stream, part_size: int = 8 * 1024 * 1024):
+        path = self.path(bucket, object_name)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(path, 'wb') as f:
+            while chunk := stream.read(part_size):
+                f.write(chunk)
+
+    def download_to(self, bucket: str, object_name: str, dst):
+        with open(self.existing(bucket, object_name), 'rb') as f:
+            while chunk := f.read(1024 * 1024):
+                dst.write(chunk)
+
+    def put_bytes(self, bucket: str, object_name: str, data: bytes):
+        path = self.path(bucket, object_name)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(data)
+
+    def remove(self, bucket: str, object_name: str):
+        self.path(bucket, object_name).unlink(missing_ok=True)
+
+    def stat(self, bucket: str, object_name: str):
+        st = self.existing(bucket, object_name).stat()
+        return SimpleNamespace(size=st.st_size, etag=f'{st.st_size}-{st.st_mtime_ns}')
+
+    def read_range(self, bucket: str, object_name: str, offset: int, length: int, etag: str | None = None) -> bytes:
+        if etag and self.stat(bucket, object_name).etag != etag:
+            raise Exception(f"{bucket}/{object_name} changed since it was opened")
+        with open(self.existing(bucket, object_name), 'rb') as f:
+            f.seek(offset)
+            return f.read(length)
+
+
+def idle_process() -> Popen:
+    return Popen([sys.executable, '-c', 'import time; time.sleep(86400)'])
+
+def fake_start_video_streaming(window_handle: int, signalling_port: int = 8443, spec: VideoSpec | None = None) -> Popen:
+    return idle_process()
+
+def fake_start_audio_streaming(signalling_port: int = 8444, target_pid: int | None = None) -> Popen:
+    return idle_process()
+
+async def fake_wait_for_window(pid, timeout=10.0, check_interval=0.1):
+    return pid
+
+def fake_bring_window_to_foreground(hwnd):
+    pass
+
+class BenchGameManager(GameManager):
+    # The dummy game is a Python script, so it is started through the interpreter
+    @staticmethod
+    def start_game(game_root_folder: Path, metadata) -> Popen:
+        exe_path = game_root_folder / metadata.exe_location
+        return Popen([sys.executable, str(exe_path)], cwd=str(exe_path.parent))
+
+def install_hooks():
+    app.start_video_streaming = fake_start_video_streaming
+    app.start_audio_streaming = fake_start_audio_streaming
+    app.wait_for_window_async = fake_wait_for_window
+    app.bring_window_to_foreground = fake_bring_window_to_foreground
+    app.GameManager = BenchGameManager
+
+
+DUMMY_GAME = '''import os
+import time
+from pathlib import Path
+# Change one save file so every session has something to stage on exit
+root = Path({save_root!r})
+root.mkdir(parents=True, exist_ok=True)
+(root / 'session.sav').write_bytes(os.urandom(4096))
+time.sleep(86400)
+'''
+
+def parse_size(text: str) -> int:
+    units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+    text = text.strip().upper()
+    if text[-1] in units:
+        return int(float(text[:-1]) * units[text[-1]])
+    return int(text)
+
+def make_game(store: Path, game: str, size: int, save_root: Path, chunk_size: int = 16 * 1024 * 1024, small_files: int = 200):
+    # Incompressible bulk data plus a tree of small deflated assets
+    zip_path = store / 'games' / f'{game}.zip'
+    zip_path.parent.mkdir(parents=True, exist_ok=True)
+    with zipfile.ZipFile(zip_path, 'w') as zip:
+        zip.writestr('cloud_gaming_metadata.json', json.dumps({
+            'exe_location': 'game.py',
+            'save_root': str(save_root),
+            'save_patterns': [{'pattern_root': '.', 'pattern': '*'}]
+        }))
+        zip.writestr('game.py', DUMMY_GAME.format(save_root=str(save_root)))
+        for i in range(small_files):
+            zip.writestr(f'assets/{i % 10}/asset_{i}.txt', (f'asset {i} ' * 512).encode(), compress_type=zipfile.ZIP_DEFLATED)
+        remaining = size
+        index = 0
+        while remaining > 0:
+            with zip.open(f'data/pack_{index}.bin', 'w', force_zip64=True) as f:
+                chunk_remaining = min(chunk_size, remaining)
+                while chunk_remaining > 0:
+                    piece = os.urandom(min(1024 * 1024, chunk_remaining))
+                    f.write(piece)
+                    chunk_remaining -= len(piece)
+            remaining -= chunk_size
+            index += 1
+
+def seed_save(store: Path, scratch: Path, game: str, user: str, count: int, file_size: int):
+    # Written through a separate manager so the agent's own save mirror starts cold
+    if not count:
+        return
+    save_files = scratch / 'seed'
+    shutil.rmtree(save_files, ignore_errors=True)
+    save_files.mkdir(parents=True)
+    files = {}
+    for i in range(count):
+        path = save_files / f'slot_{i}.sav'
+        path.write_bytes(os.urandom(file_size))
+        files[path.name] = SaveFile.from_path(path)
+    seeder = file_dl.MinioSaveFileManager(LocalObjectStore(store), 'saves', scratch / 'seed_mirror')
+    seeder.upload_save(game, user, files)
+
+def timed(obj, method: str, timings: dict, phase: str):
+    original = getattr(obj, method)
+
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return original(*args, **kwargs)
+        finally:
+            timings[phase] = time.perf_counter() - start
+
+    setattr(obj, method, wrapper)
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+async def wait_until(predicate, timeout: float = 120):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() > deadline:
+            raise Exception("Timed out waiting for the agent")
+        await asyncio.sleep(0.005)
+
+async def create_session(redis_client: FakeRedis, session_id: str, user: str, game: str, locality_timeout: float) -> dict:
+    # Same placement protocol as backend/src/session.js
+    enqueued_at = int(time.time() * 1000)
+    request = json.dumps({'id': session_id, 'user': user, 'game': game, 'enqueued_at': enqueued_at, 'deadline': enqueued_at + 60_000,
+                          'priority': 'normal'})
+    game_queue = f'sessions:game:{game}'
+    await redis_client.lpush(game_queue, request)
+    ack = await redis_client.blpop(session_id, locality_timeout)
+    if not ack:
+        if await redis_client.lrem(game_queue, 1, request):
+            await redis_client.lpush('sessions', request)
+        ack = await redis_client.blpop(session_id, 60)
+    if not ack:
+        raise Exception("Session creation timed out")
+    return json.loads(ack[1])
+
+async def run_session(redis_client: FakeRedis, timings: dict, session_id: str, user: str, game: str, locality_timeout: float) -> dict:
+    await wait_until(lambda: redis_client.brpop_waiters > 0)
+    timings.clear()
+    start = time.perf_counter()
+    ack = await create_session(redis_client, session_id, user, game, locality_timeout)
+    acked = time.perf_counter()
+    picked = min(t for value, t in redis_client.popped_at.items() if session_id.encode() in value)
+
+    phases = {}
+    async with connect(ack['ws_endpoint'], max_size=None) as ws:
+        opened = time.perf_counter()
+        await ws.send(json.dumps({'type': 'start', 'id': session_id, 'user': user, 'game': game, 'protocols': [2, 1]}))
+        async for message in ws:
+            msg = json.loads(message)
+            if msg.get('type') == 'progress':
+                phases.setdefault(msg['phase'], time.perf_counter())
+            elif msg.get('result') == 'ok':
+                break
+            else:
+                raise Exception(f"Session failed: {msg}")
+        ok = time.perf_counter()
+    closed = time.perf_counter()
+    await wait_until(lambda: redis_client.brpop_waiters > 0)
+    ready = time.perf_counter()
+
+    return {
+        'queue_pickup': picked - start,
+        'ack': acked - picked,
+        'ws_connect': opened - acked,
+        'install': timings.get('install', 0.0),
+        'save_download': timings.get('save_download', 0.0),
+        'save_import': phases['launch'] - phases['save_import'],
+        'launch': phases['stream'] - phases['launch'],
+        'stream_start': ok - phases['stream'],
+        'total': ok - start,
+        'teardown': ready - closed
+    }
+
+async def run_scenario(root: Path, size: int, save_count: int, save_file_size: int, warm_runs: int, locality_timeout: float,
+                       trace_path: str = '') -> list[dict]:
+    game, user = f'bench_{size}', 'bench_user'
+    scenario = root / f'{game}_{save_count}'
+    store, work, save_root = root / 'store', scenario / 'work', root / 'save_root'
+    if not (store / 'games' / f'{game}.zip').is_file():
+        make_game(store, game, size, save_root)
+    shutil.rmtree(save_root, ignore_errors=True)
+    shutil.rmtree(store / 'saves', ignore_errors=True)
+    seed_save(store, scenario, game, user, save_count, save_file_size)
+
+    port = free_port()
+    config = app.Config(
+        games_repo_path=str(store / 'games'), working_folder_path=str(work),
+        ws_ip='127.0.0.1', ws_port=port, reported_ws_endpoint=f'ws://127.0.0.1:{port}',
+        reported_video_signalling_endpoint='ws://127.0.0.1:8443', reported_audio_signalling_endpoint='ws://127.0.0.1:8444',
+        redis_ip='', redis_port=0, minio_endpoint='', minio_access_key='', minio_secret_key='',
+        agent_id='bench', video_spec=VideoSpec(adaptive=False), trace_path=trace_path
+    )
+    object_store = LocalObjectStore(store)
+    game_dl = file_dl.MinioGameFileManager(config.working_folder_path, object_store, 'games', install_workers=config.install_workers)
+    save_dl = file_dl.MinioSaveFileManager(object_store, 'saves', work / '.saves', config.save_transfer_workers, config.save_compression)
+    timings = {}
+    timed(game_dl, 'install_from_repo', timings, 'install')
+    timed(save_dl, 'download_save', timings, 'save_download')
+
+    redis_client = FakeRedis()
+    agent = asyncio.create_task(app.run_agent(config, redis_client, game_dl, save_dl))
+    results = []
+    try:
+        for run in range(warm_runs + 1):
+            result = await run_session(redis_client, timings, f'bench-{size}-{save_count}-{run}', user, game, locality_timeout)
+            result.update({'cache': 'cold' if run == 0 else 'warm', 'game_size': size, 'save_files': save_count})
+            results.append(result)
+    finally:
+        # Stops the agent along with the background tasks it started
+        tasks = asyncio.all_tasks() - {asyncio.current_task()}
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+    shutil.rmtree(scenario, ignore_errors=True)
+    return results
+
+def format_size(size: int) -> str:
+    for unit, scale in (('G', 1024 ** 3), ('M', 1024 ** 2), ('K', 1024)):
+        if size >= scale:
+            return f'{size / scale:g}{unit}'
+    return str(size)
+
+def print_table(results: list[dict], out):
+    header = ['size', 'saves', 'cache'] + list(PHASES)
+    rows = [[format_size(r['game_size']), str(r['save_files']), r['cache']] + [f"{r[p] * 1000:.0f}" for p in PHASES] for r in results]
+    widths = [max(len(h), *(len(row[i]) for row in rows)) for i, h in enumerate(header)]
+    print("Phase timings in ms", file=out)
+    print('  '.join(h.rjust(w) for h, w in zip(header, widths)), file=out)
+    for row in rows:
+        print('  '.join(c.rjust(w) for c, w in zip(row, widths)), file=out)
+
+async def main(args):
+    install_hooks()
+    root = Path(args.dir or tempfile.mkdtemp(prefix='cloud_gaming_bench_'))
+    root.mkdir(parents=True, exist_ok=True)
+    out = sys.stdout
+    results = []
+    try:
+        for size in [parse_size(s) for s in args.sizes.split(',')]:
+            for save_count in [int(s) for s in args.saves.split(',')]:
+                print(f"Running {format_size(size)} game with {save_count} save files...", file=out)
+                with contextlib.ExitStack() as stack:
+                    if not args.verbose:
+                        stack.enter_context(contextlib.redirect_stdout(open(os.devnull, 'w')))
+                    results += await run_scenario(root, size, save_count, parse_size(args.save_file_size),
+                                                  args.warm_runs, args.locality_timeout, args.trace or '')
+    finally:
+        if not args.keep:
+            shutil.rmtree(root, ignore_errors=True)
+
+    print_table(results, out)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark session startup against local stand-ins for Redis, MinIO and the game.")
+    parser.add_argument('--sizes', default='10M,100M', help="Comma-separated game sizes, e.g. 10M,100M,1G")
+    parser.add_argument('--saves', default='0,1000', help="Comma-separated numbers of save files")
+    parser.add_argument('--save-file-size', default='4K', help="Size of each save file")
+    parser.add_argument('--warm-runs', type=int, default=2, help="Sessions to run after the cold one with caches kept")
+    parser.add_argument('--locality-timeout', type=float, default=3.0,
+                        help="How long the backend waits for an agent with the game before offering it to any agent")
+    parser.add_argument('--dir', help="Working directory (default: a fresh temporary directory)")
+    parser.add_argument('--keep', action='store_true', help="Keep generated games and caches")
+    parser.add_argument('--json', help="Also write raw results to this file")
+    parser.add_argument('--trace', help="Append the agent's session spans to this JSON lines file")
+    parser.add_argument('--verbose', action='store_true', help="Show agent logs")
+    asyncio.run(main(parser.parse_args()))
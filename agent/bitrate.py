@@ -0,0 +1,118 @@
+import json
+import asyncio
+from collections import deque
+from subprocess import Popen
+from typing import Callable
+from pipeline import VideoSpec
+
+RESOLUTION_LADDER = (1.0, 0.75, 0.5)
+
+class BitrateController:
+    # AIMD on receiver reports: back off multiplicatively on loss or queueing
+    # delay (RTT well above the recent minimum), probe up additively while the
+    # link is clean. Resolution steps down the ladder when a backoff leaves the
+    # bitrate unable to feed the current size and back up, with hysteresis,
+    # when it can; a clean link never resizes. The default rate fits the
+    # default 4 Mbps at 1080p.
+    def __init__(self, spec: VideoSpec, kbps_per_megapixel: float = 1800, loss_threshold: float = 0.05,
+                 rtt_window: int = 30, hold_reports: int = 3):
+        self.spec = spec
+        self.kbps_per_megapixel = kbps_per_megapixel
+        self.loss_threshold = loss_threshold
+        self.rtts = deque(maxlen=rtt_window)
+        self.hold_reports = hold_reports
+        self.hold = 0
+        self.bitrate = spec.bitrate_kbps
+        self.native = (spec.width, spec.height) if spec.width and spec.height else None
+        self.rung = 0
+        self.reset()
+
+    def reset(self):
+        # A new pipeline starts from its spec: the bitrate is sent again, the
+        # size only if the ladder has moved off it
+        self.applied = {'width': self.spec.width, 'height': self.spec.height}
+
+    def resolution(self, rung: int) -> tuple[int, int]:
+        width, height = self.native
+        scale = RESOLUTION_LADDER[rung]
+        return int(width * scale) & ~1, int(height * scale) & ~1
+
+    def required_kbps(self, rung: int) -> float:
+        width, height = self.resolution(rung)
+        return width * height / 1_000_000 * self.kbps_per_megapixel
+
+    def target(self) -> dict:
+        target = {'bitrate_kbps': self.bitrate}
+        if self.native:
+            if self.rung == 0 and not self.spec.width:
+                target['width'] = target['height'] = 0
+            else:
+                target['width'], target['height'] = self.resolution(self.rung)
+        return target
+
+    def update(self, stats: dict) -> dict:
+        if self.native is None and stats.get('width') and stats.get('height'):
+            self.native = (stats['width'], stats['height'])
+
+        receivers = stats.get('receivers')
+        if not receivers:
+            return {}
+        rtt = max(r['rtt'] for r in receivers)
+        loss = max(r['loss'] for r in receivers)
+        self.rtts.append(rtt)
+        queueing = rtt > min(self.rtts) * 1.5 + 0.02
+
+        spec = self.spec
+        backed_off = loss > self.loss_threshold or queueing
+        if backed_off:
+            self.bitrate = max(spec.min_bitrate_kbps, int(self.bitrate * 0.8))
+            self.hold = self.hold_reports
+        elif self.hold:
+            self.hold -= 1
+        elif loss < self.loss_threshold / 2:
+            self.bitrate = min(spec.max_bitrate_kbps, self.bitrate + max(100, int(self.bitrate * 0.05)))
+
+        if self.native:
+            while backed_off and self.rung < len(RESOLUTION_LADDER) - 1 and self.bitrate < self.required_kbps(self.rung):
+                self.rung += 1
+            while self.rung > 0 and self.bitrate >= self.required_kbps(self.rung - 1) * 1.25:
+                self.rung -= 1
+
+        target = self.target()
+        changes = {key: value for key, value in target.items() if self.applied.get(key) != value}
+        if 'width' in changes or 'height' in changes:
+            changes['width'], changes['height'] = target['width'], target['height']
+        self.applied = target
+        return changes
+
+
+async def control_video_stream(get_process: Callable[[], Popen | None], controller: BitrateController):
+    # Follows the session's stream host across supervisor restarts
+    proc = None
+    while True:
+        current = get_process()
+        if current is None or current.stdout is None:
+            await asyncio.sleep(1)
+            continue
+        if current is not proc:
+            proc = current
+            controller.reset()
+
+        line = await asyncio.to_thread(proc.stdout.readline)
+        if not line:
+            await asyncio.sleep(0.5)
+            continue
+        try:
+            stats = json.loads(line)
+        except json.JSONDecodeError:
+            continue
+
+        command = controller.update(stats)
+        if not command:
+            continue
+        print(f"Adjusting video stream: {command}")
+        try:
+            proc.stdin.write(json.dumps(command) + '\n')
+            proc.stdin.flush()
+        except OSError as e:
+            print(f"Failed to send command to stream host: {e}")
@@ -0,0 +1,71 @@
+import time
+import asyncio
+from file_dl import SaveFileManager
+from game_manager import GameManager, GameMetadata, SaveFile
+from save_queue import SaveUploadQueue
+from tracing import NULL_SPAN, Span, NullSpan
+
+class SaveCheckpointer:
+    # Stages the running game's save whenever it has changed and then held
+    # still for a poll, at most once per interval, and hands it to the upload
+    # queue. Waiting for the files to settle keeps half-written saves out of a
+    # checkpoint, and teardown only has to stage what changed since the last one.
+    def __init__(self, save_dl: SaveFileManager, upload_queue: SaveUploadQueue, game: str, user: str, metadata: GameMetadata,
+                 interval: float, poll_interval: float = 5.0, trace: Span | NullSpan = NULL_SPAN):
+        self.save_dl = save_dl
+        self.upload_queue = upload_queue
+        self.game = game
+        self.user = user
+        self.metadata = metadata
+        self.interval = interval
+        self.poll_interval = poll_interval
+        self.trace = trace
+        self.checkpoints = 0
+        self.task = None
+
+    def start(self):
+        self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+    def snapshot(self) -> tuple[dict[str, SaveFile], dict[str, tuple[int, int]]]:
+        files = GameManager.export_save(self.metadata)
+        return files, {rel_path: (f.size, f.mtime_ns) for rel_path, f in files.items()}
+
+    async def checkpoint(self, files: dict[str, SaveFile]):
+        with self.trace.child('save_checkpoint') as span:
+            staged = await asyncio.to_thread(self.save_dl.stage_save, self.game, self.user, files)
+            span.set(files=len(files), staged=staged)
+        if staged:
+            self.upload_queue.submit(self.game, self.user, self.trace)
+        self.checkpoints += 1
+
+    async def run(self):
+        # What was just imported is already in storage
+        _, staged = await asyncio.to_thread(self.snapshot)
+        previous = staged
+        last_checkpoint = time.monotonic()
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            try:
+                files, current = await asyncio.to_thread(self.snapshot)
+            except Exception as e:
+                print(f"Failed to scan save files for {self.game}/{self.user}: {e}")
+                continue
+            settled = current == previous
+            previous = current
+            if current == staged or not settled or time.monotonic() - last_checkpoint < self.interval:
+                continue
+            last_checkpoint = time.monotonic()
+            try:
+                await self.checkpoint(files)
+                staged = current
+            except Exception as e:
+                print(f"Save checkpoint for {self.game}/{self.user} failed: {e}")
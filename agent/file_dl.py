@@ -1,108 +1,792 @@
 from abc import ABC, abstractmethod
 from pathlib import Path
+from typing import Callable
+from concurrent.futures import ThreadPoolExecutor
+import io
+import os
+import json
+import shutil
 import zipfile
+import zlib
+import time
+import hashlib
+import threading
+import urllib3
 from minio import Minio, S3Error
+from minio.datatypes import Part
 import tempfile
+from install_cache import InstallCache, remove_tree, writable_matcher
+from game_manager import SaveFile
+from hot_files import METADATA_FILE, HotFileLog, select_hot_files
+from transfer import PART_SIZE_METADATA, EtagReader, TransferStats, multipart_etag, verify_etag
+from manifest import HASH_CHUNK_SIZE, hash_file, copy_and_hash, read_json, write_json_atomic
+from zip_stream import RangeSource, LocalFileRangeSource, ZipStreamExtractor, TransferThrottle, ThrottledRangeSource, member_path
 
 class MinioClient:
-    def __init__(self, endpoint: str, access_key: str, secret_key: str):
-        self.client = Minio(endpoint, access_key=access_key, secret_key=secret_key, secure=False)
-    
-    def download(self, bucket: str, object_name: str, local_path: str):
+    # Downloads larger than a part are fetched as parallel ranged reads into a
+    # .part file, with the finished parts listed in a sidecar .part.json, so an
+    # interrupted download picks up where it stopped. Larger uploads go up as
+    # multipart uploads whose id and finished parts are kept under state_path.
+    # Every transfer is checked against the object's ETag.
+    def __init__(self, endpoint: str, access_key: str, secret_key: str, max_connections: int = 10, state_path: str | None = None,
+                 part_size: int = 16 * 1024 * 1024, transfer_workers: int = 4):
+        http_client = urllib3.PoolManager(
+            maxsize=max_connections,
+            timeout=urllib3.Timeout(connect=10, read=60),
+            retries=urllib3.Retry(total=3, backoff_factor=0.2, status_forcelist=[500, 502, 503, 504])
+        )
+        self.client = Minio(endpoint, access_key=access_key, secret_key=secret_key, secure=False, http_client=http_client)
+        self.state_path = Path(state_path) if state_path else Path(tempfile.gettempdir()) / 'cloud_gaming_transfers'
+        self.part_size = part_size
+        self.transfer_workers = transfer_workers
+        self.buckets = set()
+        self.stats = TransferStats()
+
+    def check_bucket(self, bucket: str):
+        if bucket in self.buckets:
+            return
         if not self.client.bucket_exists(bucket):
             raise Exception(f"Bucket {bucket} does not exist")
-        self.client.fget_object(bucket, object_name, local_path)
-    
+        self.buckets.add(bucket)
+
+    def get_range(self, bucket: str, object_name: str, offset: int, length: int, etag: str | None = None) -> bytes:
+        # If-Match turns an object replaced mid-download into an error instead of a mix of two versions
+        start = time.perf_counter()
+        response = self.client.get_object(bucket, object_name, offset=offset, length=length,
+                                          request_headers={'If-Match': f'"{etag}"'} if etag else None)
+        try:
+            data = response.read()
+        finally:
+            response.close()
+            response.release_conn()
+        if len(data) != length:
+            self.stats.failed('download')
+            raise Exception(f"Short read from {bucket}/{object_name}: {len(data)} of {length} bytes at {offset}")
+        self.stats.record('download', length, time.perf_counter() - start)
+        return data
+
+    def download(self, bucket: str, object_name: str, local_path: str):
+        self.check_bucket(bucket)
+        stat = self.client.stat_object(bucket, object_name)
+        part_size = int(stat.metadata.get(PART_SIZE_METADATA) or 0) or None
+        part_path = Path(local_path + '.part')
+        if stat.size <= self.part_size:
+            part_path.write_bytes(self.get_range(bucket, object_name, 0, stat.size, stat.etag) if stat.size else b'')
+            self.finish_download(stat.etag, part_size, part_path, local_path)
+            return
+
+        sidecar_path = Path(local_path + '.part.json')
+        state = read_json(sidecar_path)
+        resumed = bool(state and state.get('etag') == stat.etag and state.get('size') == stat.size and part_path.is_file())
+        if not resumed:
+            state = {'etag': stat.etag, 'size': stat.size, 'part_size': self.part_size, 'done': []}
+            with open(part_path, 'wb') as f:
+                f.truncate(stat.size)
+            write_json_atomic(sidecar_path, state)
+
+        chunk_size = state['part_size']
+        done = set(state['done'])
+        todo = [i for i in range((stat.size + chunk_size - 1) // chunk_size) if i not in done]
+        lock = threading.Lock()
+        if resumed:
+            print(f"Resuming download of {bucket}/{object_name}: {len(done)} parts already fetched, {len(todo)} to go")
+
+        def fetch(index: int):
+            offset = index * chunk_size
+            data = self.get_range(bucket, object_name, offset, min(chunk_size, stat.size - offset), stat.etag)
+            with open(part_path, 'r+b') as f:
+                f.seek(offset)
+                f.write(data)
+            with lock:
+                done.add(index)
+                state['done'] = sorted(done)
+                write_json_atomic(sidecar_path, state)
+
+        with ThreadPoolExecutor(self.transfer_workers) as pool:
+            list(pool.map(fetch, todo))
+        self.finish_download(stat.etag, part_size, part_path, local_path, resumed)
+
+    def finish_download(self, etag: str, part_size: int | None, part_path: Path, local_path: str, resumed: bool = False):
+        sidecar_path = Path(local_path + '.part.json')
+        try:
+            verified = verify_etag(part_path, etag, part_size)
+        except Exception:
+            # A corrupt file is no use for resuming either
+            part_path.unlink(missing_ok=True)
+            sidecar_path.unlink(missing_ok=True)
+            self.stats.failed('download')
+            raise
+        self.stats.completed('download', resumed, verified)
+        os.replace(part_path, local_path)
+        sidecar_path.unlink(missing_ok=True)
+
     def upload(self, bucket: str, object_name: str, local_path: str):
-        if not self.client.bucket_exists(bucket):
-            raise Exception(f"Bucket {bucket} does not exist")
-        self.client.fput_object(bucket, object_name, local_path)
+        self.check_bucket(bucket)
+        st = os.stat(local_path)
+        if st.st_size > self.part_size:
+            self.upload_multipart(bucket, object_name, local_path, st)
+            return
+        with open(local_path, 'rb') as f:
+            data = f.read()
+        start = time.perf_counter()
+        result = self.client.put_object(bucket, object_name, io.BytesIO(data), len(data))
+        if result.etag != hashlib.md5(data).hexdigest():
+            self.stats.failed('upload')
+            raise Exception(f"Integrity check failed uploading {bucket}/{object_name}: server ETag {result.etag}")
+        self.stats.record('upload', len(data), time.perf_counter() - start)
+        self.stats.completed('upload')
+
+    def upload_state(self, bucket: str, object_name: str, local_path: str, st: os.stat_result) -> tuple[Path, dict, bool]:
+        key = hashlib.sha1(f'{bucket}/{object_name}:{os.path.abspath(local_path)}'.encode()).hexdigest()
+        state_path = self.state_path / f'{key}.json'
+        state = read_json(state_path)
+        if state and state['size'] == st.st_size and state['mtime_ns'] == st.st_mtime_ns:
+            try:
+                # Only parts the server still holds with the same checksum count as done
+                listed = {}
+                marker = None
+                while True:
+                    result = self.client._list_parts(bucket, object_name, state['upload_id'], part_number_marker=marker)
+                    listed.update({str(part.part_number): part.etag for part in result.parts})
+                    if not result.is_truncated:
+                        break
+                    marker = result.next_part_number_marker
+                state['parts'] = {n: etag for n, etag in state['parts'].items() if listed.get(n) == etag}
+                return state_path, state, True
+            except S3Error as e:
+                print(f"Cannot resume upload of {bucket}/{object_name} ({e.code}); starting over")
+        elif state:
+            # The file changed since, so its parts are useless
+            try:
+                self.client._abort_multipart_upload(bucket, object_name, state['upload_id'])
+            except S3Error:
+                pass
+
+        upload_id = self.client._create_multipart_upload(bucket, object_name, {
+            'Content-Type': 'application/octet-stream',
+            PART_SIZE_METADATA: str(self.part_size)
+        })
+        state = {'upload_id': upload_id, 'size': st.st_size, 'mtime_ns': st.st_mtime_ns, 'part_size': self.part_size, 'parts': {}}
+        write_json_atomic(state_path, state)
+        return state_path, state, False
+
+    def upload_multipart(self, bucket: str, object_name: str, local_path: str, st: os.stat_result):
+        state_path, state, resumed = self.upload_state(bucket, object_name, local_path, st)
+        part_size = state['part_size']
+        count = (st.st_size + part_size - 1) // part_size
+        todo = [n for n in range(1, count + 1) if str(n) not in state['parts']]
+        lock = threading.Lock()
+        if resumed:
+            print(f"Resuming upload of {bucket}/{object_name}: {count - len(todo)} parts already stored, {len(todo)} to go")
+
+        def put(number: int):
+            with open(local_path, 'rb') as f:
+                f.seek((number - 1) * part_size)
+                data = f.read(part_size)
+            start = time.perf_counter()
+            etag = self.client._upload_part(bucket, object_name, data, None, state['upload_id'], number)
+            if etag != hashlib.md5(data).hexdigest():
+                self.stats.failed('upload')
+                raise Exception(f"Integrity check failed for part {number} of {bucket}/{object_name}")
+            self.stats.record('upload', len(data), time.perf_counter() - start)
+            with lock:
+                state['parts'][str(number)] = etag
+                write_json_atomic(state_path, state)
+
+        with ThreadPoolExecutor(self.transfer_workers) as pool:
+            list(pool.map(put, todo))
+
+        parts = [Part(n, state['parts'][str(n)]) for n in range(1, count + 1)]
+        result = self.client._complete_multipart_upload(bucket, object_name, state['upload_id'], parts)
+        state_path.unlink(missing_ok=True)
+        expected = multipart_etag([bytes.fromhex(part.etag) for part in parts])
+        if result.etag.strip('"') != expected:
+            self.stats.failed('upload')
+            raise Exception(f"Integrity check failed uploading {bucket}/{object_name}: server ETag {result.etag}, expected {expected}")
+        self.stats.completed('upload', resumed)
+
+    def get_bytes(self, bucket: str, object_name: str) -> bytes:
+        response = self.client.get_object(bucket, object_name)
+        try:
+            return response.read()
+        finally:
+            response.close()
+            response.release_conn()
+
+    def put_bytes(self, bucket: str, object_name: str, data: bytes):
+        self.client.put_object(bucket, object_name, io.BytesIO(data), len(data))
+
+    def put_stream(self, bucket: str, object_name: str, stream, part_size: int = 8 * 1024 * 1024):
+        # Length unknown up front, so minio sends it as a multipart upload of part_size parts
+        reader = EtagReader(stream, part_size)
+        start = time.perf_counter()
+        result = self.client.put_object(bucket, object_name, reader, -1, part_size=part_size)
+        expected = reader.etag()
+        if result.etag.strip('"') != expected:
+            self.stats.failed('upload')
+            raise Exception(f"Integrity check failed uploading {bucket}/{object_name}: server ETag {result.etag}, expected {expected}")
+        self.stats.record('upload', reader.size, time.perf_counter() - start)
+        self.stats.completed('upload')
+
+    def download_to(self, bucket: str, object_name: str, dst):
+        response = self.client.get_object(bucket, object_name)
+        try:
+            for chunk in response.stream(HASH_CHUNK_SIZE):
+                dst.write(chunk)
+        finally:
+            response.close()
+            response.release_conn()
+
+    def remove(self, bucket: str, object_name: str):
+        self.client.remove_object(bucket, object_name)
+
+    def stat(self, bucket: str, object_name: str):
+        return self.client.stat_object(bucket, object_name)
+
+    def read_range(self, bucket: str, object_name: str, offset: int, length: int, etag: str | None = None) -> bytes:
+        return self.get_range(bucket, object_name, offset, length, etag)
+
+class MinioRangeSource(RangeSource):
+    def __init__(self, minio_client: MinioClient, bucket: str, object_name: str):
+        self.minio_client = minio_client
+        self.bucket = bucket
+        self.object_name = object_name
+        stat = minio_client.stat(bucket, object_name)
+        self.size = stat.size
+        self.version = stat.etag
+
+    def read_range(self, offset: int, length: int) -> bytes:
+        # Pinned to the version stat saw, so a game replaced mid-install fails instead of mixing archives
+        return self.minio_client.read_range(self.bucket, self.object_name, offset, length, self.version)
 
 class GameFileManager(ABC):
-    def __init__(self, working_folder_path: str):
+    def __init__(self, working_folder_path: str, cache_max_bytes: int = 0, install_workers: int = 4):
         super().__init__()
         self.working_folder_path = Path(working_folder_path)
+        self.cache = InstallCache(self.working_folder_path, cache_max_bytes)
+        self.install_workers = install_workers
+        self.hot_log = HotFileLog(self.cache.cache_path / 'hot')
+        self.background = {}
+        self.background_errors = {}
 
     def game_is_downloaded(self, game: str) -> bool:
-        return (self.working_folder_path / game).exists()
+        return self.cache.has_game(game)
+
+    def installed_path(self, game: str) -> Path | None:
+        if self.game_is_downloaded(game):
+            if not self.cache.verify(game):
+                print(f"The install of {game} is damaged; installing it again")
+                self.cache.forget(game)
+                return None
+            self.cache.touch(game)
+            return self.cache.game_path(game)
+        game_path = self.cache.game_path(game)
+        if game_path.is_dir():
+            return self.cache.adopt(game, self.writable_files(game_path))
+        return None
+
+    def writable_files(self, game_path: Path):
+        return writable_matcher((read_json(game_path / METADATA_FILE) or {}).get('writable_files'))
+
+    def install_archive(self, game: str, source: RangeSource, progress: Callable[[int, int], None] | None = None,
+                        throttle: TransferThrottle | None = None, allow_evict: bool = True) -> Path:
+        # Builds the archive's version in its own directory. Files the installed
+        # version already has (same size and CRC) are linked from the object
+        # store; only the rest is fetched. For games with a hot file set this
+        # returns once those are in place and finishes in the background.
+        version = source.version
+        self.background_errors.pop(game, None)
+        if throttle:
+            source = ThrottledRangeSource(source, throttle)
+        extractor = ZipStreamExtractor(source, self.install_workers, progress=progress)
+        entries = {}
+        for info in extractor.infos:
+            rel_path = member_path(info)
+            if rel_path is not None and not info.is_dir():
+                entries[rel_path] = (info.file_size, info.CRC)
+        reusable = self.cache.reusable_files(game, entries)
+        needed = {rel_path for rel_path in entries if rel_path not in reusable}
+        stored = self.cache.stored_files(game, {rel_path: entries[rel_path] for rel_path in needed})
+        extractor.track_progress(lambda info: not info.is_dir() and member_path(info) in needed)
+
+        game_path = self.cache.version_path(game, version) if version else self.cache.working_folder_path / game
+        files = {}
+        dirs = []
+        lock = threading.Lock()
+        writable = writable_matcher(None)
+
+        def on_entry(info: zipfile.ZipInfo, rel_path: str, src):
+            entry = self.cache.write_file(game, game_path / rel_path, src, writable(rel_path))
+            entry['crc'] = info.CRC
+            with lock:
+                files[rel_path] = entry
+
+        def extract(rel_paths: set[str]):
+            if rel_paths:
+                extractor.extract(on_entry, include=lambda info: not info.is_dir() and member_path(info) in rel_paths)
+
+        def finish():
+            self.cache.commit(game, files, sorted(dirs), version, game_path)
+            if reusable:
+                print(f"Updated {game}: {len(needed)} files fetched, {len(reusable)} unchanged")
+
+        def finish_in_background(rest: set[str]):
+            try:
+                extract(rest)
+                finish()
+                print(f"Background install of {game} finished")
+            except Exception as e:
+                # Not committed, so the next install starts over and a restart sweeps the directory
+                print(f"Background install of {game} failed: {e}")
+                self.background_errors[game] = e
+            finally:
+                self.cache.release_pending(game)
+                self.background.pop(game).set()
+
+        def link_reusable(rel_path: str):
+            entry = reusable[rel_path]
+            copied = self.cache.link_file(entry['hash'], game_path / rel_path, writable(rel_path))
+            files[rel_path] = {**self.cache.file_entry(entry['hash'], entry['size'], copied), 'crc': entry.get('crc')}
+
+        try:
+            remove_tree(game_path)
+            game_path.mkdir(parents=True)
+            for info in extractor.infos:
+                rel_path = member_path(info)
+                if rel_path is not None and info.is_dir():
+                    (game_path / rel_path).mkdir(parents=True, exist_ok=True)
+                    dirs.append(rel_path)
+
+            # The metadata goes first: it lists the files the game writes to
+            if METADATA_FILE in reusable:
+                link_reusable(METADATA_FILE)
+            extract(needed & {METADATA_FILE})
+            writable = self.writable_files(game_path)
+
+            # Content already in the store is only linked; writable files take a copy's worth each
+            needed_bytes = sum(size for rel_path, (size, _) in entries.items()
+                               if writable(rel_path) or (rel_path in needed and rel_path not in stored))
+            if allow_evict:
+                self.cache.ensure_space(needed_bytes)
+            elif not self.cache.fits(needed_bytes):
+                raise Exception(f"Not enough free cache space for {game} without evicting other games")
+            for rel_path in reusable.keys() - {METADATA_FILE}:
+                link_reusable(rel_path)
+            # Prefetches (throttled) have nobody waiting to launch, so they install in one go
+            hot = self.hot_files(game, game_path, entries) if throttle is None else None
+            if hot is not None:
+                # Only the hot files are waited for, so progress is measured against them
+                extractor.track_progress(lambda info: not info.is_dir() and member_path(info) in needed & hot - {METADATA_FILE})
+                extract(needed & hot - {METADATA_FILE})
+                rest = needed - hot
+                if rest:
+                    print(f"{game}: {len(needed & hot)} hot files ready, extracting {len(rest)} more in the background")
+                    extractor.progress = None
+                    self.background[game] = threading.Event()
+                    threading.Thread(target=finish_in_background, args=(rest,), name=f'install-{game}', daemon=True).start()
+                    return game_path
+            else:
+                extract(needed - {METADATA_FILE})
+            finish()
+        except Exception:
+            remove_tree(game_path)
+            self.cache.release_pending(game)
+            raise
+        self.cache.release_pending(game)
+        return game_path
+
+    def hot_files(self, game: str, game_path: Path, entries: dict) -> set[str] | None:
+        metadata = read_json(game_path / METADATA_FILE)
+        if not metadata or 'hot_files' not in metadata:
+            return None
+        return select_hot_files(entries, metadata['hot_files'] + [metadata['exe_location']], self.hot_log.learned(game))
+
+    def wait_background(self, game: str):
+        # Called with the game lock held, so nothing else starts installing it meanwhile
+        done = self.background.get(game)
+        if done:
+            print(f"Waiting for the background install of {game} to finish")
+            done.wait()
+
+    def installing_in_background(self, game: str) -> bool:
+        return game in self.background
+
+    def background_result(self, game: str) -> Exception | None:
+        # For a session already running the game: blocks until the rest of
+        # its install is in place and returns what stopped it, if anything
+        done = self.background.get(game)
+        if done:
+            done.wait()
+        return self.background_errors.get(game)
+
+    def current_install(self, game: str, version: str | None) -> Path | None:
+        installed_path = self.installed_path(game)
+        if installed_path and (version is None or self.cache.installed_version(game) == version):
+            return installed_path
+        if installed_path:
+            print(f"{game} has a new version in the repository; updating")
+        return None
 
     @abstractmethod
-    def install_from_repo(self, game: str) -> Path: ...
+    def install_from_repo(self, game: str, progress: Callable[[int, int], None] | None = None,
+                          throttle: TransferThrottle | None = None, allow_evict: bool = True) -> Path: ...
 
 
 class LocalFSGameFileManager(GameFileManager):
-    def __init__(self, working_folder_path: str, games_repo_path: str):
-        super().__init__(working_folder_path)
+    def __init__(self, working_folder_path: str, games_repo_path: str, cache_max_bytes: int = 0, install_workers: int = 4):
+        super().__init__(working_folder_path, cache_max_bytes, install_workers)
         self.games_repo_path = Path(games_repo_path)
 
-    def install_from_repo(self, game: str) -> Path:
-        dest_path = self.working_folder_path / game
+    def install_from_repo(self, game: str, progress: Callable[[int, int], None] | None = None,
+                          throttle: TransferThrottle | None = None, allow_evict: bool = True) -> Path:
+        with self.cache.game_lock(game):
+            self.wait_background(game)
+            zip_file_path = self.games_repo_path / f'{game}.zip'
+            if not zip_file_path.is_file():
+                installed_path = self.installed_path(game)
+                if installed_path:
+                    return installed_path
+                raise Exception(f"Game {game} not in repo")
 
-        if self.game_is_downloaded(game):
-            return dest_path
+            source = LocalFileRangeSource(zip_file_path)
+            return self.current_install(game, source.version) or self.install_archive(game, source, progress, throttle, allow_evict)
 
-        zip_file_path = self.games_repo_path / f'{game}.zip'
-        if not zip_file_path.is_file():
-            raise Exception(f"Game {game} not in repo")
+class MinioGameFileManager(GameFileManager):
+    def __init__(self, working_folder_path: str, minio_client: MinioClient, minio_bucket: str, cache_max_bytes: int = 0, install_workers: int = 4):
+        super().__init__(working_folder_path, cache_max_bytes, install_workers)
+        self.minio_client = minio_client
+        self.minio_bucket = minio_bucket
 
-        
-        with zipfile.ZipFile(zip_file_path) as zip:
-            zip.extractall(dest_path)
+    def install_from_repo(self, game: str, progress: Callable[[int, int], None] | None = None,
+                          throttle: TransferThrottle | None = None, allow_evict: bool = True) -> Path:
+        with self.cache.game_lock(game):
+            self.wait_background(game)
+            try:
+                source = MinioRangeSource(self.minio_client, self.minio_bucket, f'{game}.zip')
+            except Exception as e:
+                # Storage being unreachable should not stop an installed game from starting
+                installed_path = self.installed_path(game)
+                if installed_path:
+                    print(f"Cannot check {game} for updates ({e}); using the installed version")
+                    return installed_path
+                raise e
+            return self.current_install(game, source.version) or self.install_archive(game, source, progress, throttle, allow_evict)
 
-        return dest_path
+# zlib level per save_compression setting; 'none' stores blobs as they are
+SAVE_COMPRESSION_LEVELS = {'none': 0, 'fast': 1, 'best': 9}
 
-class MinioGameFileManager(GameFileManager):
-    def __init__(self, working_folder_path: str, minio_endpoint: str, minio_access_key: str, minio_secret_key: str, minio_bucket: str):
-        super().__init__(working_folder_path)
-        self.minio_client = MinioClient(minio_endpoint, minio_access_key, minio_secret_key)
-        self.minio_bucket = minio_bucket
+class CompressingReader:
+    # File-like view of src compressed on the fly, for streaming uploads
+    def __init__(self, src, level: int):
+        self.src = src
+        self.compressor = zlib.compressobj(level)
+        self.buffer = bytearray()
+        self.eof = False
 
-    def install_from_repo(self, game: str) -> Path:
-        dest_path = self.working_folder_path / game
+    def read(self, size: int = -1) -> bytes:
+        while not self.eof and (size < 0 or len(self.buffer) < size):
+            chunk = self.src.read(HASH_CHUNK_SIZE)
+            if chunk:
+                self.buffer += self.compressor.compress(chunk)
+            else:
+                self.buffer += self.compressor.flush()
+                self.eof = True
+        if size < 0:
+            size = len(self.buffer)
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
 
-        if self.game_is_downloaded(game):
-            return dest_path
+class HashingWriter:
+    def __init__(self, dst):
+        self.dst = dst
+        self.hash = hashlib.sha256()
+
+    def write(self, data: bytes):
+        self.hash.update(data)
+        self.dst.write(data)
 
-        zip_file_path = dest_path.with_suffix('.zip')
-        self.minio_client.download(self.minio_bucket, f'{game}.zip', str(zip_file_path))
+class DecompressingWriter:
+    def __init__(self, dst):
+        self.dst = dst
+        self.decompressor = zlib.decompressobj()
 
-        with zipfile.ZipFile(zip_file_path) as zip:
-            zip.extractall(dest_path)
+    def write(self, data: bytes):
+        self.dst.write(self.decompressor.decompress(data))
 
-        zip_file_path.unlink(missing_ok=True)
+    def finish(self):
+        self.dst.write(self.decompressor.flush())
+        if not self.decompressor.eof:
+            raise Exception("Truncated compressed save blob")
 
-        return dest_path
 
 class SaveFileManager(ABC):
     @abstractmethod
     def download_save(self, game: str, user: str) -> Path: ...
 
     @abstractmethod
-    def upload_save(self, game: str, user: str, local_path: Path): ...
+    def stage_save(self, game: str, user: str, files: dict[str, SaveFile]) -> bool: ...
+
+    @abstractmethod
+    def push_save(self, game: str, user: str): ...
+
+    def upload_save(self, game: str, user: str, files: dict[str, SaveFile]):
+        if self.stage_save(game, user, files):
+            self.push_save(game, user)
 
 
 class MinioSaveFileManager(SaveFileManager):
-    def __init__(self, minio_endpoint: str, minio_access_key: str, minio_secret_key: str, minio_bucket: str):
+    # Saves are stored as content-addressed blobs under saves/<game>/<user>/blobs
+    # with a manifest.json mapping relative paths to hashes. The agent keeps a
+    # mirror of the last synced save per user, so only changed files move in
+    # either direction. stage_save only touches local disk; push_save uploads
+    # whatever is staged and can run later, in the background. Blobs are
+    # compressed as they stream to storage; each manifest entry records its
+    # blob's encoding, so changing the setting never breaks older saves.
+    # Mirrors beyond max_mirror_bytes are dropped least recently used first,
+    # except those with a staged save that has not been pushed yet.
+    def __init__(self, minio_client: MinioClient, minio_bucket: str, local_cache_path: str | None = None, transfer_workers: int = 8,
+                 compression: str = 'fast', max_mirror_bytes: int = 0):
         super().__init__()
-        self.minio_client = MinioClient(minio_endpoint, minio_access_key, minio_secret_key)
+        if compression not in SAVE_COMPRESSION_LEVELS:
+            raise Exception(f"Unknown save compression {compression}")
+        self.minio_client = minio_client
         self.minio_bucket = minio_bucket
+        self.local_cache_path = Path(local_cache_path) if local_cache_path else Path(tempfile.gettempdir()) / 'cloud_gaming_saves'
+        self.transfer_workers = transfer_workers
+        self.compression_level = SAVE_COMPRESSION_LEVELS[compression]
+        self.max_mirror_bytes = max_mirror_bytes
+        self.locks = {}
+        self.locks_lock = threading.Lock()
 
-    def download_save(self, game: str, user: str) -> Path | None:
-        temp_dir = Path(tempfile.gettempdir())
-        local_path = temp_dir / f'{game}_{user}_save.zip'
+    def save_lock(self, game: str, user: str) -> threading.Lock:
+        with self.locks_lock:
+            return self.locks.setdefault((game, user), threading.Lock())
+
+    def remote_prefix(self, game: str, user: str) -> str:
+        return f'saves/{game}/{user}'
+
+    def local_save_path(self, game: str, user: str) -> Path:
+        return self.local_cache_path / game / user
+
+    def local_manifest_path(self, game: str, user: str) -> Path:
+        return self.local_cache_path / game / f'{user}.manifest.json'
+
+    def read_local_manifest(self, game: str, user: str) -> dict:
+        return read_json(self.local_manifest_path(game, user)) or {'files': {}}
+
+    def pending_saves(self) -> list[tuple[str, str]]:
+        pending = []
+        for manifest_path in self.local_cache_path.glob('*/*.manifest.json'):
+            if (read_json(manifest_path) or {}).get('pending'):
+                pending.append((manifest_path.parent.name, manifest_path.name[:-len('.manifest.json')]))
+        return pending
+
+    def trim_mirrors(self):
+        # Called with one save's lock held, which keeps that mirror
+        if not self.max_mirror_bytes:
+            return
+        # A mirror's manifest is rewritten on every sync, so its mtime is the last use
+        mirrors = []
+        for manifest_path in self.local_cache_path.glob('*/*.manifest.json'):
+            try:
+                mtime = manifest_path.stat().st_mtime
+            except FileNotFoundError:
+                continue
+            manifest = read_json(manifest_path) or {}
+            size = sum(entry['size'] for entry in manifest.get('files', {}).values())
+            mirrors.append((mtime, manifest_path.parent.name, manifest_path.name[:-len('.manifest.json')], size, manifest.get('pending')))
+        total = sum(mirror[3] for mirror in mirrors)
+        for _, game, user, size, pending in sorted(mirrors):
+            if total <= self.max_mirror_bytes:
+                return
+            lock = self.save_lock(game, user)
+            if pending or not lock.acquire(blocking=False):
+                continue
+            try:
+                # Pending state may have changed since the scan
+                if self.read_local_manifest(game, user).get('pending'):
+                    continue
+                print(f"Dropping the local save mirror of {game}/{user} ({size / 1024 ** 2:.1f} MB)")
+                self.local_manifest_path(game, user).unlink(missing_ok=True)
+                shutil.rmtree(self.local_save_path(game, user), ignore_errors=True)
+                total -= size
+            finally:
+                lock.release()
+
+    def remote_manifest(self, game: str, user: str) -> dict | None:
+        try:
+            data = self.minio_client.get_bytes(self.minio_bucket, f'{self.remote_prefix(game, user)}/manifest.json')
+        except S3Error as e:
+            if e.code == "NoSuchKey":
+                return None
+            raise e
+        return json.loads(data)
 
+    def download_legacy_save(self, game: str, user: str) -> Path | None:
+        # Old single-zip saves are extracted straight from storage into the mirror
         try:
-            self.minio_client.download(self.minio_bucket, f'saves/{game}/{user}.zip', str(local_path))
+            source = MinioRangeSource(self.minio_client, self.minio_bucket, f'saves/{game}/{user}.zip')
         except S3Error as e:
             if e.code == "NoSuchKey":
                 return None
             raise e
 
-        extract_path = temp_dir / f'{game}_{user}_save'
-        with zipfile.ZipFile(local_path) as zip:
-            zip.extractall(extract_path)
-        local_path.unlink(missing_ok=True)
-        return extract_path
+        save_path = self.local_save_path(game, user)
+        shutil.rmtree(save_path, ignore_errors=True)
+        save_path.mkdir(parents=True)
+        files = {}
+        lock = threading.Lock()
+
+        def on_entry(info: zipfile.ZipInfo, rel_path: str, src):
+            dest_path = save_path / rel_path
+            if src is None:
+                dest_path.mkdir(parents=True, exist_ok=True)
+                return
+            dest_path.parent.mkdir(parents=True, exist_ok=True)
+            with open(dest_path, 'wb') as dst:
+                digest, size = copy_and_hash(src, dst)
+            with lock:
+                files[rel_path] = {'hash': digest, 'size': size, 'mtime_ns': dest_path.stat().st_mtime_ns}
+
+        ZipStreamExtractor(source, self.transfer_workers).extract(on_entry)
+        write_json_atomic(self.local_manifest_path(game, user), {'files': files})
+        return save_path
+
+    def fetch_blob(self, object_name: str, digest: str, encoding: str, dest_path: Path):
+        # Blobs are named by the sha256 of their content, which is checked after decompressing
+        part_path = dest_path.with_name(dest_path.name + '.part')
+        try:
+            if encoding == 'zlib':
+                with open(part_path, 'wb') as f:
+                    hashing = HashingWriter(f)
+                    writer = DecompressingWriter(hashing)
+                    self.minio_client.download_to(self.minio_bucket, object_name, writer)
+                    writer.finish()
+                actual = hashing.hash.hexdigest()
+            else:
+                self.minio_client.download(self.minio_bucket, object_name, str(part_path))
+                actual = hash_file(part_path)
+            if actual != digest:
+                raise Exception(f"Integrity check failed for save blob {object_name}: content hash {actual}")
+            os.replace(part_path, dest_path)
+        finally:
+            part_path.unlink(missing_ok=True)
+
+    def push_blob(self, object_name: str, path: Path) -> str:
+        if not self.compression_level:
+            self.minio_client.upload(self.minio_bucket, object_name, str(path))
+            return 'identity'
+        with open(path, 'rb') as f:
+            self.minio_client.put_stream(self.minio_bucket, object_name, CompressingReader(f, self.compression_level))
+        return 'zlib'
+
+    def download_save(self, game: str, user: str) -> Path | None:
+        if self.read_local_manifest(game, user).get('pending'):
+            # Never overwrite a staged save that has not reached storage yet
+            self.push_save(game, user)
+
+        with self.save_lock(game, user):
+            remote = self.remote_manifest(game, user)
+            if remote is None:
+                save_path = self.download_legacy_save(game, user)
+                self.trim_mirrors()
+                return save_path
+
+            save_path = self.local_save_path(game, user)
+            save_path.mkdir(parents=True, exist_ok=True)
+            local_files = self.read_local_manifest(game, user)['files']
+            prefix = self.remote_prefix(game, user)
+
+            files = {}
+            missing = []
+            for rel_path, entry in remote['files'].items():
+                local_entry = local_files.get(rel_path)
+                if local_entry and local_entry['hash'] == entry['hash'] and (save_path / rel_path).is_file():
+                    files[rel_path] = local_entry
+                else:
+                    missing.append((rel_path, entry))
+
+            def fetch(item):
+                rel_path, entry = item
+                dest_path = save_path / rel_path
+                dest_path.parent.mkdir(parents=True, exist_ok=True)
+                self.fetch_blob(f'{prefix}/blobs/{entry["hash"]}', entry['hash'], entry.get('encoding', 'identity'), dest_path)
+                return rel_path, {'hash': entry['hash'], 'size': entry['size'], 'mtime_ns': dest_path.stat().st_mtime_ns}
+
+            with ThreadPoolExecutor(self.transfer_workers) as pool:
+                for rel_path, entry in pool.map(fetch, missing):
+                    files[rel_path] = entry
+
+            for rel_path in local_files.keys() - remote['files'].keys():
+                (save_path / rel_path).unlink(missing_ok=True)
+
+            write_json_atomic(self.local_manifest_path(game, user), {'files': files})
+            print(f"Save sync for {game}/{user}: downloaded {len(missing)} of {len(remote['files'])} files")
+            self.trim_mirrors()
+            return save_path
+
+    def stage_save(self, game: str, user: str, files: dict[str, SaveFile]) -> bool:
+        # Sizes and mtimes come from the scan that produced files
+        with self.save_lock(game, user):
+            local = self.read_local_manifest(game, user)
+            local_files = local['files']
+            save_path = self.local_save_path(game, user)
+
+            new_files = {}
+            changed = 0
+            for rel_path, f in files.items():
+                local_entry = local_files.get(rel_path)
+                mirror_path = save_path / rel_path
+                if local_entry and local_entry['size'] == f.size and local_entry.get('mtime_ns') == f.mtime_ns and mirror_path.is_file():
+                    new_files[rel_path] = local_entry
+                    continue
+                digest = hash_file(f.path)
+                new_files[rel_path] = {'hash': digest, 'size': f.size, 'mtime_ns': f.mtime_ns}
+                if not local_entry or local_entry['hash'] != digest or not mirror_path.is_file():
+                    mirror_path.parent.mkdir(parents=True, exist_ok=True)
+                    shutil.copy2(f.path, mirror_path)
+                    changed += 1
+
+            removed = local_files.keys() - new_files.keys()
+            for rel_path in removed:
+                (save_path / rel_path).unlink(missing_ok=True)
+
+            pending = bool(local.get('pending') or changed or removed)
+            write_json_atomic(self.local_manifest_path(game, user), {'files': new_files, 'pending': pending})
+            print(f"Save staged for {game}/{user}: {changed} changed, {len(removed)} removed of {len(new_files)} files")
+            return pending
+
+    def push_save(self, game: str, user: str):
+        with self.save_lock(game, user):
+            local = self.read_local_manifest(game, user)
+            if not local.get('pending'):
+                return
+
+            remote = self.remote_manifest(game, user)
+            remote_files = remote['files'] if remote else {}
+            encodings = {entry['hash']: entry.get('encoding', 'identity') for entry in remote_files.values()}
+            remote_hashes = set(encodings)
+            prefix = self.remote_prefix(game, user)
+            save_path = self.local_save_path(game, user)
+
+            uploads = {entry['hash']: save_path / rel_path for rel_path, entry in local['files'].items() if entry['hash'] not in remote_hashes}
+
+            def push(item):
+                digest, path = item
+                return digest, self.push_blob(f'{prefix}/blobs/{digest}', path)
+
+            with ThreadPoolExecutor(self.transfer_workers) as pool:
+                encodings.update(pool.map(push, uploads.items()))
+
+            manifest_files = {rel_path: {'hash': e['hash'], 'size': e['size'], 'encoding': encodings[e['hash']]}
+                              for rel_path, e in local['files'].items()}
+            if manifest_files != remote_files:
+                self.minio_client.put_bytes(self.minio_bucket, f'{prefix}/manifest.json', json.dumps({'files': manifest_files}).encode())
+                for digest in remote_hashes - {e['hash'] for e in manifest_files.values()}:
+                    self.minio_client.remove(self.minio_bucket, f'{prefix}/blobs/{digest}')
 
-    def upload_save(self, game: str, user: str, local_path: Path):
-        self.minio_client.upload(self.minio_bucket, f'saves/{game}/{user}.zip', str(local_path))
\ No newline at end of file
+            local['pending'] = False
+            write_json_atomic(self.local_manifest_path(game, user), local)
+            print(f"Save sync for {game}/{user}: uploaded {len(uploads)} of {len(manifest_files)} files")
+            self.trim_mirrors()
@@ -2,16 +2,146 @@ import os
 import re
 import json
 import shutil
-import zipfile
-import tempfile
+import posixpath
 from pathlib import Path
+from dataclasses import dataclass
 from subprocess import Popen
 
+GLOB_CHARS = re.compile(r'[*?[]')
+
+@dataclass
+class SaveFile:
+    path: Path
+    size: int
+    mtime_ns: int
+
+    @classmethod
+    def from_path(cls, path: Path) -> 'SaveFile':
+        st = path.stat()
+        return cls(path, st.st_size, st.st_mtime_ns)
+
+
+def glob_component_regex(component: str) -> str:
+    # One path component of a Path.glob pattern; wildcards never cross a separator
+    out = []
+    i = 0
+    while i < len(component):
+        c = component[i]
+        if c == '*':
+            out.append('[^/]*')
+        elif c == '?':
+            out.append('[^/]')
+        elif c == '[' and (end := component.find(']', i + 2)) != -1:
+            body = component[i + 1:end]
+            if body.startswith('!'):
+                body = '^' + body[1:]
+            out.append('[' + body.replace('\\', '\\\\').replace('[', '\\[') + ']')
+            i = end
+        else:
+            out.append(re.escape(c))
+        i += 1
+    return ''.join(out)
+
+
+class SavePatterns:
+    # All of a game's save patterns compiled into one regex over paths relative
+    # to the save root, plus the directories a walk has to cover: each
+    # pattern's root and literal leading directories, and how deep below them
+    # it can match (None for patterns with **). scan walks those once and
+    # returns every matching file with its size and mtime.
+    def __init__(self, save_patterns: list):
+        regexes = []
+        bases = {}
+        for pat in save_patterns:
+            root = posixpath.normpath(Path(pat['pattern_root']).as_posix())
+            parts = [part for part in root.split('/') if part not in ('', '.')]
+            rest = [part for part in pat['pattern'].replace(os.sep, '/').split('/') if part not in ('', '.')]
+            if not rest:
+                continue
+            while len(rest) > 1 and not GLOB_CHARS.search(rest[0]):
+                parts.append(rest.pop(0))
+
+            pieces = [re.escape(part) + '/' for part in parts]
+            for i, component in enumerate(rest):
+                if component == '**':
+                    pieces.append('(?:[^/]+/)*')
+                else:
+                    pieces.append(glob_component_regex(component) + ('/' if i < len(rest) - 1 else ''))
+            regexes.append(''.join(pieces))
+
+            base = '/'.join(parts)
+            depth = None if '**' in rest else len(rest)
+            if base in bases and (bases[base] is None or (depth is not None and bases[base] >= depth)):
+                continue
+            bases[base] = depth
+
+        self.regex = re.compile('|'.join(f'(?:{r})' for r in regexes) or '(?!)', re.IGNORECASE if os.name == 'nt' else 0)
+        self.bases = [(base, depth) for base, depth in sorted(bases.items()) if not self.covered(base, depth, bases)]
+
+    @staticmethod
+    def covered(base: str, depth: int | None, bases: dict) -> bool:
+        # Another base above this one already walks deep enough to see everything below it
+        for other, other_depth in bases.items():
+            if other == base or not (other == '' or base.startswith(other + '/')):
+                continue
+            levels = base.count('/') + 1 - (other.count('/') + 1 if other else 0)
+            if other_depth is None or (depth is not None and other_depth >= levels + depth):
+                return True
+        return False
+
+    def scan(self, root: Path) -> dict[str, SaveFile]:
+        files = {}
+        match = self.regex.fullmatch
+        for base, depth in self.bases:
+            stack = [(str(root / base) if base else str(root), base, depth)]
+            while stack:
+                path, rel, remaining = stack.pop()
+                try:
+                    entries = os.scandir(path)
+                except OSError:
+                    continue
+                with entries:
+                    for entry in entries:
+                        entry_rel = f'{rel}/{entry.name}' if rel else entry.name
+                        try:
+                            # Recursive patterns don't follow directory links, like Path.glob's **
+                            if entry.is_dir(follow_symlinks=remaining is not None):
+                                if remaining is None or remaining > 1:
+                                    stack.append((entry.path, entry_rel, None if remaining is None else remaining - 1))
+                            elif entry.is_file() and match(entry_rel):
+                                st = entry.stat()
+                                files[entry_rel] = SaveFile(Path(entry.path), st.st_size, st.st_mtime_ns)
+                        except OSError:
+                            continue
+        return files
+
+
 class GameMetadata:
-    def __init__(self, exe_location: str, save_root: str, save_patterns: list):
+    def __init__(self, exe_location: str, save_root: str, save_patterns: list, stream: dict | None = None,
+                 hot_files: list | None = None, writable_files: list | None = None, warm_pool_safe: bool = False):
         self.save_root = os.path.expandvars(save_root)
         self.exe_location = exe_location
         self.save_patterns = save_patterns
+        self.stream = stream or {}
+        self.hot_files = hot_files
+        self.writable_files = writable_files
+        # The game reads its save only once a profile is picked, so it can be
+        # launched ahead of a session and have the save put in place later
+        self.warm_pool_safe = warm_pool_safe
+        self.patterns = SavePatterns(save_patterns)
+
+    @classmethod
+    def load(cls, json_path: Path) -> 'GameMetadata':
+        # Parsed once per install; an update lands in a new directory, and the
+        # size and mtime catch a metadata file edited in place
+        st = os.stat(json_path)
+        key = os.path.abspath(json_path)
+        cached = METADATA_CACHE.get(key)
+        if cached and cached[0] == (st.st_size, st.st_mtime_ns):
+            return cached[1]
+        metadata = cls.from_json(json_path)
+        METADATA_CACHE[key] = ((st.st_size, st.st_mtime_ns), metadata)
+        return metadata
 
     @classmethod
     def from_json(cls, json_path: Path):
@@ -20,9 +150,15 @@ class GameMetadata:
         return cls(
             exe_location=data['exe_location'],
             save_root=data['save_root'],
-            save_patterns=data['save_patterns']
+            save_patterns=data['save_patterns'],
+            stream=data.get('stream'),
+            hot_files=data.get('hot_files'),
+            writable_files=data.get('writable_files'),
+            warm_pool_safe=bool(data.get('warm_pool_safe', False))
         )
 
+METADATA_CACHE: dict[str, tuple[tuple[int, int], GameMetadata]] = {}
+
 class GameManager:
     @staticmethod
     def start_game(game_root_folder: Path, metadata: GameMetadata) -> Popen:
@@ -31,37 +167,35 @@ class GameManager:
         return Popen([str(exe_path)], cwd=str(cwd))
 
     @staticmethod
-    def import_save(source_location: Path, metadata: GameMetadata):
+    def matching_files(root: Path, metadata: GameMetadata) -> dict[str, SaveFile]:
+        return metadata.patterns.scan(Path(root))
+
+    @staticmethod
+    def import_save(source_location: Path | None, metadata: GameMetadata) -> int:
+        # Syncs rather than replaces: files the save root already holds with the
+        # same size and mtime (copy2 keeps both) are left alone
         root = Path(metadata.save_root)
-        
-        for pat in metadata.save_patterns:
-            pat_root = root / pat['pattern_root']
-            if not pat_root.exists():
-                pat_root.mkdir(parents=True, exist_ok=True)
-            for f in pat_root.glob(pat['pattern']):
-                if f.is_file():
-                    f.unlink()
-
-        if not source_location:
-            return
-        
         for pat in metadata.save_patterns:
-            src_pat_root = source_location / pat['pattern_root']
-            for f in src_pat_root.glob(pat['pattern']):
-                if f.is_file():
-                    rel_path = f.relative_to(source_location)
-                    dest_path = root / rel_path
-                    shutil.copy2(f, dest_path)
+            (root / pat['pattern_root']).mkdir(parents=True, exist_ok=True)
+
+        current = GameManager.matching_files(root, metadata)
+        wanted = GameManager.matching_files(source_location, metadata) if source_location else {}
+
+        copied = 0
+        for rel_path, src in wanted.items():
+            existing = current.pop(rel_path, None)
+            if existing is not None and existing.size == src.size and existing.mtime_ns == src.mtime_ns:
+                continue
+            dest_path = root / rel_path
+            dest_path.parent.mkdir(parents=True, exist_ok=True)
+            shutil.copy2(src.path, dest_path)
+            copied += 1
+
+        for f in current.values():
+            f.path.unlink()
+        print(f"Save import: {copied} copied, {len(wanted) - copied} unchanged, {len(current)} removed")
+        return copied
 
     @staticmethod
-    def export_save(metadata: GameMetadata) -> Path:
-        root = Path(metadata.save_root)
-        temp_folder = Path(tempfile.mkdtemp())
-        zip_path = temp_folder / 'save_export.zip'
-        with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
-            for pat in metadata.save_patterns:
-                pat_root = root / pat['pattern_root']
-                for f in pat_root.glob(pat['pattern']):
-                    if f.is_file():
-                        zipf.write(f, arcname=str(f.relative_to(root)))
-        return zip_path
+    def export_save(metadata: GameMetadata) -> dict[str, SaveFile]:
+        return GameManager.matching_files(Path(metadata.save_root), metadata)
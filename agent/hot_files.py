@@ -0,0 +1,112 @@
+import os
+import asyncio
+import fnmatch
+import threading
+from pathlib import Path
+from manifest import read_json, write_json_atomic
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+METADATA_FILE = 'cloud_gaming_metadata.json'
+
+# A learned file joins the hot set once at least this share of sessions opened it early
+LEARNED_MIN_SHARE = 0.5
+
+# Games that list hot_files in their metadata are installed in two steps: the
+# metadata, the exe, files matching those patterns and files earlier sessions
+# opened early on are extracted first, so the game can launch while the rest
+# of the archive is still being extracted in the background.
+
+def select_hot_files(entries, patterns: list[str], learned: list[str]) -> set[str]:
+    hot = {METADATA_FILE}
+    for rel_path in entries:
+        if any(fnmatch.fnmatch(rel_path, pattern) for pattern in patterns):
+            hot.add(rel_path)
+    hot.update(rel_path for rel_path in learned if rel_path in entries)
+    return hot
+
+
+class HotFileLog:
+    # Per game, how many sessions opened each file early on
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self.lock = threading.Lock()
+
+    def log_path(self, game: str) -> Path:
+        return self.path / f'{game}.json'
+
+    def learned(self, game: str, min_share: float = LEARNED_MIN_SHARE) -> list[str]:
+        # Files opened once by one session would otherwise stay hot forever
+        log = read_json(self.log_path(game)) or {}
+        sessions = log.get('sessions', 0)
+        if not sessions:
+            return []
+        return [rel_path for rel_path, count in log.get('files', {}).items() if count / sessions >= min_share]
+
+    def record(self, game: str, rel_paths: set[str]):
+        with self.lock:
+            log = read_json(self.log_path(game)) or {'sessions': 0, 'files': {}}
+            log['sessions'] += 1
+            for rel_path in rel_paths:
+                log['files'][rel_path] = log['files'].get(rel_path, 0) + 1
+            write_json_atomic(self.log_path(game), log)
+
+
+def access_sampling_available() -> bool:
+    return psutil is not None
+
+
+class AccessSampler:
+    # Polls which files under the install the game and its children have open
+    # or mapped (DLLs only show up as mappings) during the first window seconds
+    def __init__(self, pid: int, game_root: Path, window: float = 120.0, interval: float = 1.0):
+        self.pid = pid
+        self.game_root = os.path.normcase(os.path.realpath(game_root))
+        self.window = window
+        self.interval = interval
+        self.seen = set()
+        self.task = None
+
+    def start(self):
+        self.task = asyncio.create_task(self.run())
+
+    async def stop(self) -> set[str]:
+        if self.task:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+        return self.seen
+
+    def relative(self, path: str) -> str | None:
+        path = os.path.normcase(os.path.realpath(path))
+        if not path.startswith(self.game_root + os.sep):
+            return None
+        return Path(os.path.relpath(path, self.game_root)).as_posix()
+
+    def sample(self) -> set[str]:
+        try:
+            root = psutil.Process(self.pid)
+            processes = [root] + root.children(recursive=True)
+        except psutil.Error:
+            return set()
+        paths = set()
+        for proc in processes:
+            try:
+                paths.update(f.path for f in proc.open_files())
+                paths.update(m.path for m in proc.memory_maps())
+            except psutil.Error:
+                continue
+        return {rel for rel in map(self.relative, paths) if rel}
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.window
+        while loop.time() < deadline:
+            self.seen.update(await asyncio.to_thread(self.sample))
+            await asyncio.sleep(self.interval)
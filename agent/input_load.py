@@ -0,0 +1,238 @@
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import struct
+import asyncio
+import argparse
+import contextlib
+import tempfile
+from pathlib import Path
+from websockets.asyncio.client import connect
+import app
+import file_dl
+from benchmark import FakeRedis, LocalObjectStore, install_hooks, make_game, free_port, wait_until, create_session
+from input_protocol import PROTOCOL_V1, PROTOCOL_V2, PACKET_TAIL
+from input_recording import Recording, read_recording
+from metrics import Histogram
+from pipeline import VideoSpec
+from remote_input import InputEngine, NullBackend
+
+# Input path load test. Runs the real agent loop with the benchmark's stand-ins,
+# opens one session per simulated client and pushes recorded (.cgir) or
+# synthetic v1 input into each session's WebSocket on the recorded schedule,
+# sped up by --speed (0 sends as fast as the socket takes it). Injection goes
+# to a NullBackend, so what is measured is the agent's own input path.
+# Clients share the agent's event loop, so the results are a lower bound on
+# what the agent sustains on its own.
+#
+#   python agent/input_load.py --clients 20 --rate 250 --duration 30
+#   python agent/input_load.py --recording data/input/<session id>.cgir --speed 4 --clients 8
+
+# W, A, S, D, Space, Shift, Ctrl, E, R, Q
+SYNTHETIC_KEYS = (0x57, 0x41, 0x53, 0x44, 0x20, 0x10, 0x11, 0x45, 0x52, 0x51)
+
+
+class LoadInputEngine(InputEngine):
+    # Every engine the agent creates injects into a NullBackend and is kept for the report
+    engines = []
+
+    def __init__(self, backend=None, capacity: int = 256):
+        super().__init__(NullBackend(), capacity)
+        LoadInputEngine.engines.append(self)
+
+
+def install_input_hooks():
+    install_hooks()
+    app.InputEngine = LoadInputEngine
+    # Shared-desktop sessions would otherwise post window messages
+    app.WindowMessageBackend = lambda hwnd: NullBackend()
+
+
+def synthetic_recording(rate: float, duration: float, seed: int) -> Recording:
+    # A player on a 'rate' Hz client tick: constant mouse motion, keys and buttons toggling now and then
+    rng = random.Random(seed)
+    keys = buttons = 0
+    messages = []
+    for i in range(int(rate * duration)):
+        if rng.random() < 0.05:
+            keys ^= 1 << rng.choice(SYNTHETIC_KEYS)
+        if rng.random() < 0.02:
+            buttons ^= rng.choice((1, 2, 4))
+        wheel = rng.choice((-100, 100)) if rng.random() < 0.01 else 0
+        packet = keys.to_bytes(32, 'little') + PACKET_TAIL.pack(buttons, rng.randint(-20, 20), rng.randint(-20, 20), wheel, 0)
+        messages.append((i / rate, packet))
+    return Recording(PROTOCOL_V1, int(time.time() * 1000), messages)
+
+
+def restamp(msg: bytes, protocol: int, now_ms: int) -> bytes:
+    # Fresh client timestamps so the agent's latency histogram measures this run
+    if protocol == PROTOCOL_V2:
+        return msg[:4] + struct.pack('<Q', now_ms) + msg[12:]
+    return msg[:48] + struct.pack('<Q', now_ms)
+
+
+async def open_session(redis_client: FakeRedis, session_id: str, game: str, protocol: int, locality_timeout: float):
+    ack = await create_session(redis_client, session_id, 'load_user', game, locality_timeout)
+    ws = await connect(ack['ws_endpoint'], max_size=None)
+    await ws.send(json.dumps({'type': 'start', 'id': session_id, 'user': 'load_user', 'game': game, 'protocols': [protocol]}))
+    async for message in ws:
+        msg = json.loads(message)
+        if msg.get('result') == 'ok':
+            return ws
+        if msg.get('type') != 'progress':
+            raise Exception(f"Session {session_id} failed: {msg}")
+    raise Exception(f"Session {session_id} closed during startup")
+
+
+async def send_stream(ws, recording: Recording, speed: float, lag_us: Histogram) -> int:
+    loop = asyncio.get_running_loop()
+    start = loop.time()
+    sent = 0
+    for offset, msg in recording.messages:
+        if speed:
+            delay = start + offset / speed - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            else:
+                lag_us.record(int(-delay * 1_000_000))
+        elif sent % 64 == 0:
+            # Let the agent and the other clients run
+            await asyncio.sleep(0)
+        await ws.send(restamp(msg, recording.protocol, int(time.time() * 1000)))
+        sent += 1
+    return sent
+
+
+async def run_load(root: Path, recordings: list[Recording], clients: int, speed: float, locality_timeout: float) -> dict:
+    store, work = root / 'store', root / 'work'
+    games = [f'load_{i}' for i in range(clients)]
+    # The agent runs one session per game at a time, so every client gets its own
+    for game in games:
+        if not (store / 'games' / f'{game}.zip').is_file():
+            make_game(store, game, 64 * 1024, root / 'save_root' / game, small_files=0)
+
+    port = free_port()
+    config = app.Config(
+        games_repo_path=str(store / 'games'), working_folder_path=str(work),
+        ws_ip='127.0.0.1', ws_port=port, reported_ws_endpoint=f'ws://127.0.0.1:{port}',
+        reported_video_signalling_endpoint='ws://127.0.0.1:8443', reported_audio_signalling_endpoint='ws://127.0.0.1:8444',
+        redis_ip='', redis_port=0, minio_endpoint='', minio_access_key='', minio_secret_key='',
+        agent_id='load', video_spec=VideoSpec(adaptive=False), max_sessions=clients,
+        metrics_redis=True, metrics_interval=60
+    )
+    object_store = LocalObjectStore(store)
+    game_dl = file_dl.MinioGameFileManager(config.working_folder_path, object_store, 'games', install_workers=config.install_workers)
+    save_dl = file_dl.MinioSaveFileManager(object_store, 'saves', work / '.saves', config.save_transfer_workers, config.save_compression)
+
+    LoadInputEngine.engines.clear()
+    redis_client = FakeRedis()
+    agent = asyncio.create_task(app.run_agent(config, redis_client, game_dl, save_dl))
+    try:
+        await wait_until(lambda: redis_client.brpop_waiters > 0)
+        streams = [recordings[i % len(recordings)] for i in range(clients)]
+        sockets = await asyncio.gather(*(open_session(redis_client, f'load-{i}', game, stream.protocol, locality_timeout)
+                                         for i, (game, stream) in enumerate(zip(games, streams))))
+
+        lag_us = Histogram()
+        started = time.perf_counter()
+        sent = await asyncio.gather(*(send_stream(ws, stream, speed, lag_us) for ws, stream in zip(sockets, streams)))
+        sent_at = time.perf_counter()
+        for ws in sockets:
+            await ws.close()
+        # Summaries are published once each session's input engine has drained and stopped
+        await wait_until(lambda: len(redis_client.data.get('session_metrics', [])) >= clients)
+        drained_at = time.perf_counter()
+    finally:
+        tasks = asyncio.all_tasks() - {asyncio.current_task()}
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    latency_us, queue_delay_us, injection_us = Histogram(), Histogram(), Histogram()
+    totals = {'packets': 0, 'dropped': 0, 'bad_size': 0, 'lost': 0}
+    events = 0
+    for engine in LoadInputEngine.engines:
+        metrics = engine.metrics
+        for name in totals:
+            totals[name] += getattr(metrics, name)
+        latency_us.merge(metrics.latency_us)
+        queue_delay_us.merge(metrics.queue_delay_us)
+        injection_us.merge(metrics.injection_us)
+        events += engine.backend.event_count
+
+    duration = drained_at - started
+    return {
+        'clients': clients,
+        'protocols': sorted({stream.protocol for stream in streams}),
+        'speed': speed,
+        'messages_sent': sum(sent),
+        'send_seconds': sent_at - started,
+        'drain_seconds': drained_at - sent_at,
+        'offered_per_second': sum(sent) / (sent_at - started) if sent_at > started else 0,
+        'packets_per_second': totals['packets'] / duration if duration > 0 else 0,
+        'events_injected': events,
+        **totals,
+        'latency_ms': latency_us.summary(scale=1000),
+        'queue_delay_us': queue_delay_us.summary(),
+        'injection_us': injection_us.summary(),
+        'send_lag_ms': lag_us.summary(scale=1000)
+    }
+
+
+def print_report(result: dict, out):
+    print(f"{result['clients']} clients, protocol {'/'.join(map(str, result['protocols']))}, "
+          f"speed {result['speed'] or 'max'}", file=out)
+    print(f"  sent       {result['messages_sent']} messages in {result['send_seconds']:.2f}s "
+          f"({result['offered_per_second']:.0f}/s), drained {result['drain_seconds'] * 1000:.0f}ms later", file=out)
+    print(f"  injected   {result['packets']} packets ({result['packets_per_second']:.0f}/s) as {result['events_injected']} events; "
+          f"{result['dropped']} coalesced, {result['bad_size']} bad, {result['lost']} frames lost", file=out)
+    for name, unit in (('latency_ms', 'ms'), ('queue_delay_us', 'us'), ('injection_us', 'us'), ('send_lag_ms', 'ms')):
+        s = result[name]
+        print(f"  {name.rsplit('_', 1)[0]:<12}p50 {s['p50']:g}{unit}  p95 {s['p95']:g}{unit}  p99 {s['p99']:g}{unit}  "
+              f"max {s['max']:g}{unit}", file=out)
+
+
+async def main(args):
+    install_input_hooks()
+    if args.recording:
+        recordings = [read_recording(path) for path in args.recording]
+    else:
+        recordings = [synthetic_recording(args.rate, args.duration, seed) for seed in range(args.clients)]
+    if not any(recording.messages for recording in recordings):
+        raise Exception("Nothing to send")
+
+    root = Path(args.dir or tempfile.mkdtemp(prefix='cloud_gaming_input_load_'))
+    root.mkdir(parents=True, exist_ok=True)
+    out = sys.stdout
+    try:
+        with contextlib.ExitStack() as stack:
+            if not args.verbose:
+                stack.enter_context(contextlib.redirect_stdout(open(os.devnull, 'w')))
+            result = await run_load(root, recordings, args.clients, args.speed, args.locality_timeout)
+    finally:
+        if not args.keep:
+            shutil.rmtree(root, ignore_errors=True)
+
+    print_report(result, out)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(result, f, indent=2)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load the agent's input path with recorded or synthetic input from simulated clients.")
+    parser.add_argument('--recording', action='append', help="Input recording to replay; repeat to spread several over the clients")
+    parser.add_argument('--clients', type=int, default=1, help="Simultaneous sessions")
+    parser.add_argument('--speed', type=float, default=1.0, help="Replay speed; 0 sends as fast as possible")
+    parser.add_argument('--rate', type=float, default=125, help="Synthetic packets per second per client")
+    parser.add_argument('--duration', type=float, default=10, help="Synthetic stream length in seconds")
+    parser.add_argument('--locality-timeout', type=float, default=0.05,
+                        help="How long the backend waits for an agent with the game before offering it to any agent")
+    parser.add_argument('--dir', help="Working directory (default: a fresh temporary directory)")
+    parser.add_argument('--keep', action='store_true', help="Keep generated games and caches")
+    parser.add_argument('--json', help="Also write the raw result to this file")
+    parser.add_argument('--verbose', action='store_true', help="Show agent logs")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,114 @@
+import struct
+
+# Version 1 is the fixed 56-byte packet: 32-byte key bitmap, buttons, dx, dy,
+# wheel and a millisecond timestamp, sent on every client tick.
+#
+# Version 2 frames carry one or more samples, each holding only what changed:
+#   header  u8 version, u8 sample count, u16 sequence, u64 base timestamp (ms)
+#   sample  u16 offset from base (ms), u8 field mask, then present fields in order:
+#     FULL     no payload; DOWN lists every held key and BUTTONS is present
+#     DOWN     u8 count + key codes pressed
+#     UP       u8 count + key codes released
+#     BUTTONS  u8 button state
+#     DX/DY/WHEEL  i16 each
+# All integers are little endian.
+PROTOCOL_V1 = 1
+PROTOCOL_V2 = 2
+SUPPORTED_PROTOCOLS = (PROTOCOL_V2, PROTOCOL_V1)
+
+FIELD_FULL = 0x01
+FIELD_DOWN = 0x02
+FIELD_UP = 0x04
+FIELD_BUTTONS = 0x08
+FIELD_DX = 0x10
+FIELD_DY = 0x20
+FIELD_WHEEL = 0x40
+
+FRAME_HEADER = struct.Struct('<BBHQ')
+SAMPLE_HEADER = struct.Struct('<HB')
+INT16 = struct.Struct('<h')
+PACKET_TAIL = struct.Struct('<IiiiQ')
+
+def negotiate_protocol(offered: list | None) -> int:
+    if not offered:
+        return PROTOCOL_V1
+    for version in SUPPORTED_PROTOCOLS:
+        if version in offered:
+            return version
+    return PROTOCOL_V1
+
+
+class InputDecoderV2:
+    # Rebuilds absolute input state from v2 frames and emits it as v1 packets,
+    # so everything past the WebSocket stays on the one packet format. A gap
+    # in sequence numbers means lost key deltas, so the decoder flags that a
+    # full-state sample is needed and ignores key deltas until one arrives.
+    def __init__(self):
+        self.keys = 0
+        self.buttons = 0
+        self.expected_seq = None
+        self.lost = 0
+        self.resync_needed = False
+
+    def decode(self, frame: bytes) -> list[bytes]:
+        if len(frame) < FRAME_HEADER.size:
+            raise ValueError(f"Frame too short: {len(frame)} bytes")
+        version, count, seq, base_timestamp = FRAME_HEADER.unpack_from(frame, 0)
+        if version != PROTOCOL_V2:
+            raise ValueError(f"Unexpected protocol version {version}")
+
+        if self.expected_seq is not None and seq != self.expected_seq:
+            self.lost += (seq - self.expected_seq) & 0xFFFF
+            self.resync_needed = True
+        self.expected_seq = (seq + 1) & 0xFFFF
+
+        try:
+            packets, offset = self.decode_samples(frame, count, base_timestamp)
+        except (IndexError, struct.error) as e:
+            raise ValueError(f"Truncated frame: {e}")
+        if offset != len(frame):
+            raise ValueError(f"Frame length mismatch: parsed {offset} of {len(frame)} bytes")
+        return packets
+
+    def decode_samples(self, frame: bytes, count: int, base_timestamp: int) -> tuple[list[bytes], int]:
+        packets = []
+        offset = FRAME_HEADER.size
+        for _ in range(count):
+            time_offset, fields = SAMPLE_HEADER.unpack_from(frame, offset)
+            offset += SAMPLE_HEADER.size
+
+            full = fields & FIELD_FULL
+            keys = 0 if full else self.keys
+            if fields & FIELD_DOWN:
+                n = frame[offset]
+                for vk in frame[offset + 1:offset + 1 + n]:
+                    keys |= 1 << vk
+                offset += 1 + n
+            if fields & FIELD_UP:
+                n = frame[offset]
+                for vk in frame[offset + 1:offset + 1 + n]:
+                    keys &= ~(1 << vk)
+                offset += 1 + n
+            if fields & FIELD_BUTTONS:
+                self.buttons = frame[offset]
+                offset += 1
+
+            dx = dy = wheel = 0
+            if fields & FIELD_DX:
+                dx, = INT16.unpack_from(frame, offset)
+                offset += 2
+            if fields & FIELD_DY:
+                dy, = INT16.unpack_from(frame, offset)
+                offset += 2
+            if fields & FIELD_WHEEL:
+                wheel, = INT16.unpack_from(frame, offset)
+                offset += 2
+
+            if full:
+                self.resync_needed = False
+            if not self.resync_needed or full:
+                self.keys = keys
+
+            packets.append(self.keys.to_bytes(32, 'little') +
+                           PACKET_TAIL.pack(self.buttons, dx, dy, wheel, base_timestamp + time_offset))
+        return packets, offset
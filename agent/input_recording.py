@@ -0,0 +1,76 @@
+import time
+import struct
+from pathlib import Path
+
+# A recording holds a session's binary input messages exactly as the agent
+# received them (v1 packets or v2 frames), with their arrival times:
+#   header  4s magic, u8 format version, u8 input protocol, u64 start (unix ms)
+#   record  u32 microseconds since the previous record, u16 length, message
+# All integers are little endian. Gaps longer than a u32 of microseconds
+# (~71 minutes) are shortened to that.
+MAGIC = b'CGIR'
+FORMAT_VERSION = 1
+
+HEADER = struct.Struct('<4sBBQ')
+RECORD_HEADER = struct.Struct('<IH')
+MAX_GAP_US = 0xFFFFFFFF
+
+class InputRecorder:
+    def __init__(self, path: Path, protocol: int):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.file = open(self.path, 'wb', buffering=64 * 1024)
+        self.file.write(HEADER.pack(MAGIC, FORMAT_VERSION, protocol, int(time.time() * 1000)))
+        self.last_ns = time.perf_counter_ns()
+        self.count = 0
+
+    def record(self, msg: bytes):
+        now = time.perf_counter_ns()
+        gap_us = min((now - self.last_ns) // 1000, MAX_GAP_US)
+        # Keep the clock on the sum of the recorded gaps so rounding doesn't add up
+        self.last_ns += gap_us * 1000
+        self.file.write(RECORD_HEADER.pack(gap_us, len(msg)))
+        self.file.write(msg)
+        self.count += 1
+
+    def close(self):
+        if not self.file.closed:
+            self.file.close()
+
+
+class Recording:
+    def __init__(self, protocol: int, started_ms: int, messages: list[tuple[float, bytes]]):
+        self.protocol = protocol
+        self.started_ms = started_ms
+        # (seconds since the start, message)
+        self.messages = messages
+
+    @property
+    def duration(self) -> float:
+        return self.messages[-1][0] if self.messages else 0.0
+
+
+def read_recording(path: Path) -> Recording:
+    data = Path(path).read_bytes()
+    if len(data) < HEADER.size:
+        raise Exception(f"{path} is not an input recording")
+    magic, version, protocol, started_ms = HEADER.unpack_from(data, 0)
+    if magic != MAGIC:
+        raise Exception(f"{path} is not an input recording")
+    if version != FORMAT_VERSION:
+        raise Exception(f"Unsupported input recording version {version} in {path}")
+
+    messages = []
+    offset = HEADER.size
+    elapsed_us = 0
+    while offset + RECORD_HEADER.size <= len(data):
+        gap_us, length = RECORD_HEADER.unpack_from(data, offset)
+        offset += RECORD_HEADER.size
+        if offset + length > len(data):
+            # The agent stopped mid-write; everything before is still good
+            print(f"{path} is truncated after {len(messages)} messages")
+            break
+        elapsed_us += gap_us
+        messages.append((elapsed_us / 1_000_000, data[offset:offset + length]))
+        offset += length
+    return Recording(protocol, started_ms, messages)
@@ -0,0 +1,413 @@
+import os
+import stat
+import time
+import shutil
+import fnmatch
+import hashlib
+import tempfile
+import threading
+from pathlib import Path
+from typing import Callable
+from manifest import hash_file, copy_and_hash, read_json, write_json_atomic
+
+# Store objects are shared by every install that links them, so they are kept read-only
+READ_ONLY = stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH
+
+
+def make_writable(path: Path):
+    # On Windows the read-only attribute also blocks deleting a file
+    os.chmod(path, stat.S_IREAD | stat.S_IWRITE)
+
+
+def remove_file(path: Path):
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+    except PermissionError:
+        make_writable(path)
+        os.unlink(path)
+
+
+def remove_tree(path: Path):
+    def retry(func, failed_path, exc_info):
+        try:
+            make_writable(failed_path)
+            func(failed_path)
+        except OSError:
+            pass
+    shutil.rmtree(path, onerror=retry)
+
+
+def writable_matcher(patterns: list[str] | None) -> Callable[[str], bool]:
+    # Files a game writes into its install directory get a private copy instead of a link
+    patterns = patterns or []
+    return lambda rel_path: any(fnmatch.fnmatch(rel_path, pattern) for pattern in patterns)
+
+
+class InstallCache:
+    # Installed games live in working_folder/<game>@<version> as hardlinks into
+    # a content-addressed object store, so identical files are stored once and
+    # evicting a game only frees the objects no other manifest references. An
+    # update is built next to the current version and swapped in by rewriting
+    # the manifest; the old directory is retired once no session uses the game.
+    # Objects are read-only; files a game's metadata lists as writable_files
+    # are copied instead, and verify repairs or reports links a game broke.
+    def __init__(self, working_folder_path: Path, max_bytes: int = 0):
+        self.working_folder_path = Path(working_folder_path)
+        self.cache_path = self.working_folder_path / '.cache'
+        self.objects_path = self.cache_path / 'objects'
+        self.manifests_path = self.cache_path / 'manifests'
+        self.staging_path = self.cache_path / 'staging'
+        self.max_bytes = max_bytes
+        self.lock = threading.RLock()
+        self.game_locks = {}
+        self.pinned = {}
+        self.pending_objects = {}
+        self.used_bytes = None
+        self.copied_bytes = None
+        self.current_dirs = {}
+        self.retired = {}
+
+        remove_tree(self.staging_path)
+        self.sweep_stale_versions()
+
+    def game_path(self, game: str) -> Path:
+        # Installs made before versioning sit directly in working_folder/<game>
+        with self.lock:
+            if game not in self.current_dirs:
+                manifest = self.read_manifest(game)
+                self.current_dirs[game] = (manifest or {}).get('dir') or game
+            return self.working_folder_path / self.current_dirs[game]
+
+    def version_path(self, game: str, version: str) -> Path:
+        return self.working_folder_path / f'{game}@{hashlib.sha1(version.encode()).hexdigest()[:12]}'
+
+    def installed_version(self, game: str) -> str | None:
+        return (self.read_manifest(game) or {}).get('version')
+
+    def manifest_path(self, game: str) -> Path:
+        return self.manifests_path / f'{game}.json'
+
+    def object_path(self, digest: str) -> Path:
+        return self.objects_path / digest[:2] / digest
+
+    def read_manifest(self, game: str) -> dict | None:
+        return read_json(self.manifest_path(game))
+
+    def games(self) -> list[str]:
+        if not self.manifests_path.exists():
+            return []
+        return [p.stem for p in self.manifests_path.glob('*.json')]
+
+    def has_game(self, game: str) -> bool:
+        return self.manifest_path(game).is_file() and self.game_path(game).is_dir()
+
+    def game_lock(self, game: str) -> threading.Lock:
+        with self.lock:
+            return self.game_locks.setdefault(game, threading.Lock())
+
+    def pin(self, game: str):
+        with self.lock:
+            self.pinned[game] = self.pinned.get(game, 0) + 1
+
+    def unpin(self, game: str):
+        with self.lock:
+            count = self.pinned.get(game, 0) - 1
+            if count > 0:
+                self.pinned[game] = count
+                return
+            self.pinned.pop(game, None)
+            retired = game in self.retired
+        if retired:
+            threading.Thread(target=self.remove_retired, args=(game,), daemon=True).start()
+
+    def is_pinned(self, game: str) -> bool:
+        with self.lock:
+            return game in self.pinned
+
+    def touch(self, game: str):
+        with self.lock:
+            manifest = self.read_manifest(game)
+            if manifest is None:
+                return
+            manifest['last_used'] = time.time()
+            write_json_atomic(self.manifest_path(game), manifest)
+
+    def usage(self) -> int:
+        # Store objects plus the copies of writable files, which live outside the store
+        with self.lock:
+            if self.used_bytes is None:
+                self.used_bytes = sum(p.stat().st_size for p in self.objects_path.glob('*/*') if p.is_file())
+            if self.copied_bytes is None:
+                self.copied_bytes = sum(entry['size'] for game in self.games()
+                                        for entry in (self.read_manifest(game) or {'files': {}})['files'].values() if entry.get('copy'))
+            return self.used_bytes + self.copied_bytes
+
+    def new_staging_dir(self) -> Path:
+        self.staging_path.mkdir(parents=True, exist_ok=True)
+        return Path(tempfile.mkdtemp(dir=self.staging_path))
+
+    def store_file(self, game: str, src_path: Path, digest: str | None = None) -> tuple[str, int]:
+        digest = digest or hash_file(src_path)
+        size = src_path.stat().st_size
+        object_path = self.object_path(digest)
+        with self.lock:
+            self.pending_objects.setdefault(game, set()).add(digest)
+            if object_path.exists():
+                src_path.unlink()
+            else:
+                self.usage()
+                object_path.parent.mkdir(parents=True, exist_ok=True)
+                os.chmod(src_path, READ_ONLY)
+                os.replace(src_path, object_path)
+                self.used_bytes += size
+        return digest, size
+
+    def link_file(self, digest: str, dest_path: Path, copy: bool = False) -> bool:
+        # True when dest_path ends up a copy
+        dest_path.parent.mkdir(parents=True, exist_ok=True)
+        remove_file(dest_path)
+        if not copy:
+            try:
+                os.link(self.object_path(digest), dest_path)
+                return False
+            except OSError:
+                pass
+        # copyfile leaves the copy writable, so writing it never reaches the store
+        shutil.copyfile(self.object_path(digest), dest_path)
+        return True
+
+    def file_entry(self, digest: str, size: int, copied: bool) -> dict:
+        entry = {'hash': digest, 'size': size}
+        if copied:
+            entry['copy'] = True
+        return entry
+
+    def write_file(self, game: str, dest_path: Path, src, copy: bool = False) -> dict:
+        self.staging_path.mkdir(parents=True, exist_ok=True)
+        fd, staged_path = tempfile.mkstemp(dir=self.staging_path)
+        with os.fdopen(fd, 'wb') as dst:
+            digest, _ = copy_and_hash(src, dst)
+        digest, size = self.store_file(game, Path(staged_path), digest)
+        return self.file_entry(digest, size, self.link_file(digest, dest_path, copy))
+
+    def verify_object(self, digest: str, size: int) -> bool:
+        # An object that lost its read-only bit may have been written through a link
+        object_path = self.object_path(digest)
+        try:
+            st = object_path.stat()
+        except FileNotFoundError:
+            return False
+        if st.st_size == size and not st.st_mode & stat.S_IWUSR:
+            return True
+        if st.st_size == size and hash_file(object_path) == digest:
+            os.chmod(object_path, READ_ONLY)
+            return True
+        print(f"Store object {digest} was modified; dropping it")
+        with self.lock:
+            remove_file(object_path)
+            self.used_bytes = None
+        return False
+
+    def verify(self, game: str) -> bool:
+        # Run before each session: links the game replaced or deleted are
+        # restored; a modified object fails the check, since every install
+        # linking it is damaged, and the game has to be installed again
+        manifest = self.read_manifest(game)
+        if manifest is None:
+            return False
+        game_path = self.game_path(game)
+        for rel_path, entry in manifest['files'].items():
+            if entry.get('copy'):
+                continue
+            if not self.verify_object(entry['hash'], entry['size']):
+                return False
+            dest_path = game_path / rel_path
+            try:
+                if os.path.samestat(dest_path.stat(), self.object_path(entry['hash']).stat()):
+                    continue
+            except FileNotFoundError:
+                pass
+            print(f"{game}: restoring {rel_path}")
+            self.link_file(entry['hash'], dest_path)
+        return True
+
+    def forget(self, game: str):
+        # The files stay until the next install of the game replaces them
+        with self.lock:
+            self.manifest_path(game).unlink(missing_ok=True)
+            self.current_dirs.pop(game, None)
+            self.copied_bytes = None
+
+    def reusable_files(self, game: str, entries: dict[str, tuple[int, int]]) -> dict[str, dict]:
+        # Files of the installed version whose size and CRC match the new
+        # archive's entries (rel_path -> (size, crc)); their objects are held
+        # back from garbage collection until the install finishes
+        manifest = self.read_manifest(game) if self.has_game(game) else None
+        if not manifest:
+            return {}
+        reusable = {}
+        with self.lock:
+            for rel_path, (size, crc) in entries.items():
+                entry = manifest['files'].get(rel_path)
+                if entry and entry.get('crc') == crc and entry['size'] == size and self.object_path(entry['hash']).is_file():
+                    reusable[rel_path] = entry
+            self.pending_objects.setdefault(game, set()).update(entry['hash'] for entry in reusable.values())
+        return reusable
+
+    def stored_files(self, game: str, entries: dict[str, tuple[int, int]]) -> dict[str, str]:
+        # Entries (rel_path -> (size, crc)) whose content another install already
+        # has in the store, going by the size and CRC its manifest recorded; they
+        # will only be linked, so their objects are held back like reusable ones
+        by_crc = {}
+        for other in self.games():
+            for entry in (self.read_manifest(other) or {'files': {}})['files'].values():
+                if entry.get('crc') is not None:
+                    by_crc[(entry['size'], entry['crc'])] = entry['hash']
+        stored = {}
+        with self.lock:
+            for rel_path, (size, crc) in entries.items():
+                digest = by_crc.get((size, crc))
+                if digest and self.object_path(digest).is_file():
+                    stored[rel_path] = digest
+            self.pending_objects.setdefault(game, set()).update(stored.values())
+        return stored
+
+    def release_pending(self, game: str):
+        with self.lock:
+            self.pending_objects.pop(game, None)
+
+    def ingest_tree(self, game: str, src_root: Path, writable: Callable[[str], bool] | None = None) -> Path:
+        dest_root = self.game_path(game)
+        writable = writable or writable_matcher(None)
+        if src_root != dest_root:
+            remove_tree(dest_root)
+
+        files = {}
+        dirs = []
+        try:
+            for path in sorted(src_root.rglob('*')):
+                rel_path = path.relative_to(src_root).as_posix()
+                if path.is_dir():
+                    dirs.append(rel_path)
+                    (dest_root / rel_path).mkdir(parents=True, exist_ok=True)
+                    continue
+                digest, size = self.store_file(game, path)
+                files[rel_path] = self.file_entry(digest, size, self.link_file(digest, dest_root / rel_path, writable(rel_path)))
+            self.commit(game, files, dirs)
+        finally:
+            self.release_pending(game)
+            if src_root != dest_root:
+                remove_tree(src_root)
+
+        return dest_root
+
+    def adopt(self, game: str, writable: Callable[[str], bool] | None = None) -> Path:
+        # Installs made before the cache existed are moved into the store in place
+        print(f"Adopting existing install of {game} into the install cache")
+        return self.ingest_tree(game, self.game_path(game), writable)
+
+    def commit(self, game: str, files: dict, dirs: list, version: str | None = None, path: Path | None = None):
+        now = time.time()
+        with self.lock:
+            previous = self.game_path(game) if self.has_game(game) else None
+            dir_name = path.name if path else game
+            # Writing the manifest is the swap: from here on sessions get the new directory
+            write_json_atomic(self.manifest_path(game), {
+                'files': files,
+                'dirs': dirs,
+                'size': sum(f['size'] for f in files.values()),
+                'version': version,
+                'dir': dir_name,
+                'installed_at': now,
+                'last_used': now
+            })
+            self.current_dirs[game] = dir_name
+            self.copied_bytes = None
+            if previous and previous.name != dir_name:
+                self.retired.setdefault(game, []).append(previous)
+            retire_now = game in self.retired and not self.is_pinned(game)
+        if retire_now:
+            self.remove_retired(game)
+
+    def remove_retired(self, game: str):
+        with self.lock:
+            if self.is_pinned(game):
+                return
+            paths = self.retired.pop(game, [])
+        for path in paths:
+            print(f"Removing old install of {game} at {path}")
+            remove_tree(path)
+        if paths:
+            self.collect_garbage()
+
+    def sweep_stale_versions(self):
+        # Old versions a previous run did not get to remove
+        if not self.working_folder_path.is_dir():
+            return
+        current = {self.game_path(game).name for game in self.games()}
+        for path in self.working_folder_path.glob('*@*'):
+            if path.is_dir() and path.name not in current:
+                print(f"Removing stale install {path}")
+                remove_tree(path)
+
+    def fits(self, needed_bytes: int) -> bool:
+        if self.max_bytes:
+            return self.usage() + needed_bytes <= self.max_bytes
+        self.working_folder_path.mkdir(parents=True, exist_ok=True)
+        return shutil.disk_usage(self.working_folder_path).free > needed_bytes
+
+    def ensure_space(self, needed_bytes: int):
+        if not self.max_bytes:
+            return
+        with self.lock:
+            while self.usage() + needed_bytes > self.max_bytes:
+                victim = self.lru_victim()
+                if victim is None:
+                    raise Exception(f"Install cache over budget ({self.usage() + needed_bytes} > {self.max_bytes} bytes) "
+                                    f"and nothing left to evict")
+                self.evict(victim)
+
+    def lru_victim(self) -> str | None:
+        candidates = []
+        for game in self.games():
+            if self.is_pinned(game):
+                continue
+            manifest = self.read_manifest(game)
+            candidates.append((manifest.get('last_used', 0) if manifest else 0, game))
+        return min(candidates)[1] if candidates else None
+
+    def evict(self, game: str):
+        with self.lock:
+            if self.is_pinned(game):
+                raise Exception(f"Game {game} is in use and cannot be evicted")
+            print(f"Evicting {game} from the install cache")
+            remove_tree(self.game_path(game))
+            for path in self.retired.pop(game, []):
+                remove_tree(path)
+            self.manifest_path(game).unlink(missing_ok=True)
+            self.current_dirs.pop(game, None)
+            self.copied_bytes = None
+            self.collect_garbage()
+
+    def collect_garbage(self):
+        with self.lock:
+            referenced = set()
+            for game in self.games():
+                manifest = self.read_manifest(game)
+                if manifest:
+                    referenced.update(f['hash'] for f in manifest['files'].values())
+            for digests in self.pending_objects.values():
+                referenced.update(digests)
+
+            self.usage()
+            for object_path in self.objects_path.glob('*/*'):
+                if object_path.name not in referenced:
+                    size = object_path.stat().st_size
+                    try:
+                        remove_file(object_path)
+                    except OSError:
+                        # Still open through a link somewhere; the next collection gets it
+                        continue
+                    self.used_bytes -= size
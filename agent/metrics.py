@@ -0,0 +1,194 @@
+import json
+import time
+import asyncio
+
+SUB_BUCKET_BITS = 5
+SUB_BUCKETS = 1 << SUB_BUCKET_BITS
+MAX_TRACKED_VALUE = 1 << 40
+BUCKET_COUNT = (MAX_TRACKED_VALUE.bit_length() - SUB_BUCKET_BITS) * SUB_BUCKETS
+
+class Histogram:
+    # Log-linear buckets with 32 sub-buckets per power of two, so any recorded
+    # integer value is reported within ~3% while recording stays a couple of
+    # integer operations. Counts live in a preallocated list so snapshots can
+    # be read from another thread while the owner keeps recording.
+    def __init__(self):
+        self.counts = [0] * BUCKET_COUNT
+        self.total = 0
+        self.sum = 0
+        self.max = 0
+
+    @staticmethod
+    def bucket_index(value: int) -> int:
+        if value < SUB_BUCKETS:
+            return value
+        shift = value.bit_length() - SUB_BUCKET_BITS - 1
+        return shift * SUB_BUCKETS + (value >> shift)
+
+    @staticmethod
+    def bucket_upper_bound(index: int) -> int:
+        if index < SUB_BUCKETS:
+            return index
+        shift = index // SUB_BUCKETS - 1
+        mantissa = index - shift * SUB_BUCKETS
+        return ((mantissa + 1) << shift) - 1
+
+    def record(self, value: int):
+        if value < 0:
+            value = 0
+        elif value >= MAX_TRACKED_VALUE:
+            value = MAX_TRACKED_VALUE - 1
+        self.counts[self.bucket_index(value)] += 1
+        self.total += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def percentiles(self, quantiles: tuple[float, ...] = (0.5, 0.95, 0.99)) -> dict[float, int]:
+        result = {}
+        total = self.total
+        if not total:
+            return {q: 0 for q in quantiles}
+        targets = sorted((max(1, int(q * total + 0.5)), q) for q in quantiles)
+        seen = 0
+        i = 0
+        for index, count in enumerate(self.counts):
+            if not count:
+                continue
+            seen += count
+            while i < len(targets) and seen >= targets[i][0]:
+                result[targets[i][1]] = min(self.bucket_upper_bound(index), self.max)
+                i += 1
+            if i == len(targets):
+                break
+        return result
+
+    def merge(self, other: 'Histogram'):
+        for index, count in enumerate(other.counts):
+            self.counts[index] += count
+        self.total += other.total
+        self.sum += other.sum
+        self.max = max(self.max, other.max)
+
+    def summary(self, scale: float = 1.0) -> dict:
+        p = self.percentiles()
+        return {
+            'count': self.total,
+            'mean': self.sum / self.total / scale if self.total else 0,
+            'p50': p[0.5] / scale,
+            'p95': p[0.95] / scale,
+            'p99': p[0.99] / scale,
+            'max': self.max / scale
+        }
+
+
+class InputMetrics:
+    # Counters are only ever written from one thread each: packet counts from
+    # the WebSocket loop, histograms from the input engine thread.
+    def __init__(self, session_id: str):
+        self.session_id = session_id
+        self.started = time.time()
+        self.packets = 0
+        self.dropped = 0
+        self.bad_size = 0
+        self.lost = 0
+        self.latency_us = Histogram()
+        self.injection_us = Histogram()
+        self.queue_delay_us = Histogram()
+        self.rate_window_start = time.monotonic()
+        self.rate_window_packets = 0
+        self.packets_per_second = 0.0
+
+    def packet_received(self):
+        self.packets += 1
+        self.rate_window_packets += 1
+        now = time.monotonic()
+        elapsed = now - self.rate_window_start
+        if elapsed >= 1.0:
+            self.packets_per_second = self.rate_window_packets / elapsed
+            self.rate_window_start = now
+            self.rate_window_packets = 0
+
+    def snapshot(self) -> dict:
+        duration = time.time() - self.started
+        return {
+            'session_id': self.session_id,
+            'duration_s': duration,
+            'packets': self.packets,
+            'dropped': self.dropped,
+            'bad_size': self.bad_size,
+            'lost': self.lost,
+            'packets_per_second': self.packets_per_second,
+            'avg_packets_per_second': self.packets / duration if duration > 0 else 0,
+            'latency_ms': self.latency_us.summary(scale=1000),
+            'injection_us': self.injection_us.summary(),
+            'queue_delay_us': self.queue_delay_us.summary()
+        }
+
+
+def prometheus_text(agent_id: str, snapshots: list[dict], transfers: dict | None = None) -> str:
+    lines = []
+    for snapshot in snapshots:
+        labels = f'agent="{agent_id}",session="{snapshot["session_id"]}"'
+        for name in ('packets', 'dropped', 'bad_size', 'lost'):
+            lines.append(f'cloud_gaming_input_{name}_total{{{labels}}} {snapshot[name]}')
+        lines.append(f'cloud_gaming_input_packets_per_second{{{labels}}} {snapshot["packets_per_second"]}')
+        for hist in ('latency_ms', 'injection_us', 'queue_delay_us'):
+            for q in ('p50', 'p95', 'p99', 'max'):
+                lines.append(f'cloud_gaming_input_{hist}{{{labels},stat="{q}"}} {snapshot[hist][q]}')
+    lines.append(f'cloud_gaming_agent_sessions_active{{agent="{agent_id}"}} {len(snapshots)}')
+    for direction, totals in (transfers or {}).items():
+        labels = f'agent="{agent_id}",direction="{direction}"'
+        for name in ('bytes', 'requests', 'transfers', 'resumed', 'unverified', 'failed'):
+            lines.append(f'cloud_gaming_storage_{name}_total{{{labels}}} {totals[name]}')
+        for name in ('last_mbps', 'avg_mbps'):
+            lines.append(f'cloud_gaming_storage_{name}{{{labels}}} {totals[name]}')
+    return '\n'.join(lines) + '\n'
+
+
+class MetricsServer:
+    # Minimal HTTP endpoint for scrapers: /metrics in Prometheus text format,
+    # anything else gets the raw JSON snapshots of all running sessions.
+    def __init__(self, agent_id: str, get_snapshots, host: str, port: int, get_transfers=None):
+        self.agent_id = agent_id
+        self.get_snapshots = get_snapshots
+        self.get_transfers = get_transfers
+        self.host = host
+        self.port = port
+        self.server = None
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, self.host, self.port)
+        print(f"Metrics endpoint listening on {self.host}:{self.port}")
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), timeout=5)
+            while (await asyncio.wait_for(reader.readline(), timeout=5)) not in (b'\r\n', b'\n', b''):
+                pass
+            parts = request_line.decode(errors='replace').split()
+            path = parts[1] if len(parts) > 1 else '/'
+            snapshots = self.get_snapshots()
+            transfers = self.get_transfers() if self.get_transfers else None
+            if path == '/metrics':
+                body = prometheus_text(self.agent_id, snapshots, transfers).encode()
+                content_type = 'text/plain; version=0.0.4'
+            else:
+                body = json.dumps({'agent': self.agent_id, 'sessions': snapshots, 'transfers': transfers}).encode()
+                content_type = 'application/json'
+            writer.write(b'HTTP/1.1 200 OK\r\nContent-Type: ' + content_type.encode() +
+                         b'\r\nContent-Length: ' + str(len(body)).encode() + b'\r\nConnection: close\r\n\r\n' + body)
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+
+async def publish_metrics(redis_client, agent_id: str, snapshots: list[dict], ttl: int = 30):
+    key = f'agent_metrics:{agent_id}'
+    await redis_client.set(key, json.dumps(snapshots), ex=ttl)
+
+async def publish_session_summary(redis_client, agent_id: str, snapshot: dict, keep: int = 1000):
+    await redis_client.lpush('session_metrics', json.dumps({'agent': agent_id, **snapshot}))
+    await redis_client.ltrim('session_metrics', 0, keep - 1)
@@ -0,0 +1,158 @@
+import sys
+from abc import ABC, abstractmethod
+from dataclasses import dataclass, fields, replace
+
+GST_LAUNCH = "gst-launch-1.0.exe" if sys.platform == 'win32' else "gst-launch-1.0"
+
+@dataclass
+class VideoSpec:
+    encoder: str = 'nvh264'
+    source: str = 'window'
+    bitrate_kbps: int = 4000
+    min_bitrate_kbps: int = 1000
+    max_bitrate_kbps: int = 12000
+    gop_size: int = 30
+    width: int = 0  # 0 keeps the captured size
+    height: int = 0
+    qp_min: int = 25
+    qp_max: int = 35
+    adaptive: bool = True
+
+    def merged(self, overrides: dict | None) -> 'VideoSpec':
+        if not overrides:
+            return self
+        values = {}
+        for f in fields(self):
+            if f.name not in overrides:
+                continue
+            value = overrides[f.name]
+            if f.type is bool:
+                value = value if isinstance(value, bool) else str(value).strip().lower() in ('1', 'true', 'yes', 'on')
+            elif f.type is int:
+                value = int(value)
+            else:
+                value = str(value)
+            values[f.name] = value
+        return replace(self, **values)
+
+    def with_client(self, prefs: dict | None) -> 'VideoSpec':
+        # Clients can only lower the bitrate cap and resolution the agent and game allow
+        if not prefs:
+            return self
+        spec = self
+        max_bitrate = prefs.get('max_bitrate_kbps')
+        if max_bitrate:
+            spec = replace(spec, max_bitrate_kbps=max(spec.min_bitrate_kbps, min(spec.max_bitrate_kbps, int(max_bitrate))))
+        bitrate = prefs.get('bitrate_kbps', spec.bitrate_kbps)
+        spec = replace(spec, bitrate_kbps=max(spec.min_bitrate_kbps, min(spec.max_bitrate_kbps, int(bitrate))))
+        width, height = prefs.get('width'), prefs.get('height')
+        if width and height and (not spec.width or int(width) * int(height) < spec.width * spec.height):
+            spec = replace(spec, width=int(width) & ~1, height=int(height) & ~1)
+        return spec
+
+
+class VideoSource(ABC):
+    # Tokens for the source element(s), what to convert/scale with, the caps of
+    # its output and how to get frames into system memory if an encoder needs it
+    scaler: list[str]
+    caps: str
+    download: list[str] = []
+
+    @abstractmethod
+    def elements(self, window_handle: int | None) -> list[str]: ...
+
+
+class WindowCaptureSource(VideoSource):
+    scaler = ["d3d12convert"]
+    caps = "video/x-raw(memory:D3D12Memory)"
+    download = ["d3d12download", "!", "videoconvert"]
+
+    def elements(self, window_handle: int | None) -> list[str]:
+        return ["d3d12screencapturesrc", "show-cursor=true", f"window-handle={window_handle}"]
+
+
+class TestSource(VideoSource):
+    # Synthetic frames so pipelines and the bitrate controller run without a desktop or GPU
+    scaler = ["videoconvert", "!", "videoscale"]
+    caps = "video/x-raw"
+
+    def elements(self, window_handle: int | None) -> list[str]:
+        return ["videotestsrc", "is-live=true", "pattern=ball"]
+
+
+class VideoEncoder(ABC):
+    system_memory: bool = False
+
+    @abstractmethod
+    def elements(self, spec: VideoSpec) -> list[str]: ...
+
+
+class NvH264Encoder(VideoEncoder):
+    def elements(self, spec: VideoSpec) -> list[str]:
+        return [
+            "nvh264enc", "name=encoder", "tune=ultra-low-latency", "preset=p1", "rc-mode=cbr", f"bitrate={spec.bitrate_kbps}",
+            "bframes=0", "rc-lookahead=0", f"gop-size={spec.gop_size}", "zerolatency=true", f"vbv-buffer-size={spec.bitrate_kbps // 10}",
+            "repeat-sequence-header=true", f"qp-min={spec.qp_min}", f"qp-max={spec.qp_max}"
+        ]
+
+
+class X264Encoder(VideoEncoder):
+    system_memory = True
+
+    def elements(self, spec: VideoSpec) -> list[str]:
+        return [
+            "x264enc", "name=encoder", "tune=zerolatency", "speed-preset=ultrafast", f"bitrate={spec.bitrate_kbps}",
+            f"key-int-max={spec.gop_size}", "bframes=0", "vbv-buf-capacity=100"
+        ]
+
+
+SOURCES: dict[str, VideoSource] = {
+    'window': WindowCaptureSource(),
+    'test': TestSource()
+}
+
+ENCODERS: dict[str, VideoEncoder] = {
+    'nvh264': NvH264Encoder(),
+    'x264': X264Encoder()
+}
+
+def scale_caps(base_caps: str, width: int, height: int) -> str:
+    if width and height:
+        return f"{base_caps},width={width},height={height}"
+    return base_caps
+
+def source_and_encoder(spec: VideoSpec) -> tuple[VideoSource, VideoEncoder]:
+    if spec.source not in SOURCES:
+        raise Exception(f"Unknown video source {spec.source}")
+    if spec.encoder not in ENCODERS:
+        raise Exception(f"Unknown video encoder {spec.encoder}")
+    return SOURCES[spec.source], ENCODERS[spec.encoder]
+
+def base_caps(spec: VideoSpec) -> str:
+    source, encoder = source_and_encoder(spec)
+    # Encoders that need system memory get frames downloaded and scaled there
+    return "video/x-raw" if encoder.system_memory and source.download else source.caps
+
+def video_pipeline(spec: VideoSpec, window_handle: int | None, signalling_port: int) -> list[str]:
+    source, encoder = source_and_encoder(spec)
+
+    tokens = source.elements(window_handle)
+    # Without a fixed size or adaptation the source links straight to the encoder
+    scaled = bool(spec.width and spec.height) or spec.adaptive
+    if encoder.system_memory and source.download:
+        tokens += ["!", *source.download]
+        if scaled:
+            tokens += ["!", "videoscale"]
+    elif scaled:
+        tokens += ["!", *source.scaler]
+    if scaled:
+        # The scale capsfilter and the encoder are named so a stream host can retune them while playing
+        tokens += ["!", "capsfilter", "name=scale", f'caps="{scale_caps(base_caps(spec), spec.width, spec.height)}"']
+    tokens += ["!", *encoder.elements(spec)]
+    tokens += [
+        "!", "video/x-h264,stream-format=avc,alignment=au",
+        "!", "queue", "max-size-buffers=1", "max-size-time=0", "max-size-bytes=0", "leaky=downstream",
+        "!", "webrtcsink", "name=sink",
+        "run-signalling-server=true", f"signalling-server-port={signalling_port}"
+    ]
+    return tokens
@@ -0,0 +1,69 @@
+import asyncio
+from file_dl import GameFileManager
+from scheduling import top_games
+from zip_stream import TransferThrottle, InstallCancelled
+
+class Prefetcher:
+    # Installs the most requested games while the agent sits idle. Prefetches
+    # are throttled, never evict other games, and are preempted as soon as a
+    # session is claimed: cancelled outright, or unthrottled if the session
+    # wants the very game being prefetched.
+    def __init__(self, game_dl: GameFileManager, redis_client, max_games: int = 5, bytes_per_second: float = 0,
+                 window_hours: int = 24, interval: float = 60.0):
+        self.game_dl = game_dl
+        self.redis_client = redis_client
+        self.max_games = max_games
+        self.bytes_per_second = bytes_per_second
+        self.window_hours = window_hours
+        self.interval = interval
+        self.task = None
+        self.game = None
+        self.throttle = None
+
+    def start(self):
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.run())
+
+    def preempt(self, session_game: str | None = None):
+        if self.throttle:
+            if self.game == session_game:
+                print(f"Session wants {self.game}; finishing its prefetch at full speed")
+                self.throttle.set_rate(0)
+            else:
+                self.throttle.cancel()
+        if self.task:
+            # The install thread finishes or aborts on its own; the session's
+            # install waits on the game lock if it needs the same game
+            self.task.cancel()
+            self.task = None
+
+    async def run(self):
+        # Failures are retried the next time the agent goes idle
+        failed = set()
+        while True:
+            try:
+                games = await top_games(self.redis_client, self.window_hours, self.max_games)
+            except Exception as e:
+                print(f"Failed to read game demand: {e}")
+                games = []
+
+            for game in games:
+                if game in failed or self.game_dl.game_is_downloaded(game):
+                    continue
+                self.game = game
+                self.throttle = TransferThrottle(self.bytes_per_second)
+                print(f"Prefetching {game}")
+                try:
+                    await asyncio.to_thread(self.game_dl.install_from_repo, game, None, self.throttle, False)
+                    print(f"Prefetched {game}")
+                except InstallCancelled:
+                    print(f"Prefetch of {game} cancelled")
+                    return
+                except Exception as e:
+                    print(f"Prefetch of {game} failed: {e}")
+                    failed.add(game)
+                finally:
+                    self.game = None
+                    self.throttle = None
+
+            await asyncio.sleep(self.interval)
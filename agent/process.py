@@ -1,8 +1,12 @@
+import sys
 import time
-import win32gui
-import win32process
-import win32com.client
-import win32con
+import asyncio
+
+if sys.platform == 'win32':
+    import win32gui
+    import win32process
+    import win32com.client
+    import win32con
 
 
 def get_hwnd_from_pid(pid):
@@ -26,6 +30,16 @@ def wait_for_window(pid, timeout=10.0, check_interval=0.1):
         time.sleep(check_interval)
     return None
 
+async def wait_for_window_async(pid, timeout=10.0, check_interval=0.1):
+    print(f"Waiting for window with PID {pid}")
+    start = time.time()
+    while time.time() - start < timeout:
+        hwnd = await asyncio.to_thread(get_hwnd_from_pid, pid)
+        if hwnd:
+            return hwnd
+        await asyncio.sleep(check_interval)
+    return None
+
 def bring_window_to_foreground(hwnd):
     shell = win32com.client.Dispatch("WScript.Shell")
     shell.SendKeys('%')
@@ -1,6 +1,10 @@
+import sys
+import time
 import ctypes
 import struct
-import time
+import threading
+from abc import ABC, abstractmethod
+from collections import deque
 from ctypes import wintypes
 
 INPUT_MOUSE = 0
@@ -20,6 +24,39 @@ MOUSEEVENTF_MIDDLEDOWN = 0x0020
 MOUSEEVENTF_MIDDLEUP = 0x0040
 MOUSEEVENTF_WHEEL = 0x0800
 
+EXTENDED_KEYS = frozenset((
+    0x1D, 0x38, 0x9D, 0xB8,  # Ctrl, Alt (L/R)
+    0x25, 0x26, 0x27, 0x28,  # Arrow keys
+    0x2D, 0x2E, 0x23, 0x24,  # Ins, Del, End, Home
+    0x21, 0x22, 0x6A, 0x6B,  # PgUp, PgDn, NumPad ops
+    0x6D, 0x6F               # NumPad -, /
+))
+
+# Client button bit -> (down flag, up flag)
+MOUSE_BUTTONS = (
+    (1, MOUSEEVENTF_LEFTDOWN, MOUSEEVENTF_LEFTUP),
+    (2, MOUSEEVENTF_MIDDLEDOWN, MOUSEEVENTF_MIDDLEUP),
+    (4, MOUSEEVENTF_RIGHTDOWN, MOUSEEVENTF_RIGHTUP),
+)
+
+WM_KEYDOWN = 0x0100
+WM_KEYUP = 0x0101
+WM_MOUSEMOVE = 0x0200
+WM_MOUSEWHEEL = 0x020A
+
+# SendInput button flag -> (window message, MK_* state bit, down)
+WINDOW_BUTTON_MESSAGES = {
+    MOUSEEVENTF_LEFTDOWN: (0x0201, 0x0001, True),
+    MOUSEEVENTF_LEFTUP: (0x0202, 0x0001, False),
+    MOUSEEVENTF_RIGHTDOWN: (0x0204, 0x0002, True),
+    MOUSEEVENTF_RIGHTUP: (0x0205, 0x0002, False),
+    MOUSEEVENTF_MIDDLEDOWN: (0x0207, 0x0010, True),
+    MOUSEEVENTF_MIDDLEUP: (0x0208, 0x0010, False),
+}
+
+PACKET_SIZE = 56
+NEUTRAL_PACKET = bytes(PACKET_SIZE)
+
 if not hasattr(wintypes, 'ULONG_PTR'):
     wintypes.ULONG_PTR = ctypes.POINTER(ctypes.c_ulong) if ctypes.sizeof(ctypes.c_void_p) == 4 else ctypes.c_ulonglong
 
@@ -48,104 +85,366 @@ class _INPUTunion(ctypes.Union):
 class INPUT(ctypes.Structure):
     _fields_ = [("type", wintypes.DWORD), ("union", _INPUTunion)]
 
-SendInput = ctypes.windll.user32.SendInput
-
-prev_keys = bytearray(32)
-prev_buttons = 0
-
-def handle_packet(pkt: bytes):
-    global prev_keys, prev_buttons
-
-    if len(pkt) != 56:
-        print(f"Invalid packet size: {len(pkt)}, expected 56")
-        return
-
-    # Keyboard (0-31)
-    new_keys = pkt[0:32]
-    diff = int.from_bytes(prev_keys, 'little') ^ int.from_bytes(new_keys, 'little')
-    while diff:
-        vk = (diff & -diff).bit_length() - 1
-        byte_i = vk >> 3
-        bit = 1 << (vk & 7)
-        is_down = new_keys[byte_i] & bit
-        key_event(vk, down=bool(is_down))
-        diff &= diff - 1
-    prev_keys[:] = new_keys
-
-    # Mouse (32-47)
-    mouse_buttons, = struct.unpack('<I', pkt[32:36])
-    mouse_dx, mouse_dy, mouse_wheel_input = struct.unpack('<iii', pkt[36:48])
-    
-    # Handle mouse button changes
-    changed = mouse_buttons ^ prev_buttons
-    if changed & 1:  # Left button (bit 0)
-        if mouse_buttons & 1:
-            mouse_left_down()
-        else:
-            mouse_left_up()
-    if changed & 2:  # Middle button (bit 1)
-        if mouse_buttons & 2:
-            mouse_middle_down()
-        else:
-            mouse_middle_up()
-    if changed & 4:  # Right button (bit 2)
-        if mouse_buttons & 4:
-            mouse_right_down()
+
+class InputBackend(ABC):
+    # Events are queued with key/mouse_* and handed to the OS in one call on flush
+    @abstractmethod
+    def key(self, vk: int, down: bool): ...
+
+    @abstractmethod
+    def mouse_move(self, dx: int, dy: int): ...
+
+    @abstractmethod
+    def mouse_button(self, flags: int): ...
+
+    @abstractmethod
+    def mouse_wheel(self, delta: int): ...
+
+    @abstractmethod
+    def flush(self) -> int: ...
+
+
+class SendInputBackend(InputBackend):
+    def __init__(self, capacity: int = 256):
+        user32 = ctypes.windll.user32
+        self.send_input = user32.SendInput
+        self.capacity = capacity
+        self.inputs = (INPUT * capacity)()
+        self.input_size = ctypes.sizeof(INPUT)
+        self.count = 0
+        self.scan_codes = [user32.MapVirtualKeyW(vk, 0) for vk in range(256)]
+
+    def next_slot(self) -> INPUT:
+        if self.count == self.capacity:
+            self.flush()
+        slot = self.inputs[self.count]
+        self.count += 1
+        return slot
+
+    def key(self, vk: int, down: bool):
+        flags = KEYEVENTF_SCANCODE
+        if not down:
+            flags |= KEYEVENTF_KEYUP
+        if vk in EXTENDED_KEYS:
+            flags |= KEYEVENTF_EXTENDEDKEY
+
+        slot = self.next_slot()
+        slot.type = INPUT_KEYBOARD
+        ki = slot.union.ki
+        ki.wVk = 0
+        ki.wScan = self.scan_codes[vk]
+        ki.dwFlags = flags
+        ki.time = 0
+        ki.dwExtraInfo = 0
+
+    def mouse(self, dx: int, dy: int, data: int, flags: int):
+        slot = self.next_slot()
+        slot.type = INPUT_MOUSE
+        mi = slot.union.mi
+        mi.dx = dx
+        mi.dy = dy
+        mi.mouseData = data
+        mi.dwFlags = flags
+        mi.time = 0
+        mi.dwExtraInfo = 0
+
+    def mouse_move(self, dx: int, dy: int):
+        self.mouse(dx, dy, 0, MOUSEEVENTF_MOVE)
+
+    def mouse_button(self, flags: int):
+        self.mouse(0, 0, 0, flags)
+
+    def mouse_wheel(self, delta: int):
+        self.mouse(0, 0, delta & 0xFFFFFFFF, MOUSEEVENTF_WHEEL)
+
+    def flush(self) -> int:
+        count = self.count
+        if count:
+            self.send_input(count, self.inputs, self.input_size)
+            self.count = 0
+        return count
+
+
+class WindowMessageBackend(InputBackend):
+    # Posts input to one window instead of the desktop-wide SendInput stream so
+    # several sessions can share a desktop. Relative motion drives a virtual
+    # cursor clamped to the client area; games reading raw input won't see it.
+    def __init__(self, hwnd: int):
+        user32 = ctypes.windll.user32
+        self.hwnd = hwnd
+        self.post_message = user32.PostMessageW
+        self.post_message.argtypes = [wintypes.HWND, wintypes.UINT, wintypes.WPARAM, wintypes.LPARAM]
+        self.get_client_rect = user32.GetClientRect
+        self.client_to_screen = user32.ClientToScreen
+        self.scan_codes = [user32.MapVirtualKeyW(vk, 0) for vk in range(256)]
+        self.rect = wintypes.RECT()
+        self.messages = []
+        self.x = 0
+        self.y = 0
+        self.button_state = 0
+
+    def position(self) -> int:
+        return (self.y & 0xFFFF) << 16 | (self.x & 0xFFFF)
+
+    def key(self, vk: int, down: bool):
+        lparam = 1 | self.scan_codes[vk] << 16
+        if vk in EXTENDED_KEYS:
+            lparam |= 1 << 24
+        if not down:
+            lparam |= 3 << 30
+        self.messages.append((WM_KEYDOWN if down else WM_KEYUP, vk, lparam))
+
+    def mouse_move(self, dx: int, dy: int):
+        self.get_client_rect(self.hwnd, ctypes.byref(self.rect))
+        self.x = min(max(self.x + dx, 0), max(self.rect.right - 1, 0))
+        self.y = min(max(self.y + dy, 0), max(self.rect.bottom - 1, 0))
+        self.messages.append((WM_MOUSEMOVE, self.button_state, self.position()))
+
+    def mouse_button(self, flags: int):
+        message, state_bit, down = WINDOW_BUTTON_MESSAGES[flags]
+        if down:
+            self.button_state |= state_bit
         else:
-            mouse_right_up()
-    prev_buttons = mouse_buttons
-
-    # Handle mouse movement (relative)
-    if mouse_dx != 0 or mouse_dy != 0:
-        mouse_move(mouse_dx, mouse_dy)
-
-    # Handle mouse wheel
-    if mouse_wheel_input != 0:
-        # Positive deltaY (scroll down) should be negative wheel delta (scroll down), hence the -1
-        wheel_delta = -1 * mouse_wheel_input
-        mouse_wheel(wheel_delta)
-
-    # Timestamp (48-55)
-    timestamp_ms, = struct.unpack('<Q', pkt[48:56])
-    current_time_ms = int(time.time() * 1000)
-    latency_ms = current_time_ms - timestamp_ms
-    # print(f"Input latency: {latency_ms}ms")
-    # print(f"Received timestamp: {timestamp_ms}ms")
-
-def key_event(vk, down=True):
-    scan = ctypes.windll.user32.MapVirtualKeyW(vk, 0)
-    flags = KEYEVENTF_SCANCODE
-    if not down:
-        flags |= KEYEVENTF_KEYUP
-
-    if vk in (0x1D, 0x38, 0x9D, 0xB8,  # Ctrl, Alt (L/R)
-              0x25, 0x26, 0x27, 0x28,  # Arrow keys
-              0x2D, 0x2E, 0x23, 0x24,  # Ins, Del, End, Home
-              0x21, 0x22, 0x6A, 0x6B,  # PgUp, PgDn, NumPad ops
-              0x6D, 0x6F):             # NumPad -, /
-        flags |= KEYEVENTF_EXTENDEDKEY
-
-    ki = KEYBDINPUT(wVk=0, wScan=scan, dwFlags=flags, time=0, dwExtraInfo=0)
-    inp = INPUT(type=INPUT_KEYBOARD, union=_INPUTunion(ki=ki))
-    SendInput(1, ctypes.byref(inp), ctypes.sizeof(INPUT))
-
-def mouse_event(flags, data=0):
-    mi = MOUSEINPUT(0, 0, data, flags, 0, 0)
-    inp = INPUT(type=INPUT_MOUSE, union=_INPUTunion(mi=mi))
-    SendInput(1, ctypes.byref(inp), ctypes.sizeof(INPUT))
-
-def mouse_move(dx, dy):
-    flags = MOUSEEVENTF_MOVE
-    mi = MOUSEINPUT(dx, dy, 0, flags, 0, 0)
-    inp = INPUT(type=INPUT_MOUSE, union=_INPUTunion(mi=mi))
-    SendInput(1, ctypes.byref(inp), ctypes.sizeof(INPUT))
-
-def mouse_wheel(delta):
-    mouse_event(MOUSEEVENTF_WHEEL, delta)
-
-def mouse_left_down():  mouse_event(MOUSEEVENTF_LEFTDOWN)
-def mouse_left_up():    mouse_event(MOUSEEVENTF_LEFTUP)
-def mouse_right_down(): mouse_event(MOUSEEVENTF_RIGHTDOWN)
-def mouse_right_up():   mouse_event(MOUSEEVENTF_RIGHTUP)
-def mouse_middle_down(): mouse_event(MOUSEEVENTF_MIDDLEDOWN)
-def mouse_middle_up():   mouse_event(MOUSEEVENTF_MIDDLEUP)
+            self.button_state &= ~state_bit
+        self.messages.append((message, self.button_state, self.position()))
+
+    def mouse_wheel(self, delta: int):
+        # WM_MOUSEWHEEL carries screen coordinates and a signed 16-bit delta
+        point = wintypes.POINT(self.x, self.y)
+        self.client_to_screen(self.hwnd, ctypes.byref(point))
+        delta = min(max(delta, -32768), 32767)
+        self.messages.append((WM_MOUSEWHEEL, (delta & 0xFFFF) << 16 | self.button_state, (point.y & 0xFFFF) << 16 | (point.x & 0xFFFF)))
+
+    def flush(self) -> int:
+        count = len(self.messages)
+        for message, wparam, lparam in self.messages:
+            self.post_message(self.hwnd, message, wparam, lparam)
+        self.messages.clear()
+        return count
+
+
+class RecordingBackend(InputBackend):
+    # Stand-in for SendInput on machines without a Windows desktop; keeps the
+    # most recent batches so tests and benchmarks can inspect what was injected.
+    def __init__(self, max_batches: int = 10000):
+        self.batches = deque(maxlen=max_batches)
+        self.pending = []
+        self.event_count = 0
+        self.flush_count = 0
+
+    def key(self, vk: int, down: bool):
+        self.pending.append(('key', vk, down))
+
+    def mouse_move(self, dx: int, dy: int):
+        self.pending.append(('move', dx, dy))
+
+    def mouse_button(self, flags: int):
+        self.pending.append(('button', flags))
+
+    def mouse_wheel(self, delta: int):
+        self.pending.append(('wheel', delta))
+
+    def flush(self) -> int:
+        count = len(self.pending)
+        if count:
+            self.batches.append(self.pending)
+            self.pending = []
+            self.event_count += count
+            self.flush_count += 1
+        return count
+
+
+class NullBackend(InputBackend):
+    # Drops everything and only counts it, for load tests where the cost of
+    # the agent's input path should not include keeping the events around
+    def __init__(self):
+        self.pending = 0
+        self.event_count = 0
+        self.flush_count = 0
+
+    def key(self, vk: int, down: bool):
+        self.pending += 1
+
+    def mouse_move(self, dx: int, dy: int):
+        self.pending += 1
+
+    def mouse_button(self, flags: int):
+        self.pending += 1
+
+    def mouse_wheel(self, delta: int):
+        self.pending += 1
+
+    def flush(self) -> int:
+        count = self.pending
+        if count:
+            self.pending = 0
+            self.event_count += count
+            self.flush_count += 1
+        return count
+
+
+def default_backend() -> InputBackend:
+    if sys.platform == 'win32':
+        return SendInputBackend()
+    return RecordingBackend()
+
+
+def merge_packets(older: bytes, newer: bytes) -> bytes:
+    # Key and button state is absolute so the newer packet wins; relative
+    # mouse motion and wheel are summed so no movement is lost.
+    buttons, dx, dy, wheel = struct.unpack_from('<Iiii', newer, 32)
+    _, old_dx, old_dy, old_wheel = struct.unpack_from('<Iiii', older, 32)
+    timestamp, = struct.unpack_from('<Q', older, 48)
+    return newer[0:32] + struct.pack('<IiiiQ', buttons, dx + old_dx, dy + old_dy, wheel + old_wheel, timestamp)
+
+
+class PacketRing:
+    def __init__(self, capacity: int):
+        self.slots = [None] * capacity
+        self.capacity = capacity
+        self.head = 0
+        self.count = 0
+        self.closed = False
+        self.coalesced = 0
+        # When the oldest queued packet arrived, and how long the last drained batch's oldest packet waited
+        self.oldest_ns = 0
+        self.waited_ns = 0
+        self.cond = threading.Condition()
+
+    def push(self, pkt: bytes) -> bool:
+        with self.cond:
+            if self.count == self.capacity:
+                newest = (self.head + self.count - 1) % self.capacity
+                self.slots[newest] = merge_packets(self.slots[newest], pkt)
+                self.coalesced += 1
+                return False
+            if not self.count:
+                self.oldest_ns = time.perf_counter_ns()
+            self.slots[(self.head + self.count) % self.capacity] = pkt
+            self.count += 1
+            self.cond.notify()
+            return True
+
+    def drain(self) -> list[bytes] | None:
+        with self.cond:
+            while not self.count and not self.closed:
+                self.cond.wait()
+            if not self.count:
+                return None
+            self.waited_ns = time.perf_counter_ns() - self.oldest_ns
+            packets = []
+            for _ in range(self.count):
+                packets.append(self.slots[self.head])
+                self.slots[self.head] = None
+                self.head = (self.head + 1) % self.capacity
+            self.count = 0
+            return packets
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+
+class InputEngine:
+    # Packets from the WebSocket are queued and injected by a dedicated thread.
+    # Everything queued since the last wakeup goes out as one backend batch,
+    # with consecutive mouse motion and wheel merged into single events.
+    def __init__(self, backend: InputBackend | None = None, capacity: int = 256):
+        self.backend = backend or default_backend()
+        self.ring = PacketRing(capacity)
+        self.prev_keys = 0
+        self.prev_buttons = 0
+        self.thread = None
+        self.metrics = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name='input-engine', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.ring.close()
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+
+    def submit(self, pkt: bytes) -> bool:
+        metrics = self.metrics
+        if len(pkt) != PACKET_SIZE:
+            print(f"Invalid packet size: {len(pkt)}, expected {PACKET_SIZE}")
+            if metrics:
+                metrics.bad_size += 1
+            return False
+        if metrics:
+            metrics.packet_received()
+        if not self.ring.push(pkt) and metrics:
+            metrics.dropped += 1
+        return True
+
+    def reset(self):
+        self.ring.push(NEUTRAL_PACKET)
+
+    def run(self):
+        while (packets := self.ring.drain()) is not None:
+            if self.metrics:
+                self.metrics.queue_delay_us.record(self.ring.waited_ns // 1000)
+            try:
+                self.inject(packets)
+            except Exception as e:
+                print(f"Error injecting input: {e}")
+
+    def inject(self, packets: list[bytes]) -> int:
+        backend = self.backend
+        metrics = self.metrics
+        move_dx = move_dy = wheel = 0
+        now_us = int(time.time() * 1_000_000)
+
+        for pkt in packets:
+            keys = int.from_bytes(pkt[0:32], 'little')
+            buttons, dx, dy, wheel_input = struct.unpack_from('<Iiii', pkt, 32)
+
+            key_diff = keys ^ self.prev_keys
+            button_diff = buttons ^ self.prev_buttons
+            if key_diff or button_diff:
+                # State changes must not overtake motion queued before them
+                if move_dx or move_dy:
+                    backend.mouse_move(move_dx, move_dy)
+                    move_dx = move_dy = 0
+                if wheel:
+                    backend.mouse_wheel(wheel)
+                    wheel = 0
+
+            while key_diff:
+                vk = (key_diff & -key_diff).bit_length() - 1
+                backend.key(vk, down=bool(keys >> vk & 1))
+                key_diff &= key_diff - 1
+            self.prev_keys = keys
+
+            for bit, down_flag, up_flag in MOUSE_BUTTONS:
+                if button_diff & bit:
+                    backend.mouse_button(down_flag if buttons & bit else up_flag)
+            self.prev_buttons = buttons
+
+            move_dx += dx
+            move_dy += dy
+            # Positive deltaY (scroll down) should be negative wheel delta (scroll down), hence the -1
+            wheel -= wheel_input
+
+            if metrics:
+                # Client clock in ms; skew between client and agent clocks is included
+                timestamp_ms, = struct.unpack_from('<Q', pkt, 48)
+                if timestamp_ms:
+                    metrics.latency_us.record(now_us - timestamp_ms * 1000)
+
+        if move_dx or move_dy:
+            backend.mouse_move(move_dx, move_dy)
+        if wheel:
+            backend.mouse_wheel(wheel)
+
+        if not metrics:
+            return backend.flush()
+        start = time.perf_counter_ns()
+        count = backend.flush()
+        if count:
+            metrics.injection_us.record((time.perf_counter_ns() - start) // 1000)
+        return count
@@ -0,0 +1,57 @@
+import asyncio
+from file_dl import SaveFileManager
+from tracing import NULL_SPAN, Span, NullSpan
+
+class SaveUploadQueue:
+    # Pushes staged saves to storage in the background so the agent can take
+    # the next session as soon as the save is staged locally. Each save
+    # (game, user) gets its own worker, so a failing push backing off between
+    # retries holds up only that user; at most `concurrency` pushes run at
+    # once. A save that still fails stays marked pending on disk and is
+    # pushed before that user's save is next downloaded.
+    def __init__(self, save_dl: SaveFileManager, retries: int = 5, retry_delay: float = 2.0, concurrency: int = 4):
+        self.save_dl = save_dl
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.slots = asyncio.Semaphore(concurrency)
+        self.queued: dict[tuple[str, str], list[Span | NullSpan]] = {}
+        self.workers: dict[tuple[str, str], asyncio.Task] = {}
+        self.idle: dict[tuple[str, str], asyncio.Event] = {}
+
+    def submit(self, game: str, user: str, trace: Span | NullSpan = NULL_SPAN):
+        key = (game, user)
+        self.queued.setdefault(key, []).append(trace)
+        if key not in self.workers:
+            self.idle[key] = asyncio.Event()
+            self.workers[key] = asyncio.create_task(self.run(key))
+
+    async def wait_idle(self, game: str, user: str):
+        idle = self.idle.get((game, user))
+        if idle:
+            await idle.wait()
+
+    async def push(self, game: str, user: str, trace: Span | NullSpan):
+        delay = self.retry_delay
+        with trace.child('save_upload') as span:
+            for attempt in range(1, self.retries + 1):
+                try:
+                    async with self.slots:
+                        await asyncio.to_thread(self.save_dl.push_save, game, user)
+                    span.set(attempts=attempt, uploaded=True)
+                    return
+                except Exception as e:
+                    print(f"Save upload for {game}/{user} failed (attempt {attempt}/{self.retries}): {e}")
+                    span.set(attempts=attempt, uploaded=False, last_error=str(e))
+                    if attempt < self.retries:
+                        await asyncio.sleep(delay)
+                        delay *= 2
+
+    async def run(self, key: tuple[str, str]):
+        game, user = key
+        try:
+            while self.queued[key]:
+                await self.push(game, user, self.queued[key].pop(0))
+        finally:
+            del self.queued[key]
+            del self.workers[key]
+            self.idle.pop(key).set()
@@ -0,0 +1,62 @@
+import json
+import time
+import shutil
+
+SESSIONS_KEY = 'sessions'
+GAME_QUEUE_PREFIX = 'sessions:game:'
+AGENTS_KEY = 'agents'
+AGENT_KEY_PREFIX = 'agent:'
+DEMAND_KEY_PREFIX = 'game_demand:'
+# Served in this order; normal keeps the original queue names
+PRIORITIES = ('high', 'normal', 'low')
+DEFAULT_PRIORITY = 'normal'
+
+def global_queue(priority: str = DEFAULT_PRIORITY) -> str:
+    return SESSIONS_KEY if priority == DEFAULT_PRIORITY else f'{SESSIONS_KEY}:{priority}'
+
+def game_queue(game: str, priority: str = DEFAULT_PRIORITY) -> str:
+    return f'{GAME_QUEUE_PREFIX}{game}' if priority == DEFAULT_PRIORITY else f'{SESSIONS_KEY}:{priority}:game:{game}'
+
+def session_queues(installed_games: list[str], include_global: bool = True) -> list[str]:
+    # brpop serves keys in order. Priority comes first, then within a priority
+    # requests for games this agent already has win over the global queue that
+    # agents without the game fall back to.
+    queues = []
+    for priority in PRIORITIES:
+        queues += [game_queue(game, priority) for game in sorted(installed_games)]
+        if include_global:
+            queues.append(global_queue(priority))
+    return queues
+
+def inventory(agent_id: str, installed_games: list[str], working_folder_path: str, active_sessions: int, max_sessions: int = 1) -> dict:
+    return {
+        'id': agent_id,
+        'games': sorted(installed_games),
+        'free_disk': shutil.disk_usage(working_folder_path).free,
+        'sessions': active_sessions,
+        'max_sessions': max_sessions,
+        'updated_at': time.time()
+    }
+
+async def publish_inventory(redis_client, snapshot: dict, ttl: int = 30):
+    await redis_client.set(f'{AGENT_KEY_PREFIX}{snapshot["id"]}', json.dumps(snapshot), ex=ttl)
+    await redis_client.sadd(AGENTS_KEY, snapshot['id'])
+
+
+def demand_key(hour: int) -> str:
+    return f'{DEMAND_KEY_PREFIX}{hour}'
+
+async def record_demand(redis_client, game: str, window_hours: int = 24):
+    # One sorted set per hour, expiring once it falls out of the window
+    key = demand_key(int(time.time() // 3600))
+    await redis_client.zincrby(key, 1, game)
+    await redis_client.expire(key, (window_hours + 1) * 3600)
+
+async def top_games(redis_client, window_hours: int = 24, limit: int = 5) -> list[str]:
+    hour = int(time.time() // 3600)
+    demand = {}
+    for key in [demand_key(h) for h in range(hour - window_hours + 1, hour + 1)]:
+        for game, count in await redis_client.zrange(key, 0, -1, withscores=True):
+            game = game.decode()
+            demand[game] = demand.get(game, 0) + count
+    return sorted(demand, key=demand.get, reverse=True)[:limit]
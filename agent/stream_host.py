@@ -0,0 +1,120 @@
+import sys
+import json
+import threading
+import gi
+gi.require_version('Gst', '1.0')
+from gi.repository import Gst, GLib
+from pipeline import VideoSpec, video_pipeline, base_caps, scale_caps
+
+# Runs one video pipeline in-process so the agent can retune it while it plays.
+# Usage: stream_host.py '{"spec": {...}, "window_handle": 0, "signalling_port": 8443}'
+# Commands arrive on stdin as JSON lines ({"bitrate_kbps": 3000}, {"width": 1280,
+# "height": 720}); stats are written to stdout as JSON lines, logs go to stderr.
+
+def field_names(structure: Gst.Structure) -> list[str]:
+    return [structure.nth_field_name(i) for i in range(structure.n_fields())]
+
+def field_value(structure: Gst.Structure, name: str):
+    try:
+        return structure.get_value(name)
+    except TypeError:
+        return None
+
+def receiver_stats(stats: Gst.Structure | None) -> list[dict]:
+    # webrtcsink nests webrtcbin stats per consumer; remote-inbound-rtp entries
+    # carry what the receivers report back about the video stream
+    found = []
+
+    def walk(structure: Gst.Structure):
+        names = field_names(structure)
+        if 'round-trip-time' in names:
+            found.append({
+                'rtt': field_value(structure, 'round-trip-time') or 0.0,
+                'loss': field_value(structure, 'fraction-lost') or 0.0,
+                'jitter': field_value(structure, 'jitter') or 0.0
+            })
+        for name in names:
+            value = field_value(structure, name)
+            if isinstance(value, Gst.Structure):
+                walk(value)
+
+    if stats:
+        walk(stats)
+    return found
+
+
+class StreamHost:
+    def __init__(self, spec: VideoSpec, window_handle: int | None, signalling_port: int, stats_interval: float = 1.0):
+        self.spec = spec
+        self.base_caps = base_caps(spec)
+        self.stats_interval = stats_interval
+        self.pipeline = Gst.parse_launch(' '.join(video_pipeline(spec, window_handle, signalling_port)))
+        self.encoder = self.pipeline.get_by_name('encoder')
+        self.scale = self.pipeline.get_by_name('scale')
+        self.sink = self.pipeline.get_by_name('sink')
+        self.loop = GLib.MainLoop()
+        self.failed = False
+
+        bus = self.pipeline.get_bus()
+        bus.add_signal_watch()
+        bus.connect('message::error', self.on_error)
+        bus.connect('message::eos', lambda bus, message: self.loop.quit())
+
+    def on_error(self, bus, message):
+        error, debug = message.parse_error()
+        print(f"Pipeline error: {error.message} ({debug})", file=sys.stderr)
+        self.failed = True
+        self.loop.quit()
+
+    def apply(self, command: dict):
+        if 'bitrate_kbps' in command:
+            self.encoder.set_property('bitrate', int(command['bitrate_kbps']))
+        if 'width' in command and 'height' in command:
+            caps = scale_caps(self.base_caps, int(command['width']), int(command['height']))
+            self.scale.set_property('caps', Gst.Caps.from_string(caps))
+        return False
+
+    def read_commands(self):
+        for line in sys.stdin:
+            try:
+                command = json.loads(line)
+            except json.JSONDecodeError:
+                print(f"Ignoring malformed command: {line.strip()}", file=sys.stderr)
+                continue
+            GLib.idle_add(self.apply, command)
+        # The agent closed our stdin, so nobody is controlling this stream any more
+        GLib.idle_add(self.loop.quit)
+
+    def report(self):
+        width = height = 0
+        caps = self.encoder.get_static_pad('sink').get_current_caps()
+        if caps and caps.get_size():
+            structure = caps.get_structure(0)
+            width = field_value(structure, 'width') or 0
+            height = field_value(structure, 'height') or 0
+        print(json.dumps({
+            'type': 'stats',
+            'bitrate_kbps': self.encoder.get_property('bitrate'),
+            'width': width,
+            'height': height,
+            'receivers': receiver_stats(self.sink.get_property('stats'))
+        }), flush=True)
+        return True
+
+    def run(self) -> int:
+        self.pipeline.set_state(Gst.State.PLAYING)
+        threading.Thread(target=self.read_commands, name='stream-host-commands', daemon=True).start()
+        GLib.timeout_add(int(self.stats_interval * 1000), self.report)
+        try:
+            self.loop.run()
+        finally:
+            self.pipeline.set_state(Gst.State.NULL)
+        return 1 if self.failed else 0
+
+
+if __name__ == "__main__":
+    Gst.init(None)
+    args = json.loads(sys.argv[1])
+    host = StreamHost(VideoSpec().merged(args['spec']), args.get('window_handle'), args['signalling_port'],
+                      args.get('stats_interval', 1.0))
+    sys.exit(host.run())
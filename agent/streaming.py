@@ -1,30 +1,46 @@
-from subprocess import Popen
+import sys
+import json
+import importlib.util
+from pathlib import Path
+from dataclasses import asdict
+from subprocess import Popen, PIPE
+from pipeline import GST_LAUNCH, VideoSpec, video_pipeline
 
-def start_audio_streaming() -> Popen:
+STREAM_HOST_PATH = Path(__file__).with_name('stream_host.py')
+
+def start_audio_streaming(signalling_port: int = 8444, target_pid: int | None = None) -> Popen:
+    if target_pid is None:
+        source = ["wasapisrc", "loopback=true", "low-latency=true"]
+    else:
+        # Process loopback captures only the game's audio, so concurrent sessions don't hear each other
+        source = ["wasapi2src", "loopback=true", "loopback-mode=include-process-tree", f"loopback-target-pid={target_pid}", "low-latency=true"]
     cmd = [
-        "gst-launch-1.0.exe",
-        "wasapisrc", "loopback=true", "low-latency=true",
+        GST_LAUNCH,
+        *source,
         "!", "audioconvert",
         "!", "opusenc", "bitrate=96000",
         "!", "queue", "max-size-buffers=1", "max-size-time=0", "max-size-bytes=0", "leaky=downstream",
         "!", "webrtcsink",
-        "run-signalling-server=true", "signalling-server-port=8444"
+        "run-signalling-server=true", f"signalling-server-port={signalling_port}"
     ]
     return Popen(cmd)
 
-def start_video_streaming(window_handle: int) -> Popen:
+def stream_host_available() -> bool:
+    return importlib.util.find_spec('gi') is not None
+
+def start_video_streaming(window_handle: int, signalling_port: int = 8443, spec: VideoSpec | None = None) -> Popen:
 
     # GST_TRACERS = "latency(flags=pipeline)"
     # GST_DEBUG_FILE = ".\latency.log"
     # $env:GST_DEBUG = "GST_TRACER:7"
 
-    cmd = [
-        "gst-launch-1.0.exe",
-        "d3d12screencapturesrc", "show-cursor=true", f"window-handle={window_handle}",
-        "!", "nvh264enc", "tune=ultra-low-latency", "preset=p1", "rc-mode=cbr", "bitrate=4000", "bframes=0", "rc-lookahead=0", "gop-size=30", "zerolatency=true", "vbv-buffer-size=400", "repeat-sequence-header=true", "qp-min=25", "qp-max=35",
-        "!", "video/x-h264,stream-format=avc,alignment=au",
-        "!", "queue", "max-size-buffers=1", "max-size-time=0", "max-size-bytes=0", "leaky=downstream",
-        "!", "webrtcsink",
-        "run-signalling-server=true"
-    ]
-    return Popen(cmd)
\ No newline at end of file
+    spec = spec or VideoSpec()
+    if spec.adaptive:
+        # Hosted in-process by PyGObject so the bitrate controller can retune it while it plays
+        args = json.dumps({
+            "spec": asdict(spec),
+            "window_handle": window_handle,
+            "signalling_port": signalling_port
+        })
+        return Popen([sys.executable, str(STREAM_HOST_PATH), args], stdin=PIPE, stdout=PIPE, text=True, bufsize=1)
+    return Popen([GST_LAUNCH, *video_pipeline(spec, window_handle, signalling_port)])
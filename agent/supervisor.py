@@ -0,0 +1,120 @@
+import os
+import sys
+import time
+import asyncio
+import threading
+from dataclasses import dataclass
+from subprocess import Popen
+from typing import Callable
+
+@dataclass
+class ProcessExit:
+    name: str
+    pid: int
+    returncode: int | None
+    started: float
+    ended: float
+    restarted: bool = False
+    # Set when the session ends for something other than a process exiting
+    error: str | None = None
+
+    @property
+    def duration(self) -> float:
+        return self.ended - self.started
+
+
+async def wait_for_process_exit(proc: Popen) -> int | None:
+    # Blocks on the process itself instead of polling: a pidfd registered with
+    # the event loop where the OS has them, otherwise a thread parked in wait().
+    loop = asyncio.get_running_loop()
+    exited = loop.create_future()
+
+    def set_exited():
+        if not exited.done():
+            exited.set_result(None)
+
+    pidfd = None
+    if sys.platform.startswith('linux') and hasattr(os, 'pidfd_open'):
+        try:
+            pidfd = os.pidfd_open(proc.pid)
+        except OSError:
+            pidfd = None
+
+    if pidfd is not None:
+        loop.add_reader(pidfd, set_exited)
+        try:
+            await exited
+        finally:
+            loop.remove_reader(pidfd)
+            os.close(pidfd)
+        return proc.wait()
+
+    def wait_thread():
+        proc.wait()
+        loop.call_soon_threadsafe(set_exited)
+
+    threading.Thread(target=wait_thread, name=f'wait-{proc.pid}', daemon=True).start()
+    await exited
+    return proc.returncode
+
+
+class ProcessSupervisor:
+    # Watches the processes of one session. A process registered with a restart
+    # callback is relaunched on exit up to max_restarts times; any other exit
+    # (or running out of restarts) resolves wait() so the session can end.
+    def __init__(self, max_restarts: int = 0):
+        self.max_restarts = max_restarts
+        self.tasks = {}
+        self.history: list[ProcessExit] = []
+        self.stopped = False
+        self.fatal = asyncio.get_running_loop().create_future()
+
+    def watch(self, name: str, proc: Popen, restart: Callable[[], Popen] | None = None,
+              on_restart: Callable[[Popen], None] | None = None):
+        self.tasks[name] = asyncio.create_task(self.supervise(name, proc, restart, on_restart))
+
+    async def supervise(self, name: str, proc: Popen, restart, on_restart):
+        restarts = 0
+        while True:
+            started = time.time()
+            returncode = await wait_for_process_exit(proc)
+            if self.stopped:
+                return
+
+            will_restart = restart is not None and restarts < self.max_restarts
+            exit = ProcessExit(name, proc.pid, returncode, started, time.time(), restarted=will_restart)
+            self.history.append(exit)
+            print(f"{name} process {exit.pid} exited with code {returncode} after {exit.duration:.1f}s")
+
+            if not will_restart:
+                if not self.fatal.done():
+                    self.fatal.set_result(exit)
+                return
+
+            restarts += 1
+            print(f"Restarting {name} process ({restarts}/{self.max_restarts})")
+            try:
+                proc = await asyncio.to_thread(restart)
+            except Exception as e:
+                print(f"Failed to restart {name} process: {e}")
+                if not self.fatal.done():
+                    self.fatal.set_result(exit)
+                return
+            if on_restart:
+                on_restart(proc)
+
+    def fail(self, name: str, error: str):
+        now = time.time()
+        print(f"{name} failed: {error}")
+        if not self.fatal.done():
+            self.fatal.set_result(ProcessExit(name, 0, None, now, now, error=error))
+
+    async def wait(self) -> ProcessExit:
+        return await asyncio.shield(self.fatal)
+
+    async def stop(self):
+        self.stopped = True
+        for task in self.tasks.values():
+            task.cancel()
+        await asyncio.gather(*self.tasks.values(), return_exceptions=True)
+        self.tasks.clear()
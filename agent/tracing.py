@@ -0,0 +1,125 @@
+import json
+import time
+import secrets
+import threading
+from abc import ABC, abstractmethod
+
+# Session lifecycle spans. The trace id is the session id handed out by the
+# backend, so one request can be followed from the queue to the save upload.
+# Times are taken from perf_counter and anchored to the wall clock once, so
+# durations stay precise while start times line up across agents.
+
+class SpanExporter(ABC):
+    @abstractmethod
+    def export(self, span: dict): ...
+
+    def close(self):
+        pass
+
+
+class JsonLinesExporter(SpanExporter):
+    def __init__(self, path: str):
+        self.file = open(path, 'a', encoding='utf-8')
+        self.lock = threading.Lock()
+
+    def export(self, span: dict):
+        line = json.dumps(span) + '\n'
+        with self.lock:
+            self.file.write(line)
+            self.file.flush()
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+class Span:
+    def __init__(self, tracer: 'Tracer', trace_id: str, name: str, parent: 'Span | None', start: float | None, attributes: dict):
+        self.tracer = tracer
+        self.trace_id = trace_id
+        self.span_id = secrets.token_hex(8)
+        self.parent_id = parent.span_id if parent else None
+        self.name = name
+        self.start = time.perf_counter() if start is None else start
+        self.end_time = None
+        self.attributes = attributes
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def child(self, name: str, start: float | None = None, **attributes) -> 'Span':
+        return self.tracer.start(self.trace_id, name, self, start, **attributes)
+
+    def end(self, error: BaseException | None = None):
+        if self.end_time is not None:
+            return
+        self.end_time = time.perf_counter()
+        if error is not None:
+            self.attributes['error'] = f"{type(error).__name__}: {error}"
+        self.tracer.export(self)
+
+    def to_dict(self, epoch: float) -> dict:
+        return {
+            'trace_id': self.trace_id,
+            'span_id': self.span_id,
+            'parent_id': self.parent_id,
+            'name': self.name,
+            'start': epoch + self.start,
+            'duration_ms': (self.end_time - self.start) * 1000,
+            'attributes': self.attributes
+        }
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.end(exc)
+        return False
+
+
+class NullSpan:
+    # Handed out when tracing is off so instrumented code pays for a method call and nothing else
+    trace_id = None
+    span_id = None
+
+    def set(self, **attributes):
+        pass
+
+    def child(self, name: str, start: float | None = None, **attributes) -> 'NullSpan':
+        return self
+
+    def end(self, error: BaseException | None = None):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+NULL_SPAN = NullSpan()
+
+
+class Tracer:
+    def __init__(self, exporter: SpanExporter | None = None):
+        self.exporter = exporter
+        self.epoch = time.time() - time.perf_counter()
+
+    @property
+    def enabled(self) -> bool:
+        return self.exporter is not None
+
+    def start(self, trace_id: str, name: str, parent: Span | None = None, start: float | None = None, **attributes) -> Span | NullSpan:
+        if self.exporter is None:
+            return NULL_SPAN
+        return Span(self, trace_id, name, parent, start, attributes)
+
+    def export(self, span: Span):
+        try:
+            self.exporter.export(span.to_dict(self.epoch))
+        except Exception as e:
+            print(f"Failed to export span {span.name}: {e}")
+
+    def close(self):
+        if self.exporter:
+            self.exporter.close()
@@ -0,0 +1,114 @@
+import hashlib
+import threading
+from pathlib import Path
+
+# Helpers for MinioClient's resumable transfers: checking results against S3
+# ETags and keeping throughput counters.
+#
+# A single-part object's ETag is the MD5 of its content. A multipart upload's
+# ETag is the MD5 of the concatenated binary part MD5s followed by "-<parts>",
+# so it can only be recomputed when the part size is known. Our own uploads
+# record it in the part-size metadata field for that reason.
+
+PART_SIZE_METADATA = 'x-amz-meta-part-size'
+READ_CHUNK_SIZE = 1024 * 1024
+
+def multipart_etag(part_md5s: list[bytes]) -> str:
+    return f"{hashlib.md5(b''.join(part_md5s)).hexdigest()}-{len(part_md5s)}"
+
+def file_etag(path: Path, part_size: int, multipart: bool) -> str:
+    whole = hashlib.md5()
+    parts = []
+    with open(path, 'rb') as f:
+        while True:
+            part = hashlib.md5()
+            remaining = part_size
+            while remaining > 0 and (chunk := f.read(min(READ_CHUNK_SIZE, remaining))):
+                part.update(chunk)
+                if not multipart:
+                    whole.update(chunk)
+                remaining -= len(chunk)
+            if remaining == part_size:
+                break
+            parts.append(part.digest())
+    return multipart_etag(parts) if multipart else whole.hexdigest()
+
+def verify_etag(path: Path, etag: str, part_size: int | None) -> bool:
+    # False when the ETag cannot be recomputed (a multipart upload of unknown
+    # part size); raises when it can and does not match
+    etag = etag.strip('"')
+    multipart = '-' in etag
+    if multipart and not part_size:
+        return False
+    actual = file_etag(path, part_size or READ_CHUNK_SIZE, multipart)
+    if actual != etag:
+        raise Exception(f"Integrity check failed for {path}: expected ETag {etag}, got {actual}")
+    return True
+
+class EtagReader:
+    # Passes a stream through to an upload of part_size parts, working out the
+    # ETag the server should end up with for what was actually sent
+    def __init__(self, src, part_size: int):
+        self.src = src
+        self.part_size = part_size
+        self.parts = []
+        self.part = hashlib.md5()
+        self.part_bytes = 0
+        self.size = 0
+
+    def read(self, size: int = -1) -> bytes:
+        data = self.src.read(size)
+        view = memoryview(data)
+        while view:
+            take = min(len(view), self.part_size - self.part_bytes)
+            self.part.update(view[:take])
+            self.part_bytes += take
+            view = view[take:]
+            if self.part_bytes == self.part_size:
+                self.parts.append(self.part.digest())
+                self.part = hashlib.md5()
+                self.part_bytes = 0
+        self.size += len(data)
+        return data
+
+    def etag(self) -> str:
+        parts = self.parts + [self.part.digest()] if self.part_bytes or not self.parts else self.parts
+        # Anything up to one part goes up as a plain upload
+        return parts[0].hex() if len(parts) == 1 else multipart_etag(parts)
+
+
+class TransferStats:
+    # Bytes and time are counted per request (ranged reads, parts), so the
+    # average rate is per connection; transfers are whole objects
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.totals = {direction: {'bytes': 0, 'seconds': 0.0, 'requests': 0, 'transfers': 0, 'resumed': 0, 'unverified': 0,
+                                   'failed': 0, 'last_mbps': 0.0} for direction in ('download', 'upload')}
+
+    def record(self, direction: str, size: int, seconds: float):
+        with self.lock:
+            totals = self.totals[direction]
+            totals['bytes'] += size
+            totals['seconds'] += seconds
+            totals['requests'] += 1
+            if seconds > 0:
+                totals['last_mbps'] = size * 8 / seconds / 1_000_000
+
+    def completed(self, direction: str, resumed: bool = False, verified: bool = True):
+        with self.lock:
+            totals = self.totals[direction]
+            totals['transfers'] += 1
+            totals['resumed'] += resumed
+            totals['unverified'] += not verified
+
+    def failed(self, direction: str):
+        with self.lock:
+            self.totals[direction]['failed'] += 1
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            snapshot = {}
+            for direction, totals in self.totals.items():
+                snapshot[direction] = dict(totals)
+                snapshot[direction]['avg_mbps'] = totals['bytes'] * 8 / totals['seconds'] / 1_000_000 if totals['seconds'] else 0.0
+            return snapshot
@@ -0,0 +1,199 @@
+import time
+import asyncio
+from pathlib import Path
+from subprocess import Popen, TimeoutExpired
+from typing import Callable
+from file_dl import GameFileManager
+from game_manager import GameManager, GameMetadata
+from scheduling import top_games
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+def stop_process(process: Popen):
+    try:
+        process.terminate()
+        process.wait(5)
+    except (TimeoutExpired, Exception):
+        pass
+
+
+class WarmInstance:
+    def __init__(self, game: str, game_path: Path, metadata: GameMetadata, process: Popen, hwnd: int):
+        self.game = game
+        self.game_path = game_path
+        self.metadata = metadata
+        self.process = process
+        self.hwnd = hwnd
+        self.ready_at = time.monotonic()
+
+    def alive(self) -> bool:
+        return self.process.poll() is None
+
+    def memory(self) -> int:
+        # Resident memory of the game and whatever it started; 0 when unknown
+        if psutil is None:
+            return 0
+        try:
+            root = psutil.Process(self.process.pid)
+            return sum(proc.memory_info().rss for proc in [root] + root.children(recursive=True))
+        except psutil.Error:
+            return 0
+
+    def stop(self):
+        stop_process(self.process)
+
+
+class WarmPool:
+    # Keeps up to size games launched ahead of demand, with an empty save root
+    # and their window up, so a session for one of them only imports its save
+    # and takes the running process over. The games are the configured ones,
+    # or else the most requested installed ones. An instance nobody claims
+    # within idle_timeout is stopped and its game is not relaunched until a
+    # session asks for it again; while the pool's memory is over max_memory
+    # the newest instance goes first. Only games whose metadata sets
+    # warm_pool_safe are pooled: one that reads its save at boot would keep
+    # the empty one and write it over the user's on exit.
+    def __init__(self, game_dl: GameFileManager, redis_client, start_game: Callable[[Path, GameMetadata], Popen], wait_for_window,
+                 may_launch: Callable[[], bool], busy_games: Callable[[], set[str]], size: int = 1, games: list[str] | None = None,
+                 idle_timeout: float = 1800, max_memory: int = 0, window_hours: int = 24, interval: float = 5.0):
+        self.game_dl = game_dl
+        self.redis_client = redis_client
+        self.start_game = start_game
+        self.wait_for_window = wait_for_window
+        self.may_launch = may_launch
+        self.busy_games = busy_games
+        self.size = size
+        self.games = games or []
+        self.idle_timeout = idle_timeout
+        self.max_memory = max_memory
+        self.window_hours = window_hours
+        self.interval = interval
+        self.instances: dict[str, WarmInstance] = {}
+        self.launching: dict[str, asyncio.Task] = {}
+        self.expired = set()
+        self.failed = set()
+        self.unsafe = set()
+        self.task = None
+        if max_memory and psutil is None:
+            print("psutil is not installed; the warm pool's memory cap is not enforced")
+
+    def start(self):
+        self.task = asyncio.create_task(self.run())
+
+    async def take(self, game: str, exclusive: bool = False) -> WarmInstance | None:
+        # With exclusive set (one desktop) instances of other games are
+        # stopped so they cannot compete with the session's window
+        self.expired.discard(game)
+        # The session may install an update that changes the flag
+        self.unsafe.discard(game)
+        if exclusive:
+            for other in [g for g in set(self.instances) | set(self.launching) if g != game]:
+                await self.discard(other)
+        launch = self.launching.get(game)
+        if launch:
+            await asyncio.wait([launch])
+        instance = self.instances.pop(game, None)
+        if instance is None:
+            return None
+        # The session holds its own pin from here on
+        self.game_dl.cache.unpin(game)
+        if not instance.alive():
+            print(f"Warm instance of {game} has exited")
+            return None
+        if not instance.metadata.warm_pool_safe:
+            print(f"{game} is not marked warm_pool_safe; not handing its warm instance over")
+            await asyncio.to_thread(instance.stop)
+            return None
+        print(f"Handing the warm instance of {game} (pid {instance.process.pid}) to a session")
+        return instance
+
+    async def discard(self, game: str):
+        launch = self.launching.pop(game, None)
+        if launch:
+            launch.cancel()
+            await asyncio.wait([launch])
+        instance = self.instances.pop(game, None)
+        if instance:
+            await asyncio.to_thread(instance.stop)
+            self.game_dl.cache.unpin(game)
+
+    async def launch(self, game: str):
+        self.game_dl.cache.pin(game)
+        process = None
+        try:
+            game_path = await asyncio.to_thread(self.game_dl.installed_path, game)
+            metadata = await asyncio.to_thread(GameMetadata.load, game_path / "cloud_gaming_metadata.json")
+            if not metadata.warm_pool_safe:
+                print(f"{game} is not marked warm_pool_safe; not keeping it warm")
+                self.unsafe.add(game)
+                self.game_dl.cache.unpin(game)
+                return
+            # Whoever played last already had their save staged; the instance boots without one
+            await asyncio.to_thread(GameManager.import_save, None, metadata)
+            started = time.perf_counter()
+            process = await asyncio.to_thread(self.start_game, game_path, metadata)
+            hwnd = await self.wait_for_window(process.pid)
+            if not hwnd:
+                raise Exception("window not found")
+            self.instances[game] = WarmInstance(game, game_path, metadata, process, hwnd)
+            print(f"Warm instance of {game} ready in {time.perf_counter() - started:.1f}s (pid {process.pid})")
+        except BaseException as e:
+            if process:
+                await asyncio.shield(asyncio.to_thread(stop_process, process))
+            self.game_dl.cache.unpin(game)
+            if isinstance(e, asyncio.CancelledError):
+                raise
+            print(f"Failed to warm up {game}: {e}")
+            self.failed.add(game)
+        finally:
+            self.launching.pop(game, None)
+
+    async def candidates(self) -> list[str]:
+        games = self.games
+        if not games:
+            try:
+                games = await top_games(self.redis_client, self.window_hours,
+                                        self.size + len(self.expired) + len(self.failed) + len(self.unsafe))
+            except Exception as e:
+                print(f"Failed to read game demand: {e}")
+                return []
+        skip = self.busy_games() | set(self.instances) | set(self.launching) | self.expired | self.failed | self.unsafe
+        return [game for game in games if game not in skip and self.game_dl.game_is_downloaded(game)]
+
+    async def trim(self):
+        for game, instance in list(self.instances.items()):
+            if not instance.alive():
+                print(f"Warm instance of {game} exited on its own")
+                await self.discard(game)
+            elif time.monotonic() - instance.ready_at > self.idle_timeout:
+                print(f"Warm instance of {game} sat idle for {self.idle_timeout:.0f}s; stopping it")
+                self.expired.add(game)
+                await self.discard(game)
+
+        if not self.max_memory:
+            return
+        while self.instances:
+            instances = list(self.instances.values())
+            usage = await asyncio.to_thread(lambda: sum(instance.memory() for instance in instances))
+            if usage <= self.max_memory:
+                return
+            newest = max(self.instances.values(), key=lambda i: i.ready_at)
+            print(f"Warm pool uses {usage / 1024 ** 2:.0f} MB of {self.max_memory / 1024 ** 2:.0f} MB; stopping {newest.game}")
+            await self.discard(newest.game)
+            # Launching it again would only go over again
+            self.expired.add(newest.game)
+
+    async def run(self):
+        try:
+            while True:
+                await self.trim()
+                if self.may_launch() and len(self.instances) + len(self.launching) < self.size:
+                    for game in (await self.candidates())[:self.size - len(self.instances) - len(self.launching)]:
+                        self.launching[game] = asyncio.create_task(self.launch(game))
+                await asyncio.sleep(self.interval)
+        finally:
+            for game in set(self.instances) | set(self.launching):
+                await self.discard(game)
@@ -0,0 +1,306 @@
+import io
+import os
+import time
+import zipfile
+import threading
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor, FIRST_EXCEPTION, wait
+from typing import Callable
+
+DEFAULT_PART_SIZE = 8 * 1024 * 1024
+
+class RangeSource(ABC):
+    size: int
+    # Changes whenever the archive does (an ETag, or size and mtime for files)
+    version: str | None = None
+
+    @abstractmethod
+    def read_range(self, offset: int, length: int) -> bytes: ...
+
+
+class LocalFileRangeSource(RangeSource):
+    def __init__(self, path):
+        self.path = path
+        st = os.stat(path)
+        self.size = st.st_size
+        self.version = f'{st.st_size}-{st.st_mtime_ns}'
+        self.local = threading.local()
+
+    def read_range(self, offset: int, length: int) -> bytes:
+        f = getattr(self.local, 'file', None)
+        if f is None:
+            f = self.local.file = open(self.path, 'rb')
+        f.seek(offset)
+        return f.read(length)
+
+
+class RangeFile(io.RawIOBase):
+    # Seekable read-only view of a RangeSource. Reads are served from the last
+    # fetched chunk; when a reader walks sequentially past a chunk the next one
+    # is fetched in the background so decompression overlaps the download.
+    def __init__(self, source: RangeSource, chunk_size: int, pinned: tuple[int, bytes] | None = None,
+                 prefetch_pool: ThreadPoolExecutor | None = None, on_fetch: Callable[[int], None] | None = None):
+        super().__init__()
+        self.source = source
+        self.chunk_size = chunk_size
+        self.pinned = pinned
+        self.prefetch_pool = prefetch_pool
+        self.on_fetch = on_fetch
+        self.pos = 0
+        self.limit = source.size
+        self.buffer_offset = 0
+        self.buffer = b''
+        self.prefetch = None
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            self.pos = offset
+        elif whence == io.SEEK_CUR:
+            self.pos += offset
+        else:
+            self.pos = self.source.size + offset
+        return self.pos
+
+    def set_window_end(self, end: int):
+        # Fetches are clipped to the end of the part being extracted so small
+        # entries at the end of a part do not pull in bytes of the next one.
+        self.limit = end
+        self.buffer_offset = -1
+        self.buffer = b''
+        self.prefetch = None
+
+    def fetch(self, offset: int) -> bytes:
+        limit = self.limit if offset < self.limit else self.source.size
+        end = min(offset + self.chunk_size, limit, self.source.size)
+        data = self.source.read_range(offset, end - offset)
+        if self.on_fetch:
+            self.on_fetch(len(data))
+        return data
+
+    def chunk_at(self, pos: int) -> tuple[int, bytes]:
+        if self.pinned and self.pinned[0] <= pos < self.pinned[0] + len(self.pinned[1]):
+            return self.pinned
+        if self.buffer_offset <= pos < self.buffer_offset + len(self.buffer):
+            return self.buffer_offset, self.buffer
+
+        sequential = pos == self.buffer_offset + len(self.buffer)
+        if self.prefetch and self.prefetch[0] == pos:
+            data = self.prefetch[1].result()
+        else:
+            data = self.fetch(pos)
+        self.prefetch = None
+        self.buffer_offset, self.buffer = pos, data
+
+        next_offset = pos + len(data)
+        if sequential and self.prefetch_pool and next_offset < min(self.limit, self.source.size):
+            self.prefetch = (next_offset, self.prefetch_pool.submit(self.fetch, next_offset))
+        return self.buffer_offset, self.buffer
+
+    def read(self, n=-1):
+        remaining = self.source.size - self.pos
+        if n is None or n < 0 or n > remaining:
+            n = remaining
+        out = bytearray()
+        while n > 0:
+            chunk_offset, chunk = self.chunk_at(self.pos)
+            start = self.pos - chunk_offset
+            piece = chunk[start:start + n]
+            if not piece:
+                break
+            out += piece
+            self.pos += len(piece)
+            n -= len(piece)
+        return bytes(out)
+
+    def readinto(self, b):
+        data = self.read(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+
+class InstallCancelled(Exception):
+    pass
+
+
+class TransferThrottle:
+    # Shared by every fetch thread of one transfer. Each read reserves its slot
+    # on a byte-rate timeline and sleeps until then; cancel() and set_rate()
+    # wake sleepers so a transfer can be aborted or unthrottled mid-flight.
+    def __init__(self, bytes_per_second: float = 0):
+        self.rate = bytes_per_second
+        self.cancelled = False
+        self.next_time = time.monotonic()
+        self.cond = threading.Condition()
+
+    def set_rate(self, bytes_per_second: float):
+        with self.cond:
+            self.rate = bytes_per_second
+            self.next_time = time.monotonic()
+            self.cond.notify_all()
+
+    def cancel(self):
+        with self.cond:
+            self.cancelled = True
+            self.cond.notify_all()
+
+    def acquire(self, size: int):
+        with self.cond:
+            if self.rate:
+                deadline = max(self.next_time, time.monotonic()) + size / self.rate
+                self.next_time = deadline
+                while self.rate and not self.cancelled and (remaining := deadline - time.monotonic()) > 0:
+                    self.cond.wait(remaining)
+            if self.cancelled:
+                raise InstallCancelled()
+
+
+class ThrottledRangeSource(RangeSource):
+    # Large ranges are read in slices so the rate stays smooth and a cancel
+    # takes effect within one slice
+    def __init__(self, source: RangeSource, throttle: TransferThrottle, slice_size: int = 256 * 1024):
+        self.source = source
+        self.throttle = throttle
+        self.slice_size = slice_size
+        self.size = source.size
+        self.version = source.version
+
+    def read_range(self, offset: int, length: int) -> bytes:
+        if length <= self.slice_size:
+            self.throttle.acquire(length)
+            return self.source.read_range(offset, length)
+        out = bytearray()
+        end = offset + length
+        while offset < end:
+            size = min(self.slice_size, end - offset)
+            self.throttle.acquire(size)
+            piece = self.source.read_range(offset, size)
+            if not piece:
+                break
+            out += piece
+            offset += len(piece)
+        return bytes(out)
+
+
+def member_path(info: zipfile.ZipInfo) -> str | None:
+    # Same rules as ZipFile.extract: no drive letters, absolute paths or '..'
+    name = os.path.splitdrive(info.filename.replace('\\', '/'))[1]
+    parts = [p for p in name.split('/') if p not in ('', '.', '..')]
+    return '/'.join(parts) if parts else None
+
+
+class ZipStreamExtractor:
+    # Extracts a zip straight from a RangeSource without ever materialising the
+    # archive. Entries are grouped into contiguous parts of roughly part_size
+    # bytes, each part is fetched with its own ranged read and decompressed by
+    # a worker pool while other parts are still downloading.
+    def __init__(self, source: RangeSource, workers: int = 4, part_size: int = DEFAULT_PART_SIZE,
+                 progress: Callable[[int, int], None] | None = None):
+        self.source = source
+        self.workers = max(1, workers)
+        self.part_size = part_size
+        self.progress = progress
+        self.fetched_bytes = 0
+        self.fetched_lock = threading.Lock()
+        self.progress_tracked = False
+
+        tail_size = min(source.size, 64 * 1024 + 22)
+        tail = (source.size - tail_size, source.read_range(source.size - tail_size, tail_size))
+        with zipfile.ZipFile(RangeFile(source, part_size, pinned=tail)) as zip:
+            self.infos = zip.infolist()
+            self.start_dir = zip.start_dir
+        self.fetch_total = self.start_dir
+        if self.start_dir < tail[0]:
+            tail = (self.start_dir, source.read_range(self.start_dir, source.size - self.start_dir))
+        self.central_directory = tail
+
+    def uncompressed_size(self) -> int:
+        return sum(info.file_size for info in self.infos)
+
+    def plan_parts(self, include: Callable[[zipfile.ZipInfo], bool] | None = None) -> list[list]:
+        infos = sorted(self.infos, key=lambda i: i.header_offset)
+        parts = []
+        for i, info in enumerate(infos):
+            if include and not include(info):
+                continue
+            end = infos[i + 1].header_offset if i + 1 < len(infos) else self.start_dir
+            # Only entries that follow each other share a ranged read, so skipped entries are never fetched
+            if parts and parts[-1][1] == info.header_offset and end - parts[-1][0] <= self.part_size:
+                parts[-1][1] = end
+                parts[-1][2].append(info)
+            else:
+                parts.append([info.header_offset, end, [info]])
+        # Largest parts first so one huge entry does not end up running alone at the end
+        parts.sort(key=lambda p: p[1] - p[0], reverse=True)
+        return parts
+
+    def track_progress(self, include: Callable[[zipfile.ZipInfo], bool] | None = None):
+        # Progress then runs once over everything include selects, however
+        # many extract calls that takes; otherwise each call reports its own
+        with self.fetched_lock:
+            self.fetched_bytes = 0
+            self.fetch_total = sum(end - start for start, end, _ in self.plan_parts(include))
+            self.progress_tracked = True
+
+    def on_fetch(self, size: int):
+        with self.fetched_lock:
+            self.fetched_bytes += size
+            fetched_bytes = min(self.fetched_bytes, self.fetch_total)
+        if self.progress:
+            self.progress(fetched_bytes, self.fetch_total)
+
+    def extract(self, on_entry: Callable[[zipfile.ZipInfo, str, io.BufferedIOBase | None], None],
+                include: Callable[[zipfile.ZipInfo], bool] | None = None):
+        local = threading.local()
+        opened = []
+        opened_lock = threading.Lock()
+
+        def worker_zip(prefetch_pool) -> tuple[zipfile.ZipFile, RangeFile]:
+            if getattr(local, 'zip', None) is None:
+                local.file = RangeFile(self.source, self.part_size, pinned=self.central_directory,
+                                       prefetch_pool=prefetch_pool, on_fetch=self.on_fetch)
+                local.zip = zipfile.ZipFile(local.file)
+                with opened_lock:
+                    opened.append(local.zip)
+            return local.zip, local.file
+
+        def extract_part(part, prefetch_pool):
+            _, end, entries = part
+            zip, file = worker_zip(prefetch_pool)
+            file.set_window_end(end)
+            for info in entries:
+                rel_path = member_path(info)
+                if rel_path is None:
+                    continue
+                if info.is_dir():
+                    on_entry(info, rel_path, None)
+                    continue
+                with zip.open(info) as src:
+                    on_entry(info, rel_path, src)
+
+        try:
+            with ThreadPoolExecutor(self.workers, thread_name_prefix='zip-prefetch') as prefetch_pool, \
+                 ThreadPoolExecutor(self.workers, thread_name_prefix='zip-extract') as extract_pool:
+                parts = self.plan_parts(include)
+                if not self.progress_tracked:
+                    with self.fetched_lock:
+                        self.fetched_bytes = 0
+                        self.fetch_total = sum(end - start for start, end, _ in parts)
+                futures = [extract_pool.submit(extract_part, part, prefetch_pool) for part in parts]
+                done, _ = wait(futures, return_when=FIRST_EXCEPTION)
+                for future in done:
+                    if future.exception():
+                        for f in futures:
+                            f.cancel()
+                        raise future.exception()
+        finally:
+            for zip in opened:
+                zip.close()
@@ -20,6 +20,7 @@ app.get('/create_session', async (req, res) => {
   }
 
   try {
+    // Any priority the client asks for is ignored; the session manager decides it
     let sessionInfo = await sessionManager.createSession(userId, gameId);
     res.json(sessionInfo);
   } catch (error) {
@@ -2,33 +2,90 @@ import Redis from "ioredis";
 import crypto from "crypto";
 export class SessionManager {
     static SESSIONS_KEY = 'sessions';
+    static GAME_QUEUE_PREFIX = 'sessions:game:';
+    // Agents serve higher priorities first; normal keeps the original queue names
+    static PRIORITIES = ['high', 'normal', 'low'];
+    static DEFAULT_PRIORITY = 'normal';
+    static ACK_TIMEOUT = 60;
+    // How long agents that already have the game installed get to claim
+    // a session before it is offered to every agent
+    static LOCALITY_TIMEOUT = 3;
+    // A user whose request timed out is served first when they retry within this many seconds
+    static RETRY_KEY_PREFIX = 'sessions:retry:';
+    static RETRY_WINDOW = 300;
 
     constructor(endpoint) {
         this.endpoint = endpoint;
         this.redis = new Redis(endpoint);
     }
 
+    static globalQueue(priority) {
+        return priority === SessionManager.DEFAULT_PRIORITY ? SessionManager.SESSIONS_KEY : `${SessionManager.SESSIONS_KEY}:${priority}`;
+    }
+
+    static gameQueue(gameId, priority) {
+        return priority === SessionManager.DEFAULT_PRIORITY
+            ? SessionManager.GAME_QUEUE_PREFIX + gameId
+            : `${SessionManager.SESSIONS_KEY}:${priority}:game:${gameId}`;
+    }
+
+    async priorityFor(userId) {
+        // Decided here, never by the client: only a retry after a timeout jumps the queue
+        let retrying = await this.redis.get(SessionManager.RETRY_KEY_PREFIX + userId);
+        return retrying ? 'high' : SessionManager.DEFAULT_PRIORITY;
+    }
+
     async createSession(userId, gameId) {
+        let priority = await this.priorityFor(userId);
         let sessionId = crypto.randomUUID();
+        // Agents drop requests past their deadline instead of launching a game for a client that has left
+        let enqueuedAt = Date.now();
         let sessionData = {
             id: sessionId,
             user: userId,
-            game: gameId
+            game: gameId,
+            enqueued_at: enqueuedAt,
+            deadline: enqueuedAt + SessionManager.ACK_TIMEOUT * 1000,
+            priority: priority
         };
-        await this.redis.lpush(SessionManager.SESSIONS_KEY, JSON.stringify(sessionData));
+        let request = JSON.stringify(sessionData);
+        let gameQueue = SessionManager.gameQueue(gameId, priority);
+        let globalQueue = SessionManager.globalQueue(priority);
 
-        console.log(`Attempting to create session: ${JSON.stringify(sessionData)}`);
+        console.log(`Attempting to create session: ${request}`);
 
-        let ack = await this.redis.blpop(sessionId, 60);
+        // Blocking pops get their own connection so concurrent requests don't queue behind each other
+        let blocking = this.redis.duplicate();
+        try {
+            await this.redis.lpush(gameQueue, request);
+            let ack = await blocking.blpop(sessionId, SessionManager.LOCALITY_TIMEOUT);
 
-        if (!ack) {
-            throw new Error("Session creation timed out");
-        }
+            if (!ack) {
+                // Popping from a queue is the claim: if the request is still in the game queue
+                // no agent with the game took it, so move it to the global queue. Otherwise an
+                // agent has claimed it and is about to ack.
+                let removed = await this.redis.lrem(gameQueue, 1, request);
+                if (removed) {
+                    console.log(`No agent with ${gameId} installed claimed session ${sessionId}, falling back to any agent`);
+                    await this.redis.lpush(globalQueue, request);
+                }
+                ack = await blocking.blpop(sessionId, SessionManager.ACK_TIMEOUT - SessionManager.LOCALITY_TIMEOUT);
+            }
 
-        console.log(`Received ack: ${ack[1]}`);
-        ack = JSON.parse(ack[1]);
-        console.log(`Session created: ${JSON.stringify(ack)}`);
+            if (!ack) {
+                await this.redis.lrem(globalQueue, 1, request);
+                await this.redis.set(SessionManager.RETRY_KEY_PREFIX + userId, 1, 'EX', SessionManager.RETRY_WINDOW);
+                throw new Error("Session creation timed out");
+            }
+            await this.redis.del(SessionManager.RETRY_KEY_PREFIX + userId);
 
-        return ack;
+            console.log(`Received ack: ${ack[1]}`);
+            ack = JSON.parse(ack[1]);
+            console.log(`Session created: ${JSON.stringify(ack)}`);
+
+            return ack;
+        } finally {
+            blocking.disconnect();
+        }
     }
-}
\ No newline at end of file
+}
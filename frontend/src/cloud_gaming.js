@@ -12,6 +12,28 @@ let previous_mouse_buttons = 0;
 
 let input_packet = new Uint8Array(56); // 32 bytes for keys + 16 bytes for mouse data + 8 bytes for timestamp
 
+// Input protocol v2: only changes are sent, as samples batched into sequenced frames.
+// See agent/input_protocol.py for the layout.
+const SUPPORTED_PROTOCOLS = [2, 1];
+const FIELD_FULL = 0x01, FIELD_DOWN = 0x02, FIELD_UP = 0x04, FIELD_BUTTONS = 0x08;
+const FIELD_DX = 0x10, FIELD_DY = 0x20, FIELD_WHEEL = 0x40;
+const MAX_SAMPLES_PER_FRAME = 32;
+
+let input_protocol = 1;
+let input_seq = 0;
+let pending_samples = [];
+let resync_requested = true;
+
+// A dropped input socket is reopened while the agent holds the session for us
+const RECONNECT_ATTEMPTS = 10;
+const RECONNECT_INTERVAL_MS = 2000;
+
+let input_ready = false;
+let session_started = false;
+let session_closing = false;
+let reconnect_attempts = 0;
+let session_error = null;
+
 function setMouseButton(button, down) {
     if (down) mouse_buttons |= (1 << button);
     else mouse_buttons &= ~(1 << button);
@@ -33,9 +55,101 @@ function stateChanged() {
           mouse_wheel !== 0);
 }
 
+function clampInt16(value) {
+    return Math.max(-32768, Math.min(32767, value));
+}
+
+function takeSample() {
+    let sample = { time: Date.now(), fields: 0, down: [], up: [], buttons: mouse_buttons, dx: 0, dy: 0, wheel: 0 };
+
+    if (resync_requested) {
+        sample.fields |= FIELD_FULL | FIELD_DOWN | FIELD_BUTTONS;
+        for (let vk = 0; vk < 256; vk++) {
+            if (keys_bit_mask[vk >>> 3] & (1 << (vk & 7))) sample.down.push(vk);
+        }
+        resync_requested = false;
+    } else {
+        for (let i = 0; i < 32; i++) {
+            let diff = keys_bit_mask[i] ^ previous_input_keys[i];
+            for (let bit = 0; diff; bit++, diff >>= 1) {
+                if (!(diff & 1)) continue;
+                let vk = i * 8 + bit;
+                if (keys_bit_mask[i] & (1 << bit)) sample.down.push(vk);
+                else sample.up.push(vk);
+            }
+        }
+        if (sample.down.length) sample.fields |= FIELD_DOWN;
+        if (sample.up.length) sample.fields |= FIELD_UP;
+        if (mouse_buttons !== previous_mouse_buttons) sample.fields |= FIELD_BUTTONS;
+    }
+
+    sample.dx = clampInt16(mouse_dx);
+    sample.dy = clampInt16(mouse_dy);
+    sample.wheel = clampInt16(mouse_wheel);
+    // Whatever did not fit in int16 goes out with the next sample
+    mouse_dx -= sample.dx;
+    mouse_dy -= sample.dy;
+    mouse_wheel -= sample.wheel;
+    if (sample.dx) sample.fields |= FIELD_DX;
+    if (sample.dy) sample.fields |= FIELD_DY;
+    if (sample.wheel) sample.fields |= FIELD_WHEEL;
+    return sample;
+}
+
+function encodeFrame(samples) {
+    let size = 12;
+    for (const s of samples) {
+        size += 3;
+        if (s.fields & FIELD_DOWN) size += 1 + s.down.length;
+        if (s.fields & FIELD_UP) size += 1 + s.up.length;
+        if (s.fields & FIELD_BUTTONS) size += 1;
+        if (s.fields & FIELD_DX) size += 2;
+        if (s.fields & FIELD_DY) size += 2;
+        if (s.fields & FIELD_WHEEL) size += 2;
+    }
+
+    let frame = new Uint8Array(size);
+    let view = new DataView(frame.buffer);
+    let base = samples[0].time;
+    view.setUint8(0, 2);
+    view.setUint8(1, samples.length);
+    view.setUint16(2, input_seq, true);
+    view.setBigUint64(4, BigInt(base), true);
+    input_seq = (input_seq + 1) & 0xFFFF;
+
+    let offset = 12;
+    for (const s of samples) {
+        view.setUint16(offset, Math.min(s.time - base, 0xFFFF), true);
+        view.setUint8(offset + 2, s.fields);
+        offset += 3;
+        for (const [field, keys] of [[FIELD_DOWN, s.down], [FIELD_UP, s.up]]) {
+            if (!(s.fields & field)) continue;
+            frame[offset] = keys.length;
+            frame.set(keys, offset + 1);
+            offset += 1 + keys.length;
+        }
+        if (s.fields & FIELD_BUTTONS) frame[offset++] = s.buttons;
+        for (const [field, value] of [[FIELD_DX, s.dx], [FIELD_DY, s.dy], [FIELD_WHEEL, s.wheel]]) {
+            if (!(s.fields & field)) continue;
+            view.setInt16(offset, value, true);
+            offset += 2;
+        }
+    }
+    return frame;
+}
+
+function sendInputFrame() {
+    // On a congested link samples are held back and sent together once the socket drains
+    if (ws.bufferedAmount > 0 && pending_samples.length < MAX_SAMPLES_PER_FRAME) {
+        return;
+    }
+    ws.send(encodeFrame(pending_samples));
+    pending_samples = [];
+}
+
 function sendInputPacket(force) {
-    if (!ws || ws.readyState !== WebSocket.OPEN) {
-        // Websocket not open, not sending
+    if (!ws || ws.readyState !== WebSocket.OPEN || !input_ready) {
+        // Websocket not open or session not acknowledged yet, not sending
         return;
     }
 
@@ -45,12 +159,24 @@ function sendInputPacket(force) {
             return;
         }
 
-        if (!stateChanged()) {
+        if (!stateChanged() && !(input_protocol === 2 && (resync_requested || pending_samples.length))) {
             // State hasnt changed, not sending
             return;
         }
     }
 
+    if (input_protocol === 2) {
+        if (stateChanged() || resync_requested) {
+            pending_samples.push(takeSample());
+        }
+        if (pending_samples.length) {
+            sendInputFrame();
+        }
+        previous_input_keys.set(keys_bit_mask);
+        previous_mouse_buttons = mouse_buttons;
+        return;
+    }
+
     // Packet contains:
     // Keyboard [0-31]
     // Mouse [32-47]
@@ -94,6 +220,8 @@ function showError(message) {
 }
 
 function terminateSession() {
+    session_closing = true;
+    input_ready = false;
     if (ws && ws.readyState === WebSocket.OPEN) {
         ws.close();
         ws = null;
@@ -109,7 +237,7 @@ function terminateSession() {
         audioElement.srcObject = null;
     }
 
-    showError("Session closed");
+    showError(session_error || "Session closed");
 }
 
 
@@ -305,6 +433,23 @@ async function init_stream(video_webrtc_config, audio_webrtc_config) {
     });
 }
 
+const progress_labels = {
+    install: "Installing game",
+    save_download: "Downloading save",
+    save_import: "Importing save",
+    launch: "Launching game",
+    window: "Waiting for game window",
+    stream: "Starting stream"
+};
+
+function formatProgress(msg) {
+    let label = progress_labels[msg.phase] || msg.phase;
+    if (msg.total) {
+        return `${label}... ${Math.floor(100 * msg.done / msg.total)}%`;
+    }
+    return `${label}...`;
+}
+
 const backend_endpoint = `http://localhost:3001`;
 
 async function init() {
@@ -334,15 +479,12 @@ async function init() {
     showError(`Connecting to server machine...`);
     console.log(`Connecting to ws: ${ws_endpoint}`);
 
-    ws = new WebSocket(ws_endpoint);
-
-    ws.addEventListener("open", (event) => {
-        ws.send(JSON.stringify({
-            type: "start",
-            id: session_info.id,
-            user: user_name,
-            game: game_name
-        }))
+    let start_message = JSON.stringify({
+        type: "start",
+        id: session_info.id,
+        user: user_name,
+        game: game_name,
+        protocols: SUPPORTED_PROTOCOLS
     });
 
     let video_webrtc_config = {
@@ -355,26 +497,76 @@ async function init() {
         signalingServerUrl: `${audio_signalling_endpoint}`,
     };
 
-    ws.addEventListener("message", (event) => {
+    connectInput(ws_endpoint, start_message, () => init_stream(video_webrtc_config, audio_webrtc_config));
+}
+
+function connectInput(ws_endpoint, start_message, onStarted) {
+    ws = new WebSocket(ws_endpoint);
+    let socket = ws;
+
+    socket.addEventListener("open", (event) => {
+        socket.send(start_message);
+    });
+
+    socket.addEventListener("message", (event) => {
         console.log(`Received from server: ${event.data}`);
         let msg = JSON.parse(event.data);
-        if (msg.result === "ok") {
-            console.log("Start acknowledged by server");
-            init_stream(video_webrtc_config, audio_webrtc_config);
+        if (msg.type === "progress") {
+            showError(formatProgress(msg));
+        }
+        else if (msg.type === "error") {
+            // The agent is ending the session; there is nothing to reconnect to
+            session_closing = true;
+            session_error = msg.msg;
+            showError(msg.msg);
+        }
+        else if (msg.type === "resync") {
+            // The agent lost input frames; the next sample carries the full key state
+            resync_requested = true;
+        }
+        else if (msg.result === "ok") {
+            input_protocol = msg.protocol || 1;
+            input_ready = true;
+            reconnect_attempts = 0;
+            if (msg.reattached) {
+                // The game and stream kept running; the agent starts from neutral input
+                console.log(`Reconnected to session, input protocol ${input_protocol}`);
+                pending_samples = [];
+                resync_requested = true;
+                showError("");
+            }
+            else {
+                console.log(`Start acknowledged by server, input protocol ${input_protocol}`);
+                session_started = true;
+                onStarted();
+            }
+        }
+        else if (session_started) {
+            // A reconnect can be refused while the agent is still handing the
+            // session over; the close that follows retries until attempts run out
+            console.log("Reconnect refused:", msg);
         }
         else {
+            session_closing = true;
             showError("Unexpected message from server:", msg);
         }
     });
 
-    ws.addEventListener("close", (event) => {
+    socket.addEventListener("close", (event) => {
         console.log("WebSocket connection closed", event);
+        input_ready = false;
+        if (session_started && !session_closing && reconnect_attempts < RECONNECT_ATTEMPTS) {
+            reconnect_attempts++;
+            showError(`Connection lost, reconnecting (${reconnect_attempts}/${RECONNECT_ATTEMPTS})...`);
+            setTimeout(() => connectInput(ws_endpoint, start_message, onStarted), RECONNECT_INTERVAL_MS);
+            return;
+        }
         terminateSession();
     });
 
-    ws.addEventListener("error", (event) => {
+    socket.addEventListener("error", (event) => {
+        // A close event always follows and decides whether to reconnect
         console.error("WebSocket error:", event);
-        terminateSession();
     });
 }
 